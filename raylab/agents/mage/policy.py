@@ -1,6 +1,7 @@
 """Policy for MAGE using PyTorch."""
 from typing import List
 from typing import Tuple
+from typing import Union
 
 from raylab.agents.sop import SOPTorchPolicy
 from raylab.options import configure
@@ -12,6 +13,8 @@ from raylab.policy.losses import MaximumLikelihood
 from raylab.policy.model_based.lightning import LightningModelTrainer
 from raylab.policy.model_based.lightning import TrainingSpec
 from raylab.policy.model_based.policy import MBPolicyMixin
+from raylab.policy.model_based.training import build_model_trainer
+from raylab.policy.model_based.training import TorchModelTrainer
 from raylab.policy.modules.critic import HardValue
 from raylab.torch.optim import build_optimizer
 from raylab.utils.types import StatDict
@@ -55,14 +58,14 @@ class MAGETorchPolicy(MBPolicyMixin, EnvFnMixin, SOPTorchPolicy):
 
     # pylint:disable=too-many-ancestors
     dist_class = WrapDeterministicPolicy
-    model_trainer: LightningModelTrainer
+    model_trainer: Union[LightningModelTrainer, TorchModelTrainer]
 
     def __init__(self, observation_space, action_space, config):
         super().__init__(observation_space, action_space, config)
         self._set_model_loss()
         self._set_critic_loss()
         self.build_timers()
-        self.model_trainer = LightningModelTrainer(
+        self.model_trainer = build_model_trainer(
             models=self.module.models,
             loss_fn=self.loss_model,
             optimizer=self.optimizers["models"],
@@ -1,7 +1,10 @@
 """Policy for MBPO using PyTorch."""
 from typing import List
+from typing import Optional
 from typing import Tuple
+from typing import Union
 
+import torch
 from ray.rllib import SampleBatch
 
 from raylab.agents.sac import SACTorchPolicy
@@ -13,13 +16,22 @@ from raylab.policy.losses import MaximumLikelihood
 from raylab.policy.model_based import EnvFnMixin
 from raylab.policy.model_based import LightningModelTrainer
 from raylab.policy.model_based import ModelSamplingMixin
+from raylab.policy.model_based import TorchModelTrainer
 from raylab.policy.model_based.policy import MBPolicyMixin
 from raylab.policy.model_based.policy import model_based_options
+from raylab.policy.model_based.sampling import AsyncModelSampler
 from raylab.policy.model_based.sampling import SamplingSpec
+from raylab.policy.model_based.training import build_model_trainer
 from raylab.torch.optim import build_optimizer
+from raylab.utils.replay_buffer import CompactReplayBuffer
+from raylab.utils.replay_buffer import GenerationalReplayBuffer
+from raylab.utils.replay_buffer import MixedReplaySampler
 from raylab.utils.replay_buffer import NumpyReplayBuffer
+from raylab.utils.replay_buffer import PrioritizedReplayBuffer
+from raylab.utils.replay_buffer import TorchReplayBuffer
 from raylab.utils.timer import TimerStat
 from raylab.utils.types import StatDict
+from raylab.utils.types import TensorDict
 
 
 DEFAULT_MODULE = {
@@ -51,13 +63,27 @@ DEFAULT_MODULE = {
     default=int(1e6),
     help="Size of the buffer for virtual samples",
 )
+@option(
+    "virtual_generations",
+    default=0,
+    help="""Number of model updates whose virtual samples are kept.
+
+    Virtual transitions are tagged with the number of model updates preceding
+    them. Those older than the latest 'virtual_generations' are evicted after
+    each model update, and the virtual buffer's memory is allocated on demand
+    and released as transitions are evicted. 0 keeps a FIFO buffer of
+    'virtual_buffer_size' transitions instead. Not compatible with
+    'replay/compact_obs'.
+    """,
+)
 @option(
     "model_rollouts",
     default=40,
     help="""Number of model rollouts to add to virtual buffer each policy interval.
 
     Populates virtual replay with this many model rollouts before each policy
-    improvement.
+    improvement, on average. See 'model_sampling/rollout_interval' to sample
+    them in larger, less frequent batches.
     """,
 )
 @option(
@@ -65,6 +91,17 @@ DEFAULT_MODULE = {
     default=0.1,
     help="Fraction of each policy minibatch to sample from environment replay pool",
 )
+@option(
+    "async_rollouts",
+    default=False,
+    help="""Whether to sample model rollouts in a background thread.
+
+    Rollouts for the next iteration run on a snapshot of the actor and elite
+    models while the current iteration's policy updates proceed. Their
+    transitions are added to the virtual buffer at the next augmentation step,
+    so virtual samples lag one iteration behind the models and actor.
+    """,
+)
 @option("module", default=DEFAULT_MODULE, override=True)
 @option(
     "optimizer/models",
@@ -76,7 +113,9 @@ class MBPOTorchPolicy(MBPolicyMixin, EnvFnMixin, ModelSamplingMixin, SACTorchPol
 
     # pylint:disable=too-many-ancestors
     virtual_replay: NumpyReplayBuffer
-    model_trainer: LightningModelTrainer
+    mixed_sampler: Optional[MixedReplaySampler] = None
+    rollout_sampler: Optional[AsyncModelSampler] = None
+    model_trainer: Union[LightningModelTrainer, TorchModelTrainer]
     dist_class = WrapStochasticPolicy
 
     def __init__(self, observation_space, action_space, config):
@@ -85,13 +124,15 @@ class MBPOTorchPolicy(MBPolicyMixin, EnvFnMixin, ModelSamplingMixin, SACTorchPol
         self.loss_model = MaximumLikelihood(models)
 
         self.build_timers()
-        self.model_trainer = LightningModelTrainer(
+        self.model_trainer = build_model_trainer(
             models=self.module.models,
             loss_fn=self.loss_model,
             optimizer=self.optimizers["models"],
             replay=self.replay,
             config=self.config,
         )
+        if self.config["async_rollouts"]:
+            self.rollout_sampler = AsyncModelSampler(self, seed=self.config["seed"])
 
     def _make_optimizers(self):
         optimizers = super()._make_optimizers()
@@ -101,17 +142,55 @@ class MBPOTorchPolicy(MBPolicyMixin, EnvFnMixin, ModelSamplingMixin, SACTorchPol
 
     def build_replay_buffer(self):
         super().build_replay_buffer()
-        self.virtual_replay = NumpyReplayBuffer(
+        args = (
             self.observation_space,
             self.action_space,
             self.config["virtual_buffer_size"],
         )
+        compact_obs = self.config["replay"]["compact_obs"]
+        if self.config["virtual_generations"]:
+            if compact_obs:
+                raise ValueError(
+                    "'virtual_generations' is not compatible with 'replay/compact_obs'"
+                )
+            self.virtual_replay = GenerationalReplayBuffer(
+                *args, max_generations=self.config["virtual_generations"]
+            )
+        else:
+            cls = CompactReplayBuffer if compact_obs else NumpyReplayBuffer
+            self.virtual_replay = cls(*args)
         self.virtual_replay.seed(self.config["seed"])
 
+        # Prioritized, tensor and prefetched real samples need their own paths
+        if not (
+            isinstance(self.replay, (PrioritizedReplayBuffer, TorchReplayBuffer))
+            or self.prefetcher
+        ):
+            self.mixed_sampler = MixedReplaySampler(
+                [self.replay, self.virtual_replay], self._minibatch_sizes()
+            )
+
+    def replay_batch_size(self) -> int:
+        env_batch_size, _ = self._minibatch_sizes()
+        return env_batch_size
+
+    def _minibatch_sizes(self) -> List[int]:
+        """Number of real and virtual transitions in each policy minibatch."""
+        batch_size = self.config["batch_size"]
+        env_batch_size = int(batch_size * self.config["real_data_ratio"])
+        return [env_batch_size, batch_size - env_batch_size]
+
     def build_timers(self):
         super().build_timers()
         self.timers["augmentation"] = TimerStat()
 
+    def close(self):
+        """Stop the background rollout and replay prefetcher threads, if any."""
+        if self.rollout_sampler:
+            self.rollout_sampler.close()
+            self.rollout_sampler = None
+        super().close()
+
     @learner_stats
     def learn_on_batch(self, samples: SampleBatch) -> dict:
         self.add_to_buffer(samples)
@@ -125,11 +204,14 @@ class MBPOTorchPolicy(MBPolicyMixin, EnvFnMixin, ModelSamplingMixin, SACTorchPol
                 timer.push_units_processed(model_info["model_epochs"])
                 info.update(model_info)
             self.set_new_elite(losses)
+            if isinstance(self.virtual_replay, GenerationalReplayBuffer):
+                self.virtual_replay.new_generation()
 
         with self.timers["augmentation"] as timer:
             count_before = len(self.virtual_replay)
             self.populate_virtual_buffer()
             timer.push_units_processed(len(self.virtual_replay) - count_before)
+            info.update(self.rollout_stats())
 
         with self.timers["policy"] as timer:
             times = self.config["improvement_steps"]
@@ -150,29 +232,80 @@ class MBPOTorchPolicy(MBPolicyMixin, EnvFnMixin, ModelSamplingMixin, SACTorchPol
         num_rollouts = self.config["model_rollouts"]
         real_data_ratio = self.config["real_data_ratio"]
         if not (num_rollouts and real_data_ratio < 1.0):
+            self.rollout_active_counts = []
+            return
+
+        # Generations may have been evicted between scheduled rollouts
+        scheduled = self.scheduled_rollouts(num_rollouts)
+        if not (scheduled or len(self.virtual_replay) == 0):
+            return
+        num_rollouts = scheduled or num_rollouts
+
+        if self.rollout_sampler:
+            self._populate_async(num_rollouts)
             return
 
         real_samples = self.replay.sample(num_rollouts)
-        virtual_samples = self.generate_virtual_sample_batch(real_samples)
-        self.virtual_replay.add(virtual_samples)
+        self.write_virtual_samples(real_samples, self.virtual_replay)
+
+    def _populate_async(self, num_rollouts: int):
+        """Add the rollouts sampled in the background and start the next ones.
+
+        The first call has no rollouts in flight, so it samples synchronously.
+        """
+        sampler = self.rollout_sampler
+        if sampler.pending:
+            self.virtual_replay.add(sampler.result())
+            self.rollout_active_counts = sampler.rollout_active_counts
+        else:
+            real_samples = self.replay.sample(num_rollouts)
+            self.virtual_replay.add(self.generate_virtual_sample_batch(real_samples))
+
+        sampler.submit(self.replay.sample(num_rollouts))
 
     def update_policy(self, times: int) -> StatDict:
-        batch_size = self.config["batch_size"]
-        env_batch_size = int(batch_size * self.config["real_data_ratio"])
-        model_batch_size = batch_size - env_batch_size
+        if self.mixed_sampler:
+            for batch in self.mixed_sampler.sample_many(times):
+                info = self.improve_policy(self.lazy_tensor_dict(batch))
+            return info
 
-        for _ in range(times):
-            samples = []
+        env_batch_size, model_batch_size = self._minibatch_sizes()
+        sources = []
+        if env_batch_size:
+            sources += [self.sample_replay_batches(times, env_batch_size)]
+        if model_batch_size:
+            virtual = self.virtual_replay.sample_many(times, model_batch_size)
+            sources += [[self.lazy_tensor_dict(b) for b in virtual]]
+
+        for samples in zip(*sources):
+            info = self.improve_policy(self._concat_minibatches(samples))
             if env_batch_size:
-                samples += [self.replay.sample(env_batch_size)]
-            if model_batch_size:
-                samples += [self.virtual_replay.sample(model_batch_size)]
-            batch = SampleBatch.concat_samples(samples)
-            batch = self.lazy_tensor_dict(batch)
-            info = self.improve_policy(batch)
+                # Real samples lead the minibatch
+                self.update_priorities(samples[0])
 
         return info
 
+    @staticmethod
+    def _concat_minibatches(samples: Tuple[TensorDict, ...]) -> TensorDict:
+        """Concatenate the fields shared by minibatches from different buffers.
+
+        Samples without importance sampling weights get a weight of 1 if
+        others have them, e.g., virtual samples mixed with prioritized ones.
+        """
+        keys = set.intersection(*(set(s.keys()) for s in samples))
+        batch = {k: torch.cat([s[k] for s in samples]) for k in keys}
+        weights = PrioritizedReplayBuffer.WEIGHTS
+        if any(weights in s for s in samples):
+            batch[weights] = torch.cat(
+                [
+                    s[weights]
+                    if weights in s
+                    else torch.ones_like(s[SampleBatch.REWARDS])
+                    for s in samples
+                ]
+            )
+        return batch
+
     def timer_stats(self) -> dict:
         stats = super().timer_stats()
         augmentation_timer = self.timers["augmentation"]
@@ -180,4 +313,10 @@ class MBPOTorchPolicy(MBPolicyMixin, EnvFnMixin, ModelSamplingMixin, SACTorchPol
             augmentation_time_s=round(augmentation_timer.mean, 3),
             augmentation_throughput=round(augmentation_timer.mean_throughput, 3),
         )
+        if self.rollout_sampler:
+            sampler = self.rollout_sampler
+            stats.update(
+                augmentation_generation_time_s=round(sampler.generation_time, 3),
+                augmentation_hidden_time_s=round(sampler.hidden_time, 3),
+            )
         return stats
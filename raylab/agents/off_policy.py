@@ -1,13 +1,28 @@
 # pylint:disable=missing-module-docstring
+import os
+import uuid
 from typing import Callable
 from typing import Iterable
 
+import numpy as np
+import ray
+from ray.rllib import RolloutWorker
+from ray.rllib import SampleBatch
 from ray.rllib.evaluation.worker_set import WorkerSet
+from ray.rllib.execution.common import _get_global_vars
+from ray.rllib.execution.common import _get_shared_metrics
+from ray.rllib.execution.common import LEARN_ON_BATCH_TIMER
+from ray.rllib.execution.common import LEARNER_INFO
+from ray.rllib.execution.common import STEPS_SAMPLED_COUNTER
+from ray.rllib.execution.common import STEPS_TRAINED_COUNTER
+from ray.rllib.execution.common import WORKER_UPDATE_TIMER
 from ray.rllib.execution.metric_ops import StandardMetricsReporting
 from ray.rllib.execution.rollout_ops import ParallelRollouts
 from ray.rllib.execution.train_ops import TrainOneStep
 from ray.rllib.utils.typing import ResultDict
 from ray.rllib.utils.typing import TrainerConfigDict
+from ray.util.iter import LocalIterator
+from ray.util.iter_metrics import SharedMetrics
 
 from raylab.execution import LearningStarts
 from raylab.options import option
@@ -30,21 +45,144 @@ def off_policy_execution_plan(workers: WorkerSet, config: TrainerConfigDict):
     return StandardMetricsReporting(train_op, workers, config)
 
 
+def sample_into_replay(worker: RolloutWorker) -> int:
+    """Collect samples and add them to the worker's own replay buffer.
+
+    Returns:
+        The number of timesteps collected
+    """
+    samples = worker.sample()
+    worker.foreach_trainable_policy(lambda p, _: p.add_to_buffer(samples))
+    return samples.count
+
+
+def empty_batch(policy) -> SampleBatch:
+    """Sample batch with no timesteps and the policy's replay fields."""
+    return SampleBatch(
+        {f.name: np.empty((0,) + f.shape, dtype=f.dtype) for f in policy.replay.fields}
+    )
+
+
+class TrainOnSharedReplay:
+    """Callable that improves the policy on a shared replay buffer.
+
+    Counts the timesteps written to the buffer by rollout workers, updates the
+    local policy once `learning_starts` timesteps have been collected and
+    broadcasts the new weights to the workers.
+    """
+
+    # pylint:disable=too-few-public-methods
+    def __init__(self, workers: WorkerSet, learning_starts: int):
+        self.workers = workers
+        self.learning_starts = learning_starts
+
+    def __call__(self, count: int) -> dict:
+        metrics = _get_shared_metrics()
+        metrics.counters[STEPS_SAMPLED_COUNTER] += count
+        if metrics.counters[STEPS_SAMPLED_COUNTER] < self.learning_starts:
+            return {}
+
+        local_worker = self.workers.local_worker()
+        learn_timer = metrics.timers[LEARN_ON_BATCH_TIMER]
+        with learn_timer:
+            # Samples are already in the shared buffer
+            info = local_worker.learn_on_batch(empty_batch(local_worker.get_policy()))
+            learn_timer.push_units_processed(count)
+        metrics.counters[STEPS_TRAINED_COUNTER] += count
+        metrics.info[LEARNER_INFO] = info
+
+        with metrics.timers[WORKER_UPDATE_TIMER]:
+            weights = ray.put(local_worker.get_weights())
+            for worker in self.workers.remote_workers():
+                worker.set_weights.remote(weights, _get_global_vars())
+        local_worker.set_global_vars(_get_global_vars())
+        return info
+
+
+def shared_replay_execution_plan(workers: WorkerSet, config: TrainerConfigDict):
+    """Execution plan for rollout workers writing to a shared replay buffer.
+
+    Remote workers add their samples directly to their segment of the buffer
+    and only report the number of timesteps collected, so that sample batches
+    are never sent to the learner.
+    """
+
+    def collect(timeout=None):
+        del timeout
+        remote_workers = workers.remote_workers()
+        while True:
+            counts = [w.apply.remote(sample_into_replay) for w in remote_workers]
+            yield sum(ray.get(counts))
+
+    counts = LocalIterator(collect, SharedMetrics())
+    train_op = counts.for_each(TrainOnSharedReplay(workers, config["learning_starts"]))
+    return StandardMetricsReporting(train_op, workers, config)
+
+
 class OffPolicyMixin:
     """Mixin for off-policy agents."""
 
     # pylint:disable=missing-function-docstring
     def validate_config(self, config: dict):
         super().validate_config(config)
-        assert config["num_workers"] == 0, "No point in using additional workers."
+        replay = config["policy"].setdefault("replay", {})
+        if replay.get("storage") == "shared":
+            assert not config["replay_checkpoint"], (
+                "Shared replay buffers cannot be checkpointed. Set"
+                " 'replay_checkpoint' to None with 'policy/replay/storage': shared"
+            )
+            replay["name"] = replay.get("name") or f"raylab-{uuid.uuid4().hex[:8]}"
+            # Evaluation workers do not write to the buffer
+            evaluation = config["evaluation_config"].setdefault("policy", {})
+            evaluation["replay"] = {"storage": "memory"}
+        else:
+            assert config["num_workers"] == 0, (
+                "No point in using additional workers without"
+                " 'policy/replay/storage': shared"
+            )
         assert (
             config["rollout_fragment_length"] >= 1
         ), "At least one sample must be collected."
+        assert config["replay_checkpoint"] in {
+            None,
+            "full",
+            "incremental",
+        }, "Replay checkpoints must be either 'full' or 'incremental'."
+
+    def cleanup(self):
+        # Stop the replay prefetchers' threads
+        for name in ("workers", "evaluation_workers"):
+            workers = getattr(self, name, None)
+            if workers:
+                workers.local_worker().foreach_trainable_policy(lambda p, _: p.close())
+        super().cleanup()
+
+    def save_checkpoint(self, checkpoint_dir: str) -> str:
+        checkpoint_path = super().save_checkpoint(checkpoint_dir)
+        if self.config["replay_checkpoint"]:
+            directory = self._replay_checkpoint_dir(checkpoint_dir)
+            self.get_policy().save_replay(directory)
+        return checkpoint_path
+
+    def load_checkpoint(self, checkpoint_path: str):
+        super().load_checkpoint(checkpoint_path)
+        if self.config["replay_checkpoint"]:
+            checkpoint_dir = os.path.dirname(checkpoint_path)
+            directory = self._replay_checkpoint_dir(checkpoint_dir)
+            if os.path.isdir(directory):
+                self.get_policy().restore_replay(directory)
+
+    def _replay_checkpoint_dir(self, checkpoint_dir: str) -> str:
+        if self.config["replay_checkpoint"] == "incremental":
+            return os.path.join(os.path.dirname(checkpoint_dir), "replay")
+        return os.path.join(checkpoint_dir, "replay")
 
     @property
     def execution_plan(
         self,
     ) -> Callable[[WorkerSet, TrainerConfigDict], Iterable[ResultDict]]:
+        if self.config["num_workers"] > 0:
+            return shared_replay_execution_plan
         return off_policy_execution_plan
 
     @staticmethod
@@ -56,6 +194,24 @@ class OffPolicyMixin:
                 default=0,
                 help="Hold this number of timesteps before first training operation.",
             ),
+            option(
+                "replay_checkpoint",
+                default=None,
+                help="""Whether to save the replay buffer contents with checkpoints.
+
+                'full' writes the buffer to `replay/` in each checkpoint
+                directory.
+
+                'incremental' keeps a single copy of the buffer in `replay/`
+                next to the checkpoint directories, usually the trial's log
+                directory, and only writes the transitions added since the last
+                checkpoint. Restoring any checkpoint then loads the latest
+                buffer contents, along with the observation statistics and
+                priorities that describe them.
+
+                None disables buffer checkpointing.
+                """,
+            ),
             option("rollout_fragment_length", default=1, override=True),
             option("num_workers", default=0, override=True),
             option("evaluation_config/explore", False, override=True),
@@ -1,7 +1,10 @@
 """SAC policy class using PyTorch."""
+from typing import Optional
+
 import torch
 import torch.nn as nn
 from ray.rllib.utils import override
+from torch import Tensor
 
 from raylab.options import configure
 from raylab.options import option
@@ -110,6 +113,10 @@ class SACTorchPolicy(OffPolicyMixin, TorchPolicy):
         )
         return info
 
+    @override(OffPolicyMixin)
+    def td_error(self) -> Optional[Tensor]:
+        return self.loss_critic.last_td_error
+
     def _update_critic(self, batch: TensorDict) -> dict:
         with self.optimizers.optimize("critics"):
             critic_loss, info = self.loss_critic(batch)
@@ -1,6 +1,9 @@
 """SOP policy class using PyTorch."""
+from typing import Optional
+
 import torch
 from ray.rllib.utils import override
+from torch import Tensor
 from torch.nn.utils import clip_grad_norm_
 
 from raylab.options import configure
@@ -11,6 +14,7 @@ from raylab.policy.losses import ActionDPG
 from raylab.policy.losses import DeterministicPolicyGradient
 from raylab.policy.losses import FittedQLearning
 from raylab.policy.modules.critic import HardValue
+from raylab.policy.off_policy import off_policy_options
 from raylab.policy.off_policy import OffPolicyMixin
 from raylab.torch.nn.utils import update_polyak
 from raylab.torch.optim import build_optimizer
@@ -18,10 +22,9 @@ from raylab.utils.types import TensorDict
 
 
 @configure
-@option("buffer_size", int(1e6))
-@option("batch_size", 256)
-@option("std_obs", False)
-@option("improvement_steps", 1)
+@option("buffer_size", int(1e6), override=True)
+@option("batch_size", 256, override=True)
+@off_policy_options
 @option(
     "dpg_loss",
     "default",
@@ -120,6 +123,10 @@ class SOPTorchPolicy(OffPolicyMixin, TorchPolicy):
         update_polyak(critics, target_critics, self.config["polyak"])
         return self._info.copy()
 
+    @override(OffPolicyMixin)
+    def td_error(self) -> Optional[Tensor]:
+        return self.loss_critic.last_td_error
+
     def _update_critic(self, batch_tensors):
         with self.optimizers.optimize("critics"):
             loss, info = self.loss_critic(batch_tensors)
@@ -1,4 +1,5 @@
 """SVG(inf) policy class using PyTorch."""
+import numpy as np
 import torch
 import torch.nn as nn
 from ray.rllib import SampleBatch
@@ -92,9 +93,8 @@ class SVGInfTorchPolicy(OffPolicyMixin, AdaptiveKLCoeffMixin, SVGTorchPolicy):
         self.add_to_buffer(samples)
 
         info = {}
-        for _ in range(int(traj_len * self.config["updates_per_step"])):
-            batch = self.replay.sample(self.config["batch_size"])
-            batch = self.lazy_tensor_dict(batch)
+        num_batches = int(traj_len * self.config["updates_per_step"])
+        for batch in self.sample_replay_batches(num_batches, self.config["batch_size"]):
             off_policy_stats = self._learn_off_policy(batch)
 
         info.update(off_policy_stats)
@@ -117,10 +117,10 @@ class SVGInfTorchPolicy(OffPolicyMixin, AdaptiveKLCoeffMixin, SVGTorchPolicy):
     def _learn_on_policy(self, samples: SampleBatch) -> dict:
         """Update on-policy components."""
         batch = self.lazy_tensor_dict(samples)
-        episodes = [self.lazy_tensor_dict(s) for s in samples.split_by_episode()]
+        episodes = self.lazy_tensor_dict(self._pad_episodes(samples))
 
         with self.optimizers.optimize("on_policy"):
-            loss, info = self.loss_actor(episodes)
+            loss, info = self.loss_actor.sequences_loss(episodes)
             kl_div = self._avg_kl_divergence(batch)
             loss = loss + kl_div * self.curr_kl_coeff
             loss.backward()
@@ -129,6 +129,24 @@ class SVGInfTorchPolicy(OffPolicyMixin, AdaptiveKLCoeffMixin, SVGTorchPolicy):
         info.update(self.update_kl_coeff(samples))
         return info
 
+    def _pad_episodes(self, samples: SampleBatch) -> SampleBatch:
+        """Stack the episodes in a sample batch into padded trajectories.
+
+        Returns:
+            A batch of `(num_episodes, max_length, ...)` arrays, padded by
+            repeating each episode's last transition, with boolean flags for
+            valid timesteps
+        """
+        eps_id = samples[SampleBatch.EPS_ID]
+        starts = np.flatnonzero(np.append(True, eps_id[1:] != eps_id[:-1]))
+        lengths = np.diff(np.append(starts, samples.count))
+        steps = np.arange(lengths.max())
+        idxes = starts[:, None] + np.minimum(steps, lengths[:, None] - 1)
+
+        padded = {k: samples[k][idxes] for k in self.loss_actor.batch_keys}
+        padded[self.loss_actor.MASK] = steps < lengths[:, None]
+        return SampleBatch(padded)
+
     @torch.no_grad()
     @override(AdaptiveKLCoeffMixin)
     def _kl_divergence(self, sample_batch: SampleBatch):
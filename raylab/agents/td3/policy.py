@@ -1,6 +1,9 @@
 """TD3 policy class using PyTorch."""
+from typing import Optional
+
 import torch
 from ray.rllib.utils import override
+from torch import Tensor
 from torch.nn.utils import clip_grad_norm_
 
 from raylab.options import configure
@@ -79,6 +82,10 @@ class TD3TorchPolicy(OffPolicyMixin, TorchPolicy):
 
         return self._info.copy()
 
+    @override(OffPolicyMixin)
+    def td_error(self) -> Optional[Tensor]:
+        return self.loss_critic.last_td_error
+
     def _update_critic(self, batch: TensorDict) -> dict:
         with self.optimizers.optimize("critics"):
             loss, info = self.loss_critic(batch)
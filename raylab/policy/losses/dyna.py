@@ -9,6 +9,7 @@ from torch import Tensor
 
 from raylab.policy.modules.actor import DeterministicPolicy
 from raylab.policy.modules.actor import StochasticPolicy
+from raylab.policy.modules.critic import BatchedQValueEnsemble
 from raylab.policy.modules.critic import QValueEnsemble
 from raylab.policy.modules.critic import VValue
 from raylab.policy.modules.model import SME
@@ -56,7 +57,7 @@ class DynaQLearning(UniformModelPriorMixin, EnvFunctionsMixin, Loss):
         gamma: discount factor
     """
 
-    critics: QValueEnsemble
+    critics: Union[QValueEnsemble, BatchedQValueEnsemble]
     actor: Union[DeterministicPolicy, StochasticPolicy]
     models: Union[StochasticModel, SME]
     target_critic: VValue
@@ -67,7 +68,7 @@ class DynaQLearning(UniformModelPriorMixin, EnvFunctionsMixin, Loss):
 
     def __init__(
         self,
-        critics: QValueEnsemble,
+        critics: Union[QValueEnsemble, BatchedQValueEnsemble],
         actor: Union[DeterministicPolicy, StochasticPolicy],
         models: Union[StochasticModel, SME],
         target_critic: VValue,
@@ -88,8 +89,6 @@ class DynaQLearning(UniformModelPriorMixin, EnvFunctionsMixin, Loss):
         self.models = models
         self.target_critic = target_critic
 
-        self._loss_fn = nn.MSELoss()
-
     @property
     def model_samples(self) -> int:
         """Number of next states to sample from model."""
@@ -120,10 +119,12 @@ class DynaQLearning(UniformModelPriorMixin, EnvFunctionsMixin, Loss):
 
             target = reward + self.gamma * next_values.mean(dim=0)
 
-        values = self.critics(obs, action)
-        loss = torch.stack([self._loss_fn(target, v) for v in values]).sum()
+        values = self.critics.stacked_values(obs, action)  # (*, N)
+        squared_errors = (target.unsqueeze(-1) - values) ** 2
+        # Sum of each critic's mean squared error
+        loss = squared_errors.reshape(-1, values.shape[-1]).mean(dim=0).sum()
 
         stats = {"loss(critics)": loss.item()}
-        stats.update(QLearningMixin.q_value_info(values))
+        stats.update(QLearningMixin.q_value_info(list(values.unbind(dim=-1))))
         stats.update(dist_params_stats(dist_params, name="model"))
         return loss, stats
@@ -1,4 +1,5 @@
 """Losses for model aware action gradient estimation."""
+from typing import Optional
 from typing import Tuple
 from typing import Union
 
@@ -7,6 +8,7 @@ from ray.rllib import SampleBatch
 from torch import Tensor
 
 from raylab.policy.modules.actor import DeterministicPolicy
+from raylab.policy.modules.critic import BatchedQValueEnsemble
 from raylab.policy.modules.critic import QValueEnsemble
 from raylab.policy.modules.critic import VValue
 from raylab.policy.modules.model import SME
@@ -29,18 +31,24 @@ class MAGE(EnvFunctionsMixin, UniformModelPriorMixin, Loss):
         target_critic: V-value estimator for the next state
         models: ensemble of stochastic models
 
+    If the batch contains importance sampling weights under the `weights` key,
+    the per-sample losses are scaled accordingly.
+
     Attributes:
         gamma: discount factor
         lambd: weighting factor for TD-error regularization
+        last_td_error: Absolute temporal difference errors of each sample in
+            the last batch, averaged over the critics
     """
 
     batch_keys = (SampleBatch.CUR_OBS,)
     gamma: float = 0.99
     lambd: float = 0.05
+    last_td_error: Optional[Tensor] = None
 
     def __init__(
         self,
-        critics: QValueEnsemble,
+        critics: Union[QValueEnsemble, BatchedQValueEnsemble],
         policy: DeterministicPolicy,
         target_critic: VValue,
         models: Union[StochasticModel, SME],
@@ -61,10 +69,14 @@ class MAGE(EnvFunctionsMixin, UniformModelPriorMixin, Loss):
         next_obs, dist_params = self.transition(obs, action)
 
         delta = self.temporal_diff_error(obs, action, next_obs)
-        grad_loss = self.gradient_loss(delta, action)
-        td_reg = self.temporal_diff_loss(delta)
+        weights = batch.get("weights")
+        grad_loss = self.gradient_loss(delta, action, weights)
+        td_reg = self.temporal_diff_loss(delta, weights)
         loss = grad_loss + self.lambd * td_reg
 
+        with torch.no_grad():
+            self.last_td_error = delta.abs().mean(dim=-1)
+
         info = {
             "loss(critics)": loss.item(),
             "loss(MAGE)": grad_loss.item(),
@@ -92,16 +104,20 @@ class MAGE(EnvFunctionsMixin, UniformModelPriorMixin, Loss):
         next_val = self.target_critic(next_obs)  # (*,)
         target = torch.where(done, reward, reward + self.gamma * next_val)  # (*,)
 
-        values = self.critics(obs, action)  # [(*,)] * N
-        return torch.stack([target - v for v in values], dim=-1)  # (*, N)
+        values = self.critics.stacked_values(obs, action)  # (*, N)
+        return target.unsqueeze(-1) - values  # (*, N)
 
     @staticmethod
-    def gradient_loss(delta: Tensor, action: Tensor) -> Tensor:
+    def gradient_loss(
+        delta: Tensor, action: Tensor, weights: Optional[Tensor] = None
+    ) -> Tensor:
         """Returns the action gradient loss for the Q-value function."""
         (action_gradient,) = torch.autograd.grad(delta.sum(), action, create_graph=True)
-        return torch.sum(action_gradient ** 2, dim=-1).mean()
+        losses = torch.sum(action_gradient ** 2, dim=-1)
+        return (losses if weights is None else weights * losses).mean()
 
     @staticmethod
-    def temporal_diff_loss(delta: Tensor) -> Tensor:
+    def temporal_diff_loss(delta: Tensor, weights: Optional[Tensor] = None) -> Tensor:
         """Returns the temporal difference loss for the Q-value function."""
-        return torch.sum(delta ** 2, dim=-1).mean()
+        losses = torch.sum(delta ** 2, dim=-1)
+        return (losses if weights is None else weights * losses).mean()
@@ -10,6 +10,7 @@ from torch import Tensor
 from torch.jit import fork
 from torch.jit import wait
 
+from raylab.policy.modules.model import BatchedSME
 from raylab.policy.modules.model import ForkedSME
 from raylab.policy.modules.model import SME
 from raylab.policy.modules.model import StochasticModel
@@ -83,6 +84,32 @@ class ForkedLosses(Losses):
         return [wait(f) for f in futures]
 
 
+class BatchedLosses(nn.Module):
+    """Compute the Negative Log-Likelihood losses of a batched model ensemble.
+
+    Evaluates every model at once on the same inputs.
+    """
+
+    # pylint:disable=abstract-method
+    def __init__(self, models: BatchedSME):
+        super().__init__()
+        self.models = models
+        self.logvar_reg = LogVarReg()
+
+    def forward(self, obs: Tensor, act: Tensor, new_obs: Tensor) -> List[Tensor]:
+        # pylint:disable=arguments-differ
+        size = self.models.ensemble_size
+        obs = obs.expand([size] + list(obs.shape))
+        act = act.expand([size] + list(act.shape))
+        new_obs = new_obs.expand([size] + list(new_obs.shape))
+        params = self.models.batched(obs, act)
+        nlls = -self.models.batched.log_prob(new_obs, params).mean(dim=-1)
+        return [
+            nll + self.logvar_reg(p)
+            for nll, p in zip(nlls.unbind(0), self.models.unbind_params(params))
+        ]
+
+
 class MaximumLikelihood(Loss):
     """Loss function for model learning of single transitions.
 
@@ -97,7 +124,7 @@ class MaximumLikelihood(Loss):
     )
     _last_output: Tuple[Tensor, StatDict]
 
-    def __init__(self, models: Union[StochasticModel, SME]):
+    def __init__(self, models: Union[StochasticModel, SME, BatchedSME]):
         if isinstance(models, StochasticModel):
             # Treat everything as if ensemble
             models = SME([models])
@@ -109,6 +136,10 @@ class MaximumLikelihood(Loss):
     def build_losses(self):
         # pylint:disable=missing-function-docstring
         models = self.models
+        if isinstance(models, BatchedSME):
+            self.loss_fns = BatchedLosses(models)
+            return
+
         losses = [NLLLoss(m) for m in models]
         cls = ForkedLosses if isinstance(models, ForkedSME) else Losses
         self.loss_fns = cls(losses)
@@ -10,6 +10,7 @@ from torch import Tensor
 from raylab.policy.modules.actor import Alpha
 from raylab.policy.modules.actor import DeterministicPolicy
 from raylab.policy.modules.actor import StochasticPolicy
+from raylab.policy.modules.critic import BatchedQValueEnsemble
 from raylab.policy.modules.critic import ClippedQValue
 from raylab.policy.modules.critic import QValue
 from raylab.policy.modules.critic import QValueEnsemble
@@ -21,8 +22,10 @@ from .utils import action_dpg
 from .utils import dist_params_stats
 
 
-def clip_if_needed(critic: Union[QValue, QValueEnsemble]) -> QValue:
-    if isinstance(critic, QValueEnsemble):
+def clip_if_needed(
+    critic: Union[QValue, QValueEnsemble, BatchedQValueEnsemble]
+) -> QValue:
+    if isinstance(critic, (QValueEnsemble, BatchedQValueEnsemble)):
         critic = ClippedQValue(critic)
     return critic
 
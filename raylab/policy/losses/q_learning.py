@@ -2,14 +2,16 @@
 from abc import ABC
 from abc import abstractmethod
 from typing import List
+from typing import Optional
 from typing import Tuple
+from typing import Union
 
 import torch
-import torch.nn as nn
 from ray.rllib import SampleBatch
 from torch import Tensor
 
 import raylab.utils.dictionaries as dutil
+from raylab.policy.modules.critic import BatchedQValueEnsemble
 from raylab.policy.modules.critic import QValueEnsemble
 from raylab.policy.modules.critic import VValue
 from raylab.utils.types import StatDict
@@ -19,7 +21,16 @@ from .abstract import Loss
 
 
 class QLearningMixin(ABC):
-    """Adds default call for Q-Learning losses."""
+    """Adds default call for Q-Learning losses.
+
+    If the batch contains importance sampling weights under the `weights` key,
+    e.g., from a prioritized replay buffer, the squared errors of each sample
+    are scaled accordingly.
+
+    Attributes:
+        last_td_error: Absolute temporal difference errors of each sample in
+            the last batch, averaged over the critics
+    """
 
     # pylint:disable=too-few-public-methods
     batch_keys = (
@@ -29,19 +40,27 @@ class QLearningMixin(ABC):
         SampleBatch.NEXT_OBS,
         SampleBatch.DONES,
     )
-    critics: QValueEnsemble
+    critics: Union[QValueEnsemble, BatchedQValueEnsemble]
+    last_td_error: Optional[Tensor] = None
 
     def __call__(self, batch: TensorDict) -> Tuple[Tensor, TensorDict]:
         """Compute loss for Q-value function."""
         obs, actions, rewards, next_obs, dones = dutil.get_keys(batch, *self.batch_keys)
         with torch.no_grad():
             target_values = self.critic_targets(rewards, next_obs, dones)
-        loss_fn = nn.MSELoss()
-        values = self.critics(obs, actions)
-        critic_loss = torch.stack([loss_fn(v, target_values) for v in values]).sum()
+        values = self.critics.stacked_values(obs, actions)  # (*, N)
+        td_errors = target_values.unsqueeze(-1) - values
+        squared_errors = td_errors ** 2
+        if "weights" in batch:
+            squared_errors = batch["weights"].unsqueeze(-1) * squared_errors
+        # Sum of each critic's mean squared error
+        critic_loss = squared_errors.reshape(-1, values.shape[-1]).mean(dim=0).sum()
+
+        with torch.no_grad():
+            self.last_td_error = td_errors.abs().mean(dim=-1)
 
         stats = {"loss(critics)": critic_loss.item()}
-        stats.update(self.q_value_info(values))
+        stats.update(self.q_value_info(list(values.unbind(dim=-1))))
         return critic_loss, stats
 
     @abstractmethod
@@ -87,7 +106,7 @@ class FittedQLearning(QLearningMixin, Loss):
 
     def __init__(
         self,
-        critics: QValueEnsemble,
+        critics: Union[QValueEnsemble, BatchedQValueEnsemble],
         target_critic: VValue,
     ):
         self.critics = critics
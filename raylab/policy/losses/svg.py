@@ -125,8 +125,12 @@ class TrajectorySVG(EnvFunctionsMixin, Loss):
         model: model that reproduces state and its log density
         actor: policy that reproduces action and its log density
         critic: state-value function
+
+    Attributes:
+        MASK: Key of the valid timestep flags in padded trajectory batches
     """
 
+    MASK: str = "mask"
     batch_keys: Tuple[str, str, str] = (
         SampleBatch.CUR_OBS,
         SampleBatch.ACTIONS,
@@ -169,6 +173,33 @@ class TrajectorySVG(EnvFunctionsMixin, Loss):
         info = {"loss(actor)": loss.item(), "sim_return_mean": sim_return_mean.item()}
         return loss, info
 
+    def sequences_loss(self, batch: TensorDict) -> Tuple[Tensor, StatDict]:
+        """Compute Stochastic Value Gradient loss given padded trajectories.
+
+        Reproduces all trajectories at once, as opposed to looping over
+        episodes.
+
+        Args:
+            batch: Dictionary of `(B, T, ...)` tensors, e.g., from
+                `NumpyReplayBuffer.sample_sequences`, with boolean flags for
+                valid timesteps under `MASK`
+        """
+        assert (
+            self._rollout is not None
+        ), "Rollout module not set. Did you call `set_reward_fn`?"
+
+        obs, actions, next_obs = self.unpack_batch(batch)
+        _, _, rewards = self._rollout(
+            actions.transpose(0, 1), next_obs.transpose(0, 1), obs[:, 0]
+        )
+        mask = batch[self.MASK].transpose(0, 1)
+
+        sim_return_mean = torch.where(mask, rewards, torch.zeros_like(rewards))
+        sim_return_mean = sim_return_mean.sum(dim=0).mean()
+        loss = -sim_return_mean
+        info = {"loss(actor)": loss.item(), "sim_return_mean": sim_return_mean.item()}
+        return loss, info
+
 
 class ReproduceRewards(nn.Module):
     """Unrolls a policy, model and reward function given a trajectory.
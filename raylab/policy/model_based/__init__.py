@@ -3,10 +3,12 @@ from .envfn import EnvFnMixin
 from .lightning import LightningModelTrainer
 from .policy import MBPolicyMixin
 from .sampling import ModelSamplingMixin
+from .training import TorchModelTrainer
 
 __all__ = [
     "EnvFnMixin",
     "LightningModelTrainer",
     "MBPolicyMixin",
     "ModelSamplingMixin",
+    "TorchModelTrainer",
 ]
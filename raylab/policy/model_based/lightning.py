@@ -1,30 +1,37 @@
 # pylint:disable=missing-module-docstring
-import copy
 import statistics as stats
 import warnings
 from dataclasses import dataclass
 from dataclasses import field
+from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Sequence
 from typing import Tuple
+from typing import Union
 
+import numpy as np
 import pytorch_lightning as pl
 import torch
 import torch.nn as nn
 from dataclasses_json import DataClassJsonMixin
 from torch import Tensor
 from torch.optim import Optimizer
+from torch.utils.data import BatchSampler
 from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
-from torch.utils.data import random_split
+from torch.utils.data import RandomSampler
+from torch.utils.data import SequentialSampler
 
 from raylab.options import option
 from raylab.policy.losses import Loss
 from raylab.policy.modules.model import SME
 from raylab.torch.utils import convert_to_tensor
+from raylab.torch.utils import StateSnapshot
 from raylab.utils.lightning import supress_stderr
 from raylab.utils.lightning import supress_stdout
 from raylab.utils.replay_buffer import NumpyReplayBuffer
+from raylab.utils.timer import TimerStat
 from raylab.utils.types import StatDict
 from raylab.utils.types import TensorDict
 
@@ -89,7 +96,8 @@ class DatamoduleSpec(DataClassJsonMixin):
     """Specifications for creating the data module.
 
     Attributes:
-        holdout_ratio: Fraction of replay buffer to use as validation dataset
+        holdout_ratio: Expected fraction of replay buffer to use as validation
+            dataset
         max_holdout: Maximum number of samples to use as validation dataset
         batch_size: Size of minibatch for dynamics model training
         shuffle: set to ``True`` to have the data reshuffled
@@ -115,6 +123,17 @@ class DatamoduleSpec(DataClassJsonMixin):
 class DataModule(pl.LightningDataModule):
     """Data module from experience replay buffer
 
+    Minibatches are gathered from the replay buffer with a single indexing
+    operation each, by feeding whole batches of indexes from a
+    :class:`~torch.utils.data.BatchSampler` to the dataset.
+
+    The holdout set is persistent: each storage slot of the replay buffer is
+    assigned a fixed random key once, and is held out for validation if its
+    key is below the holdout ratio. The validation set thus only grows as
+    new transitions are added, and a transition that overwrites a held out
+    one in the ring buffer, never seen during training, takes its place.
+    If `max_holdout` is reached, the slots with the lowest keys are kept.
+
     Args:
         replay: Experience replay buffer
         spec: Data loading especifications
@@ -129,47 +148,89 @@ class DataModule(pl.LightningDataModule):
         super().__init__()
         self.replay_dataset = ReplayDataset(replay)
         self.spec = spec
+        self._holdout_keys: Optional[np.ndarray] = None
+        self._holdout_slots: Optional[np.ndarray] = None
 
     def setup(self, stage=None):
-        dataset = self.replay_dataset
-        spec = self.spec
-        replay_count = len(dataset)
-        max_holdout = spec.max_holdout or replay_count
-        val_size = min(round(replay_count * spec.holdout_ratio), max_holdout)
-        self.train_dataset, self.val_dataset = random_split(
-            dataset, (replay_count - val_size, val_size)
-        )
+        replay = self.replay_dataset.replay
+        replay_count = len(replay)
+        val_idxes = self.holdout_idxes()
+        train_mask = np.ones(replay_count, dtype=bool)
+        train_mask[val_idxes] = False
+        self.train_dataset = ReplayDataset(replay, np.flatnonzero(train_mask))
+        self.val_dataset = ReplayDataset(replay, val_idxes)
+
+    def holdout_idxes(self) -> np.ndarray:
+        """Storage indexes of the transitions currently held out for validation.
+
+        Returns:
+            A sorted array of indexes into the replay buffer
+        """
+        replay = self.replay_dataset.replay
+        if self._holdout_keys is None or len(self._holdout_keys) < replay.capacity:
+            self._holdout_keys = torch.rand(replay.capacity).numpy()
+            self._holdout_slots = np.flatnonzero(
+                self._holdout_keys < self.spec.holdout_ratio
+            )
+
+        replay_count = len(replay)
+        idxes = self._holdout_slots[
+            : np.searchsorted(self._holdout_slots, replay_count)
+        ]
+        max_holdout = self.spec.max_holdout
+        if max_holdout and len(idxes) > max_holdout:
+            lowest = np.argpartition(self._holdout_keys[idxes], max_holdout)
+            idxes = np.sort(idxes[lowest[:max_holdout]])
+        return idxes
 
     def train_dataloader(self, *args, **kwargs):
-        spec = self.spec
-        kwargs = dict(
-            shuffle=spec.shuffle,
-            batch_size=spec.batch_size,
-            num_workers=spec.num_workers,
-        )
-        return DataLoader(self.train_dataset, **kwargs)
+        return self._batch_loader(self.train_dataset, shuffle=self.spec.shuffle)
 
     def val_dataloader(self, *args, **kwargs):
         if len(self.val_dataset) == 0:
             return None
 
-        spec = self.spec
-        kwargs = dict(
-            shuffle=False, batch_size=spec.batch_size, num_workers=spec.num_workers
+        return self._batch_loader(self.val_dataset, shuffle=False)
+
+    def _batch_loader(self, dataset: Dataset, shuffle: bool) -> DataLoader:
+        # Random samplers reject empty datasets
+        shuffle = shuffle and len(dataset) > 0
+        sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+        batch_sampler = BatchSampler(
+            sampler, batch_size=self.spec.batch_size, drop_last=False
+        )
+        # Disable automatic batching: each item is already a whole minibatch
+        return DataLoader(
+            dataset,
+            batch_size=None,
+            sampler=batch_sampler,
+            num_workers=self.spec.num_workers,
         )
-        return DataLoader(self.val_dataset, **kwargs)
 
 
 class ReplayDataset(Dataset):
-    """Adapter for using a replay buffer as an map-style dataset."""
+    """Adapter for using a replay buffer as an map-style dataset.
+
+    Also accepts sequences of indexes, returning the corresponding minibatch
+    gathered from the replay buffer at once.
 
-    def __init__(self, replay: NumpyReplayBuffer):
+    Args:
+        replay: Experience replay buffer
+        idxes: Storage indexes of the transitions in the dataset. If None,
+            uses all transitions in the buffer.
+    """
+
+    def __init__(self, replay: NumpyReplayBuffer, idxes: Optional[np.ndarray] = None):
         self.replay = replay
+        self.idxes = idxes
 
     def __len__(self):
-        return len(self.replay)
+        return len(self.replay) if self.idxes is None else len(self.idxes)
 
-    def __getitem__(self, idx: int):
+    def __getitem__(self, idx: Union[int, Sequence[int]]):
+        idx = np.asarray(idx)
+        if self.idxes is not None:
+            idx = self.idxes[idx]
         return self.replay[idx]
 
 
@@ -183,11 +244,21 @@ class EarlyStopping(pl.callbacks.EarlyStopping):
     _train_outputs: List[Tuple[Tensor, StatDict]]
     _val_outputs: List[Tuple[Tensor, StatDict]]
     _loss: Tuple[List[float], StatDict] = None
-    _module_state: Optional[dict] = None
+    _snapshot: Optional[StateSnapshot] = None
 
     def __warn_deprecated_monitor_key(self):
         pass  # Disable annoying UserWarning
 
+    def reset(self):
+        """Forget the best score and saved outputs before a new training run."""
+        self.wait_count = 0
+        self.stopped_epoch = 0
+        inf = torch.tensor(float("inf"))
+        self.best_score = inf if self.monitor_op == torch.lt else -inf
+        self._loss = None
+        if self._snapshot:
+            self._snapshot.reset()
+
     def on_train_epoch_start(self, trainer, pl_module):
         self._train_outputs = []
         super().on_train_epoch_start(trainer, pl_module)
@@ -235,17 +306,31 @@ class EarlyStopping(pl.callbacks.EarlyStopping):
         self._loss = (model_losses, model_infos)
 
     def save_module_state(self, pl_module):
-        self._module_state = copy.deepcopy(pl_module.state_dict())
+        self._save_snapshot(pl_module.state_dict())
+
+    def _save_snapshot(self, module_state: dict):
+        if self._snapshot is None:
+            self._snapshot = StateSnapshot()
+        self._snapshot.save(module_state)
 
     def state_dict(self):
         state = super().state_dict()
-        state.update(loss=self._loss, module=self._module_state)
+        snapshot = self._snapshot
+        saved = snapshot is not None and snapshot.saved
+        state.update(
+            loss=self._loss,
+            module=snapshot.state if saved else None,
+            snapshots=snapshot.count if snapshot else 0,
+        )
         return state
 
     def load_state_dict(self, state_dict):
         self._loss = state_dict["loss"]
-        self._module_state = copy.deepcopy(state_dict["module"])
-        used = set("loss module".split())
+        if self._snapshot:
+            self._snapshot.reset()
+        if state_dict["module"]:
+            self._save_snapshot(state_dict["module"])
+        used = set("loss module snapshots".split())
         super().load_state_dict({k: v for k, v in state_dict.items() if k not in used})
 
 
@@ -313,11 +398,25 @@ class TrainingSpec(DataClassJsonMixin):
         datamodule: Specifications for creating the data module
         training: Specifications for model training
         warmup: Specifications for model warmup
+        reuse_trainer: Whether to build the Lightning trainers for training
+            and warmup only once, resetting their progress and early stopping
+            state on each call instead
+        framework: Either 'lightning', to train with PyTorch Lightning, or
+            'torch', to train with a plain PyTorch loop following the same
+            specifications
     """
 
     datamodule: DatamoduleSpec = field(default_factory=DatamoduleSpec)
     training: LightningTrainerSpec = field(default_factory=LightningTrainerSpec)
     warmup: LightningTrainerSpec = field(default_factory=LightningTrainerSpec)
+    reuse_trainer: bool = False
+    framework: str = "lightning"
+
+    def __post_init__(self):
+        assert self.framework in {
+            "lightning",
+            "torch",
+        }, "Model training framework must be 'lightning' or 'torch'"
 
 
 class LightningModelTrainer:
@@ -336,11 +435,14 @@ class LightningModelTrainer:
         spec: Specifications for training the model
         training_loss: Loss function used for model training and evaluation
         warmup_loss: Loss function used for model warm-up.
+        setup_timer: Time spent building or resetting the Lightning trainer
+            on each call to :meth:`optimize`
     """
 
     pl_model: LightningModel
     datamodule: DataModule
     spec: TrainingSpec
+    setup_timer: TimerStat
 
     def __init__(
         self,
@@ -355,6 +457,8 @@ class LightningModelTrainer:
         self.pl_model = LightningModel(model=models, loss=loss_fn, optimizer=optimizer)
         self.datamodule = DataModule(replay, self.spec.datamodule)
         self.training_loss = self.warmup_loss = loss_fn
+        self.setup_timer = TimerStat()
+        self._trainers: Dict[bool, pl.Trainer] = {}
 
     def optimize(self, warmup: bool = False) -> Tuple[List[float], StatDict]:
         """Update models using replay buffer data.
@@ -369,14 +473,36 @@ class LightningModelTrainer:
         loss_fn = self.warmup_loss if warmup else self.training_loss
         self.pl_model.configure_losses(loss_fn)
 
-        trainer_spec = self.spec.warmup if warmup else self.spec.training
-        trainer = trainer_spec.build_trainer(check_val=warmup)
+        with self.setup_timer:
+            trainer = self.get_trainer(warmup)
 
         losses, info = self.run_training(
             model=self.pl_model, trainer=trainer, datamodule=self.datamodule
         )
+        info.update(model_setup_time_s=round(self.setup_timer.mean, 3))
         return losses, info
 
+    def get_trainer(self, warmup: bool) -> pl.Trainer:
+        """Lightning trainer ready for a new training run.
+
+        Builds a new trainer unless `reuse_trainer` is set in the spec, in which
+        case the trainer built on the first call is reset for each run.
+        """
+        trainer_spec = self.spec.warmup if warmup else self.spec.training
+        if not self.spec.reuse_trainer:
+            return trainer_spec.build_trainer(check_val=warmup)
+
+        if warmup not in self._trainers:
+            self._trainers[warmup] = trainer_spec.build_trainer(check_val=warmup)
+            return self._trainers[warmup]
+
+        trainer = self._trainers[warmup]
+        trainer.current_epoch = 0
+        trainer.global_step = 0
+        trainer.should_stop = False
+        trainer.early_stop_callback.reset()
+        return trainer
+
     @staticmethod
     @supress_stderr
     @supress_stdout
@@ -393,7 +519,9 @@ class LightningModelTrainer:
         if saved_state["module"]:
             model.load_state_dict(saved_state["module"])
         info.update(
-            model_epochs=trainer.current_epoch + 1, model_steps=trainer.global_step
+            model_epochs=trainer.current_epoch + 1,
+            model_steps=trainer.global_step,
+            model_snapshots=saved_state["snapshots"],
         )
         return losses, info
 
@@ -87,7 +87,8 @@ class MBPolicyMixin(ABC):
     def update_policy(self, times: int) -> StatDict:
         """Improve the policy on previously collected environment data.
 
-        Improves the policy on batches sampled from the replay buffer.
+        Improves the policy on batches sampled from the replay buffer, updating
+        their priorities if the buffer is prioritized.
 
         Args:
             times: number of times to call :meth:`improve_policy`
@@ -95,10 +96,9 @@ class MBPolicyMixin(ABC):
         Returns:
             A dictionary of training statistics
         """
-        for _ in range(times):
-            batch = self.replay.sample(self.config["batch_size"])
-            batch = self.lazy_tensor_dict(batch)
+        for batch in self.sample_replay_batches(times, self.config["batch_size"]):
             info = self.improve_policy(batch)
+            self.update_priorities(batch)
 
         return info
 
@@ -1,8 +1,16 @@
 """Environment model handling mixins for TorchPolicy."""
+import copy
+import time
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from dataclasses import field
+from typing import Dict
+from typing import Iterator
 from typing import List
+from typing import Optional
 from typing import Tuple
+from typing import Union
 
 import numpy as np
 import torch
@@ -10,8 +18,13 @@ from dataclasses_json import DataClassJsonMixin
 from numpy.random import Generator
 from ray.rllib import SampleBatch
 from ray.rllib.utils import PiecewiseSchedule
+from torch import Tensor
+from torch import nn
 from torch.nn import Module
 
+from raylab.policy.modules.model import BatchedSME
+from raylab.utils.replay_buffer import NumpyReplayBuffer
+
 
 @dataclass(frozen=True)
 class SamplingSpec(DataClassJsonMixin):
@@ -24,13 +37,26 @@ class SamplingSpec(DataClassJsonMixin):
             length for timestep `t` is a linear interpolation between the two
             values corresponding to the nearest endpoints. Must be passed in
             increasing order of endpoints.
+        drop_terminated: Whether to stop each rollout once it reaches a
+            terminal state. If False, terminated rollouts restart from their
+            initial state. Otherwise, finished rows are removed from the batch
+            before the next step, so that the actor and models only process
+            live rollouts.
+        rollout_interval: Number of calls to :meth:`scheduled_rollouts`
+            between model rollouts. Each rollout starts from this many times
+            the requested number of states, so that the virtual data rate is
+            unchanged while the per-step overhead is amortized over larger
+            batches.
     """
 
     num_elites: int = 1
     rollout_schedule: List[Tuple[int, float]] = field(default_factory=lambda: [(0, 1)])
+    drop_terminated: bool = False
+    rollout_interval: int = 1
 
     def __post_init__(self):
         assert self.num_elites > 0, "Must have at least one elite model to sample from"
+        assert self.rollout_interval > 0, "Rollout interval must be positive"
         assert all(
             a[0] <= b[0]
             for a, b in zip(self.rollout_schedule[:-1], self.rollout_schedule[1:])
@@ -54,14 +80,20 @@ class ModelSamplingMixin:
         model_sampling_spec: Specifications for model training and sampling
         elite_models: Sequence of the `num_elites` best models sorted by
             performance. Initially set using the policy's model order.
+        elite_idxes: Indexes of the elite models in the ensemble
         rng: Random number generator for choosing from the elite models for
             sampling.
+        rollout_active_counts: Number of live rollouts at each scheduled step
+            of the latest model rollout
     """
 
     model_sampling_spec: SamplingSpec
     rollout_schedule: PiecewiseSchedule
     elite_models: List[Module]
+    elite_idxes: np.ndarray
     rng: Generator
+    rollout_active_counts: List[int]
+    _rollout_calls: int = 0
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -79,9 +111,11 @@ class ModelSamplingMixin:
         models = self.module.models
         num_elites = self.model_sampling_spec.num_elites
         assert num_elites <= len(models), "Cannot have more elites than models"
+        self.elite_idxes = np.arange(num_elites)
         self.elite_models = list(models[:num_elites])
 
         self.rng = np.random.default_rng(self.config["seed"])
+        self.rollout_active_counts = []
 
     def set_new_elite(self, losses: List[float]):
         """Update the elite models based on model losses.
@@ -90,7 +124,29 @@ class ModelSamplingMixin:
             losses: list of model losses following the order of the ensemble
         """
         models = self.module.models
-        self.elite_models = [models[i] for i in np.argsort(losses)]
+        num_elites = self.model_sampling_spec.num_elites
+        self.elite_idxes = np.argsort(losses)[:num_elites]
+        self.elite_models = [models[i] for i in self.elite_idxes]
+
+    def scheduled_rollouts(self, num_rollouts: int) -> int:
+        """Number of rollouts to sample now to average `num_rollouts` per call.
+
+        Rollouts are batched according to the `rollout_interval` of the
+        sampling spec. The first call always samples, so that the virtual
+        data is available from the start.
+
+        Args:
+            num_rollouts: Average number of rollouts to sample per call
+
+        Returns:
+            `rollout_interval` times `num_rollouts` every `rollout_interval`
+            calls, and 0 otherwise
+        """
+        interval = self.model_sampling_spec.rollout_interval
+        self._rollout_calls += 1
+        if (self._rollout_calls - 1) % interval:
+            return 0
+        return num_rollouts * interval
 
     @torch.no_grad()
     def generate_virtual_sample_batch(self, samples: SampleBatch) -> SampleBatch:
@@ -100,7 +156,16 @@ class ModelSamplingMixin:
         information is retained.
 
         If a transition is terminal, the next transition, if any, is generated from
-        the initial state passed through `samples`.
+        the initial state passed through `samples`, unless `drop_terminated` is
+        set in the sampling spec. In that case, the rollout ends at the terminal
+        transition and the batch may hold fewer than `rollout_length` transitions
+        per initial state.
+
+        Transitions are ordered by rollout, so that consecutive transitions of a
+        rollout share observations.
+
+        Each row samples its next observation from an elite model chosen
+        uniformly at random at every step.
 
         Args:
             samples: the transitions to extract initial states from
@@ -108,33 +173,260 @@ class ModelSamplingMixin:
         Returns:
             A batch of transitions sampled from the model
         """
-        virtual_samples = []
-        obs = init_obs = self.convert_to_tensor(samples[SampleBatch.CUR_OBS])
-
+        init_obs = self.convert_to_tensor(samples[SampleBatch.CUR_OBS])
         rollout_length = round(self.rollout_schedule(self.global_timestep))
-        for _ in range(rollout_length):
-            model = self.rng.choice(self.elite_models)
-
-            action, _ = self.module.actor.sample(obs)
-            next_obs, _ = model.sample(model(obs, action))
-            reward = self.reward_fn(obs, action, next_obs)
-            done = self.termination_fn(obs, action, next_obs)
-
-            transition = {
-                SampleBatch.CUR_OBS: obs,
-                SampleBatch.ACTIONS: action,
-                SampleBatch.NEXT_OBS: next_obs,
-                SampleBatch.REWARDS: reward,
-                SampleBatch.DONES: done,
+        if self.model_sampling_spec.drop_terminated:
+            return self._generate_terminating_rollouts(init_obs, rollout_length)
+
+        # Transitions stored as (step, rollout, ...) tensors
+        buffers: Dict[str, Tensor] = {}
+        for step, transition in enumerate(self._rollout(init_obs, rollout_length)):
+            if not buffers:
+                buffers = {
+                    k: v.new_empty((rollout_length,) + v.shape)
+                    for k, v in transition.items()
+                }
+            for key, val in transition.items():
+                buffers[key][step] = val
+        self.rollout_active_counts = [len(init_obs)] * rollout_length
+
+        # Reorder from (step, rollout) to (rollout, step)
+        return SampleBatch(
+            {
+                k: v.transpose(0, 1).reshape((-1,) + v.shape[2:]).cpu().numpy()
+                for k, v in buffers.items()
             }
-            virtual_samples += [
-                SampleBatch({k: v.cpu().numpy() for k, v in transition.items()})
-            ]
-            obs = torch.where(done.unsqueeze(-1), init_obs, next_obs)
+        )
+
+    def _generate_terminating_rollouts(
+        self, init_obs: Tensor, rollout_length: int
+    ) -> SampleBatch:
+        # Transitions of live rows and their (rollout * length + step) keys
+        steps: List[Dict[str, Tensor]] = []
+        keys: List[Tensor] = []
+        for step, (rows, transition) in enumerate(
+            self._live_rollout(init_obs, rollout_length)
+        ):
+            steps += [transition]
+            keys += [rows * rollout_length + step]
+        # Rollouts that all ended early have no live rows for the remaining steps
+        self.rollout_active_counts = [len(k) for k in keys]
+        self.rollout_active_counts += [0] * (rollout_length - len(keys))
+
+        if not steps:
+            return SampleBatch({})
+        order = torch.cat(keys).argsort()
+        return SampleBatch(
+            {
+                k: torch.cat([s[k] for s in steps]).index_select(0, order).cpu().numpy()
+                for k in steps[0]
+            }
+        )
+
+    @torch.no_grad()
+    def write_virtual_samples(self, samples: SampleBatch, replay: NumpyReplayBuffer):
+        """Rollout model with latest policy directly into a replay buffer.
+
+        Equivalent to adding the output of :meth:`generate_virtual_sample_batch`
+        to the buffer, but each step is copied into its reserved slots as soon
+        as it is sampled, skipping the intermediate rollout batch. Rollouts
+        that drop terminated rows have no fixed size, so they are added as a
+        batch instead.
+
+        Args:
+            samples: the transitions to extract initial states from
+            replay: the buffer to store the sampled transitions in. Must
+                support :meth:`NumpyReplayBuffer.reserve`.
+        """
+        init_obs = self.convert_to_tensor(samples[SampleBatch.CUR_OBS])
+        rollout_length = round(self.rollout_schedule(self.global_timestep))
+        count = rollout_length * len(init_obs)
+        if not count:
+            self.rollout_active_counts = []
+            return
+        if count > replay.capacity or self.model_sampling_spec.drop_terminated:
+            replay.add(self.generate_virtual_sample_batch(samples))
+            return
+
+        # Rollout-major order: step `t` of every rollout goes to rows t::length
+        with replay.reserve(count) as reservation:
+            for step, transition in enumerate(self._rollout(init_obs, rollout_length)):
+                rows = slice(step, None, rollout_length)
+                for key, val in transition.items():
+                    reservation.write(key, rows, val)
+        self.rollout_active_counts = [len(init_obs)] * rollout_length
+
+    def _rollout(self, init_obs: Tensor, length: int) -> Iterator[Dict[str, Tensor]]:
+        """Yield each step of model rollouts starting from `init_obs`."""
+        obs = init_obs
+        for _ in range(length):
+            transition = self._model_step(obs)
+            done = transition[SampleBatch.DONES]
+            obs = torch.where(
+                done.unsqueeze(-1), init_obs, transition[SampleBatch.NEXT_OBS]
+            )
+            yield transition
 
-        return SampleBatch.concat_samples(virtual_samples)
+    def _live_rollout(
+        self, init_obs: Tensor, length: int
+    ) -> Iterator[Tuple[Tensor, Dict[str, Tensor]]]:
+        """Yield the rollout indices and transitions of unfinished rollouts."""
+        obs = init_obs
+        rows = torch.arange(len(init_obs), device=init_obs.device)
+        for _ in range(length):
+            if not len(rows):
+                break
+            transition = self._model_step(obs)
+            yield rows, transition
+            live = (~transition[SampleBatch.DONES]).nonzero(as_tuple=True)[0]
+            rows = rows.index_select(0, live)
+            obs = transition[SampleBatch.NEXT_OBS].index_select(0, live)
+
+    def _model_step(self, obs: Tensor) -> Dict[str, Tensor]:
+        action, _ = self.module.actor.sample(obs)
+        next_obs = self._sample_elite_next_obs(obs, action)
+        return {
+            SampleBatch.CUR_OBS: obs,
+            SampleBatch.ACTIONS: action,
+            SampleBatch.NEXT_OBS: next_obs,
+            SampleBatch.REWARDS: self.reward_fn(obs, action, next_obs),
+            SampleBatch.DONES: self.termination_fn(obs, action, next_obs),
+        }
+
+    def _sample_elite_next_obs(self, obs: Tensor, action: Tensor) -> Tensor:
+        """Sample next observations, each from a random elite model.
+
+        Batched ensembles evaluate all models in a single pass and gather each
+        row's sample. Otherwise, each elite model only processes the rows
+        assigned to it.
+        """
+        choices = self.elite_idxes[
+            self.rng.integers(len(self.elite_idxes), size=len(obs))
+        ]
+        models = self.module.models
+
+        if isinstance(models, BatchedSME):
+            size = [len(models)]
+            params = models.batched(
+                obs.expand(size + list(obs.shape)),
+                action.expand(size + list(action.shape)),
+            )
+            samples, _ = models.batched.sample(params)  # (N, B, O)
+            rows = torch.arange(len(obs), device=obs.device)
+            return samples[torch.as_tensor(choices, device=obs.device), rows]
+
+        next_obs = torch.empty_like(obs)
+        for idx in np.unique(choices):
+            rows = torch.as_tensor(np.flatnonzero(choices == idx), device=obs.device)
+            model = models[idx]
+            next_obs[rows], _ = model.sample(model(obs[rows], action[rows]))
+        return next_obs
+
+    def rollout_stats(self) -> Dict[str, Union[float, List[int]]]:
+        """Active row counts of the latest model rollout."""
+        counts = self.rollout_active_counts
+        # Counts span the scheduled horizon and every rollout is live at first
+        num_rollouts, rollout_length = (counts[0], len(counts)) if counts else (0, 0)
+        total = num_rollouts * rollout_length
+        return {
+            "rollout_active_counts": counts,
+            "rollout_active_fraction": sum(counts) / total if total else 0.0,
+        }
 
     @staticmethod
     def model_sampling_defaults():
         """The default configuration dict for model sampling."""
         return SamplingSpec().to_dict()
+
+
+class _RolloutSnapshot(ModelSamplingMixin):
+    """Copy of the policy components needed to sample model rollouts."""
+
+    # pylint:disable=super-init-not-called,attribute-defined-outside-init
+    def __init__(self, policy: ModelSamplingMixin, seed: Optional[int] = None):
+        self.module = nn.ModuleDict(
+            {
+                "actor": copy.deepcopy(policy.module.actor),
+                "models": copy.deepcopy(policy.module.models),
+            }
+        )
+        self.model_sampling_spec = policy.model_sampling_spec
+        self.rollout_schedule = policy.rollout_schedule
+        self.reward_fn = policy.reward_fn
+        self.termination_fn = policy.termination_fn
+        self.convert_to_tensor = policy.convert_to_tensor
+        self.rng = np.random.default_rng(seed)
+        self.rollout_active_counts = []
+        self.update(policy)
+
+    def update(self, policy: ModelSamplingMixin):
+        """Copy the policy's current parameters, elites and timestep."""
+        self.module.actor.load_state_dict(policy.module.actor.state_dict())
+        self.module.models.load_state_dict(policy.module.models.state_dict())
+        self.elite_idxes = policy.elite_idxes.copy()
+        self.elite_models = [self.module.models[i] for i in self.elite_idxes]
+        self.global_timestep = policy.global_timestep
+
+
+class AsyncModelSampler:
+    """Samples model rollouts in a background thread.
+
+    Rollouts run on a snapshot of the policy's actor, models and elites taken
+    on :meth:`submit`, so that the policy may keep training meanwhile. At most
+    one rollout is in flight: its batch is only handed over by :meth:`result`,
+    leaving the caller to add it to the virtual buffer.
+
+    Args:
+        policy: The model sampling policy to take snapshots from
+        seed: Seed for the random number generator choosing elite models in
+            the background thread
+
+    Attributes:
+        generation_time: Seconds spent sampling the latest collected rollout
+        hidden_time: Seconds of the latest collected rollout that overlapped
+            with the caller's work, i.e., that it did not wait for
+        rollout_active_counts: Number of live rollouts at each step of the
+            latest collected rollout
+    """
+
+    def __init__(self, policy: ModelSamplingMixin, seed: Optional[int] = None):
+        self._policy = policy
+        self._snapshot = _RolloutSnapshot(policy, seed=seed)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future: Optional[Future] = None
+        self.generation_time = 0.0
+        self.hidden_time = 0.0
+        self.rollout_active_counts: List[int] = []
+
+    @property
+    def pending(self) -> bool:
+        """Whether a submitted rollout has not been collected yet."""
+        return self._future is not None
+
+    def submit(self, samples: SampleBatch):
+        """Start rollouts from the initial states in `samples`."""
+        assert not self.pending, "Collect the previous rollout before submitting"
+        self._snapshot.update(self._policy)
+        self._future = self._executor.submit(self._generate, samples)
+
+    def _generate(self, samples: SampleBatch) -> Tuple[SampleBatch, float]:
+        start = time.perf_counter()
+        batch = self._snapshot.generate_virtual_sample_batch(samples)
+        return batch, time.perf_counter() - start
+
+    def result(self) -> SampleBatch:
+        """Wait for the submitted rollout and return its transitions."""
+        assert self.pending, "No rollout was submitted"
+        start = time.perf_counter()
+        batch, self.generation_time = self._future.result()
+        waited = time.perf_counter() - start
+        self._future = None
+
+        self.hidden_time = max(self.generation_time - waited, 0.0)
+        self.rollout_active_counts = self._snapshot.rollout_active_counts
+        return batch
+
+    def close(self):
+        """Wait for any rollout in flight and stop the background thread."""
+        self._executor.shutdown(wait=True)
+        self._future = None
@@ -0,0 +1,201 @@
+"""Model training with a plain PyTorch loop."""
+import statistics as stats
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import torch
+from torch import Tensor
+from torch.optim import Optimizer
+from torch.utils.data import DataLoader
+
+from raylab.policy.losses import Loss
+from raylab.policy.modules.model import SME
+from raylab.torch.utils import StateSnapshot
+from raylab.utils.replay_buffer import NumpyReplayBuffer
+from raylab.utils.types import StatDict
+
+from .lightning import DataModule
+from .lightning import LightningModelTrainer
+from .lightning import TrainingSpec
+
+
+class TorchModelTrainer:
+    """Model training behavior for TorchPolicy instances via a PyTorch loop.
+
+    Follows the same :class:`TrainingSpec` as :class:`LightningModelTrainer`,
+    without Lightning's trainer, callback and logging machinery. Early
+    stopping monitors the mean validation loss of each epoch, or the mean
+    training loss if there is no holdout data. The best model state is kept
+    in a :class:`~raylab.torch.utils.StateSnapshot`, reused across calls.
+    If there is no data to train or evaluate on, training stops and the
+    previous call's losses are reported.
+
+    Args:
+        models: Stochastic model ensemble
+        loss_fn: Loss associated with the model ensemble
+        optimizer: Optimizer associated with the model ensemble
+        replay: Experience replay buffer
+        config: Dictionary containg `model_training` and `model_warmup` dicts
+
+    Attributes:
+        models: Stochastic model ensemble
+        optimizer: Optimizer associated with the model ensemble
+        datamodule: Data module splitting the replay buffer into training and
+            validation loaders
+        spec: Specifications for training the model
+        training_loss: Loss function used for model training and evaluation
+        warmup_loss: Loss function used for model warm-up.
+    """
+
+    datamodule: DataModule
+    spec: TrainingSpec
+
+    def __init__(
+        self,
+        models: SME,
+        loss_fn: Loss,
+        optimizer: Optimizer,
+        replay: NumpyReplayBuffer,
+        config: dict,
+    ):
+        # pylint:disable=too-many-arguments
+        self.spec = TrainingSpec.from_dict(config["model_training"])
+        self.models = models
+        self.optimizer = optimizer
+        self.datamodule = DataModule(replay, self.spec.datamodule)
+        self.training_loss = self.warmup_loss = loss_fn
+        self._snapshot = StateSnapshot()
+        self._last_outputs: Optional[Tuple[List[float], StatDict]] = None
+
+    def optimize(self, warmup: bool = False) -> Tuple[List[float], StatDict]:
+        """Update models using replay buffer data.
+
+        Args:
+            warmup: Whether to train with warm-up loss and spec
+
+        Returns:
+            A tuple with a list of each model's evaluation loss and a dictionary
+            with training statistics
+        """
+        loss_fn = self.warmup_loss if warmup else self.training_loss
+        spec = self.spec.warmup if warmup else self.spec.training
+
+        self.datamodule.setup()
+        train_loader = self.datamodule.train_dataloader()
+        val_loader = self.datamodule.val_dataloader()
+
+        best_score = float("inf")
+        self._snapshot.reset()
+        outputs: Optional[Tuple[List[float], StatDict]] = None
+        wait, epochs, steps = 0, 0, 0
+        stop = False
+        for _ in range(spec.max_epochs):
+            train_outputs, steps = self._train_epoch(
+                loss_fn, train_loader, steps, spec.max_steps
+            )
+            epoch_outputs = (
+                train_outputs
+                if val_loader is None
+                else self._evaluate(loss_fn, val_loader)
+            )
+            if not epoch_outputs:
+                break
+
+            epochs += 1
+            if spec.patience is None:
+                outputs = self._mean_outputs(epoch_outputs)
+            else:
+                score = torch.stack([o[0] for o in epoch_outputs]).mean().item()
+                if score < best_score - spec.improvement_delta:
+                    best_score, wait = score, 0
+                    outputs = self._mean_outputs(epoch_outputs)
+                    self._snapshot.save(self.models.state_dict())
+                else:
+                    wait += 1
+                    stop = wait >= spec.patience
+                    outputs = outputs or self._mean_outputs(epoch_outputs)
+
+            # Further epochs would only repeat the same evaluation
+            stop = stop or not train_outputs
+            if stop or (spec.max_steps and steps >= spec.max_steps):
+                break
+
+        if self._snapshot.saved:
+            self.models.load_state_dict(self._snapshot.state)
+        if outputs is None:
+            outputs = self._last_outputs or ([float("nan")] * len(self.models), {})
+        self._last_outputs = outputs
+        losses, info = list(outputs[0]), dict(outputs[1])
+        info.update(
+            model_epochs=epochs,
+            model_steps=steps,
+            model_snapshots=self._snapshot.count,
+        )
+        return losses, info
+
+    def _train_epoch(
+        self, loss_fn: Loss, loader: DataLoader, steps: int, max_steps: Optional[int]
+    ) -> Tuple[List[Tuple[Tensor, Tensor, StatDict]], int]:
+        """Run gradient steps over the training data.
+
+        Returns:
+            The loss, per-model losses and statistics of each step and the
+            total number of gradient steps so far
+        """
+        self.models.train()
+        outputs = []
+        for batch in loader:
+            loss, _ = loss_fn(batch)
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+            outputs += [self._detached_output(loss, loss_fn)]
+            steps += 1
+            if max_steps and steps >= max_steps:
+                break
+        return outputs, steps
+
+    @torch.no_grad()
+    def _evaluate(
+        self, loss_fn: Loss, loader: DataLoader
+    ) -> List[Tuple[Tensor, Tensor, StatDict]]:
+        self.models.eval()
+        outputs = []
+        for batch in loader:
+            loss, _ = loss_fn(batch)
+            outputs += [self._detached_output(loss, loss_fn)]
+        self.models.train()
+        return outputs
+
+    @staticmethod
+    def _detached_output(
+        loss: Tensor, loss_fn: Loss
+    ) -> Tuple[Tensor, Tensor, StatDict]:
+        losses, info = loss_fn.last_output
+        return loss.detach(), losses.detach(), info
+
+    @staticmethod
+    def _mean_outputs(
+        outputs: List[Tuple[Tensor, Tensor, StatDict]]
+    ) -> Tuple[List[float], StatDict]:
+        """Average the per-model losses and statistics over an epoch."""
+        _, epoch_losses, epoch_infos = zip(*outputs)
+        model_losses = torch.stack(epoch_losses, dim=0).mean(dim=0).tolist()
+        model_infos = {k: stats.mean(i[k] for i in epoch_infos) for k in epoch_infos[0]}
+        return model_losses, model_infos
+
+
+def build_model_trainer(
+    models: SME,
+    loss_fn: Loss,
+    optimizer: Optimizer,
+    replay: NumpyReplayBuffer,
+    config: dict,
+) -> Union[LightningModelTrainer, TorchModelTrainer]:
+    """Model trainer for the framework chosen in `config['model_training']`."""
+    # pylint:disable=too-many-arguments
+    spec = TrainingSpec.from_dict(config["model_training"])
+    cls = TorchModelTrainer if spec.framework == "torch" else LightningModelTrainer
+    return cls(models, loss_fn, optimizer, replay, config)
@@ -1,10 +1,12 @@
 # pylint:disable=missing-module-docstring
 from .action_value import ActionValueCritic
+from .q_value import BatchedQValueEnsemble
 from .q_value import ClippedQValue
 from .q_value import ForkedQValueEnsemble
 from .q_value import MLPQValue
 from .q_value import QValue
 from .q_value import QValueEnsemble
+from .v_value import BatchedVValueEnsemble
 from .v_value import ClippedVValue
 from .v_value import ForkedVValueEnsemble
 from .v_value import HardValue
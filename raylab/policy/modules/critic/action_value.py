@@ -1,11 +1,13 @@
 """Network and configurations for modules with Q-value critics."""
 from dataclasses import dataclass
 from dataclasses import field
+from typing import Union
 
 import torch.nn as nn
 from dataclasses_json import DataClassJsonMixin
 from gym.spaces import Box
 
+from .q_value import BatchedQValueEnsemble
 from .q_value import ForkedQValueEnsemble
 from .q_value import MLPQValue
 from .q_value import QValueEnsemble
@@ -23,8 +25,10 @@ class ActionValueCriticSpec(DataClassJsonMixin):
             states and actions to pre-value function linear features
         double_q: Whether to create two Q-value estimators instead of one.
             Defaults to True
-        parallelize: Whether to evaluate Q-values in parallel. Defaults to
-            False.
+        parallelize: Whether to evaluate Q-values in parallel. If True, forks
+            one TorchScript task per Q-value. If 'batched', stacks their weights
+            and evaluates all of them with one batched matrix multiply per
+            layer. Defaults to False.
         initializer: Optional dictionary with mandatory `type` key corresponding
             to the initializer function name in `torch.nn.init` and optional
             keyword arguments.
@@ -32,7 +36,7 @@ class ActionValueCriticSpec(DataClassJsonMixin):
 
     encoder: QValueSpec = field(default_factory=QValueSpec)
     double_q: bool = True
-    parallelize: bool = False
+    parallelize: Union[bool, str] = False
     initializer: dict = field(default_factory=dict)
 
 
@@ -63,18 +67,23 @@ class ActionValueCritic(nn.Module):
         def make_q_value():
             return MLPQValue(obs_space, action_space, spec.encoder)
 
-        def make_q_value_ensemble():
+        def make_q_value_list():
             n_q_values = 2 if spec.double_q else 1
-            q_values = [make_q_value() for _ in range(n_q_values)]
+            return [make_q_value() for _ in range(n_q_values)]
 
+        def make_q_value_ensemble(q_values):
+            if spec.parallelize == "batched":
+                return BatchedQValueEnsemble(q_values)
             if spec.parallelize:
                 return ForkedQValueEnsemble(q_values)
             return QValueEnsemble(q_values)
 
-        q_values = make_q_value_ensemble()
-        q_values.initialize_parameters(spec.initializer)
+        q_value_list = make_q_value_list()
+        for q_value in q_value_list:
+            q_value.initialize_parameters(spec.initializer)
+        q_values = make_q_value_ensemble(q_value_list)
 
-        target_q_values = make_q_value_ensemble()
+        target_q_values = make_q_value_ensemble(make_q_value_list())
         main, target = set(q_values.parameters()), set(target_q_values.parameters())
         assert not main.intersection(
             target
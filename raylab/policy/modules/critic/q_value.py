@@ -1,7 +1,9 @@
 """Parameterized action-value estimators."""
 from abc import ABC
 from abc import abstractmethod
+from typing import Iterator
 from typing import List
+from typing import Union
 
 import torch
 import torch.nn as nn
@@ -9,6 +11,7 @@ from gym.spaces import Box
 from torch import Tensor
 
 from raylab.policy.modules.networks.mlp import StateActionMLP
+from raylab.torch.nn.utils import stack_modules
 
 
 MLPSpec = StateActionMLP.spec_cls
@@ -98,6 +101,19 @@ class QValueEnsemble(nn.ModuleList):
     def _action_values(self, obs: Tensor, act: Tensor) -> List[Tensor]:
         return [m(obs, act) for m in self]
 
+    @torch.jit.export
+    def stacked_values(self, obs: Tensor, action: Tensor) -> Tensor:
+        """Evaluate each Q estimator and stack the outputs.
+
+        Args:
+            obs: The observation tensor
+            action: The action tensor
+
+        Returns:
+            Tensor of shape `(*, N)` with the outputs of all estimators
+        """
+        return torch.stack(self(obs, action), dim=-1)
+
     def initialize_parameters(self, initializer_spec: dict):
         """Initialize each Q estimator in the ensemble.
 
@@ -126,14 +142,115 @@ class ForkedQValueEnsemble(QValueEnsemble):
         return [torch.jit.wait(f) for f in futures]
 
 
+class BatchedQValueEnsemble(nn.Module):
+    """Ensemble of Q-value estimators evaluated as a single batched network.
+
+    Stacks the parameters of `N` Q-value estimators with the same architecture,
+    so that each Linear layer evaluates every estimator with one batched matrix
+    multiply. Implements the same API as :class:`QValueEnsemble`.
+
+    Indexing and iterating yield views of single estimators, which share the
+    stacked parameters. These still evaluate the whole stack, so prefer the
+    ensemble methods where possible. Compiling with TorchScript keeps the
+    ensemble methods but not the views.
+
+    Args:
+        q_values: List of QValue modules with the same architecture. Their
+            parameters are copied
+
+    Attributes:
+        batched: QValue module mapping `(N, B) + O` observations and
+            `(N, B) + A` actions to `(N, B)` values
+    """
+
+    # pylint:disable=abstract-method
+    ensemble_size: int
+
+    def __init__(self, q_values: List[QValue]):
+        cls_name = type(self).__name__
+        assert all(
+            isinstance(q, QValue) for q in q_values
+        ), f"All modules in {cls_name} must be instances of QValue."
+        super().__init__()
+        self.ensemble_size = len(q_values)
+        self.batched = stack_modules(q_values)
+        # Plain list so that members are not registered as submodules
+        self._members = [
+            _MemberQValue(self.batched, i, self.ensemble_size)
+            for i in range(self.ensemble_size)
+        ]
+
+    @torch.jit.export
+    def __len__(self) -> int:
+        return self.ensemble_size
+
+    def __iter__(self) -> Iterator[QValue]:
+        return iter(self._members)
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[QValue, List[QValue]]:
+        return self._members[idx]
+
+    def forward(self, obs: Tensor, action: Tensor) -> List[Tensor]:
+        """Evaluate each Q estimator in the ensemble.
+
+        Args:
+            obs: The observation tensor
+            action: The action tensor
+
+        Returns:
+            List of `N` output tensors, where `N` is the ensemble size
+        """
+        # pylint:disable=arguments-differ
+        return [val for val in self.stacked_values(obs, action).unbind(-1)]
+
+    @torch.jit.export
+    def stacked_values(self, obs: Tensor, action: Tensor) -> Tensor:
+        """Evaluate all Q estimators at once.
+
+        Args:
+            obs: The observation tensor
+            action: The action tensor
+
+        Returns:
+            Tensor of shape `(*, N)` with the outputs of all estimators
+        """
+        batch_shape = obs.shape[:-1]
+        size = self.ensemble_size
+        obs = obs.reshape(1, -1, obs.shape[-1]).expand(size, -1, -1)
+        action = action.reshape(1, -1, action.shape[-1]).expand(size, -1, -1)
+        values = self.batched(obs, action)  # (N, B)
+        return values.t().reshape(list(batch_shape) + [size])
+
+    @staticmethod
+    def clipped(outputs: List[Tensor]) -> Tensor:
+        """Returns the minimum Q-value of an ensemble's outputs."""
+        return QValueEnsemble.clipped(outputs)
+
+
+class _MemberQValue(QValue):
+    """Single Q-value estimator in a batched ensemble."""
+
+    def __init__(self, stacked: QValue, index: int, ensemble_size: int):
+        super().__init__()
+        self.stacked = stacked
+        self.index = index
+        self.ensemble_size = ensemble_size
+
+    def forward(self, obs: Tensor, action: Tensor) -> Tensor:
+        batch_shape = obs.shape[:-1]
+        size = self.ensemble_size
+        obs = obs.reshape(1, -1, obs.shape[-1]).expand(size, -1, -1)
+        action = action.reshape(1, -1, action.shape[-1]).expand(size, -1, -1)
+        return self.stacked(obs, action)[self.index].reshape(batch_shape)
+
+
 class ClippedQValue(QValue):
     """Q-value computed as the minimum among Q-values in an ensemble."""
 
-    def __init__(self, q_values: QValueEnsemble):
+    def __init__(self, q_values: Union[QValueEnsemble, BatchedQValueEnsemble]):
         super().__init__()
         self.q_values = q_values
 
     def forward(self, obs, act):  # pylint:disable=arguments-differ
-        values = self.q_values(obs, act)
-        mininum, _ = torch.stack(values, dim=0).min(dim=0)
+        mininum, _ = self.q_values.stacked_values(obs, act).min(dim=-1)
         return mininum
@@ -1,6 +1,7 @@
 # pylint:disable=missing-module-docstring
 from abc import ABC
 from abc import abstractmethod
+from typing import Iterator
 from typing import List
 from typing import Union
 
@@ -15,7 +16,9 @@ from raylab.policy.modules.actor import Alpha
 from raylab.policy.modules.actor import DeterministicPolicy
 from raylab.policy.modules.actor import StochasticPolicy
 from raylab.policy.modules.networks.mlp import StateMLP
+from raylab.torch.nn.utils import stack_modules
 
+from .q_value import BatchedQValueEnsemble
 from .q_value import ClippedQValue
 from .q_value import QValue
 from .q_value import QValueEnsemble
@@ -93,6 +96,18 @@ class VValueEnsemble(nn.ModuleList):
     def _state_values(self, obs: Tensor) -> List[Tensor]:
         return [m(obs) for m in self]
 
+    @torch.jit.export
+    def stacked_values(self, obs: Tensor) -> Tensor:
+        """Evaluate each V estimator and stack the outputs.
+
+        Args:
+            obs: The observation tensor
+
+        Returns:
+            Tensor of shape `(*, N)` with the outputs of all estimators
+        """
+        return torch.stack(self(obs), dim=-1)
+
     @staticmethod
     def clipped(outputs: List[Tensor]) -> Tensor:
         """Returns the minimum V-value of an ensemble's outputs."""
@@ -110,18 +125,114 @@ class ForkedVValueEnsemble(VValueEnsemble):
         return [wait(f) for f in futures]
 
 
+class BatchedVValueEnsemble(nn.Module):
+    """Ensemble of V-value estimators evaluated as a single batched network.
+
+    Stacks the parameters of `N` V-value estimators with the same architecture,
+    so that each Linear layer evaluates every estimator with one batched matrix
+    multiply. Implements the same API as :class:`VValueEnsemble`. Estimators
+    with layer normalization are not supported.
+
+    Indexing and iterating yield views of single estimators, which share the
+    stacked parameters. These still evaluate the whole stack, so prefer the
+    ensemble methods where possible.
+
+    Args:
+        v_values: List of VValue modules with the same architecture. Their
+            parameters are copied
+
+    Attributes:
+        batched: VValue module mapping `(N, B) + O` observations to `(N, B)`
+            values
+    """
+
+    # pylint:disable=abstract-method
+    ensemble_size: int
+
+    def __init__(self, v_values: List[VValue]):
+        cls_name = type(self).__name__
+        assert all(
+            isinstance(v, VValue) for v in v_values
+        ), f"All modules in {cls_name} must be instances of VValue."
+        super().__init__()
+        self.ensemble_size = len(v_values)
+        self.batched = stack_modules(v_values)
+        # Plain list so that members are not registered as submodules
+        self._members = [
+            _MemberVValue(self.batched, i, self.ensemble_size)
+            for i in range(self.ensemble_size)
+        ]
+
+    @torch.jit.export
+    def __len__(self) -> int:
+        return self.ensemble_size
+
+    def __iter__(self) -> Iterator[VValue]:
+        return iter(self._members)
+
+    def __getitem__(self, idx: Union[int, slice]) -> Union[VValue, List[VValue]]:
+        return self._members[idx]
+
+    def forward(self, obs: Tensor) -> List[Tensor]:
+        """Evaluate each V estimator in the ensemble.
+
+        Args:
+            obs: The observation tensor
+
+        Returns:
+            List of `N` output tensors, where `N` is the ensemble size
+        """
+        # pylint:disable=arguments-differ
+        return [val for val in self.stacked_values(obs).unbind(-1)]
+
+    @torch.jit.export
+    def stacked_values(self, obs: Tensor) -> Tensor:
+        """Evaluate all V estimators at once.
+
+        Args:
+            obs: The observation tensor
+
+        Returns:
+            Tensor of shape `(*, N)` with the outputs of all estimators
+        """
+        batch_shape = obs.shape[:-1]
+        size = self.ensemble_size
+        values = self.batched(obs.reshape(1, -1, obs.shape[-1]).expand(size, -1, -1))
+        return values.t().reshape(list(batch_shape) + [size])
+
+    @staticmethod
+    def clipped(outputs: List[Tensor]) -> Tensor:
+        """Returns the minimum V-value of an ensemble's outputs."""
+        return VValueEnsemble.clipped(outputs)
+
+
+class _MemberVValue(VValue):
+    """Single V-value estimator in a batched ensemble."""
+
+    def __init__(self, stacked: VValue, index: int, ensemble_size: int):
+        super().__init__()
+        self.stacked = stacked
+        self.index = index
+        self.ensemble_size = ensemble_size
+
+    def forward(self, obs: Tensor) -> Tensor:
+        batch_shape = obs.shape[:-1]
+        obs = obs.reshape(1, -1, obs.shape[-1]).expand(self.ensemble_size, -1, -1)
+        return self.stacked(obs)[self.index].reshape(batch_shape)
+
+
 class SoftValue(VValue):
     """V-value computed from stochastic policy, Q-value, and entropy bonus."""
 
     def __init__(
         self,
         policy: StochasticPolicy,
-        q_value: Union[QValue, QValueEnsemble],
+        q_value: Union[QValue, QValueEnsemble, BatchedQValueEnsemble],
         alpha: Alpha,
         deterministic: bool = False,
     ):
         super().__init__()
-        if isinstance(q_value, QValueEnsemble):
+        if isinstance(q_value, (QValueEnsemble, BatchedQValueEnsemble)):
             # Treat everything as if single value
             q_value = ClippedQValue(q_value)
         self.q_value = q_value
@@ -147,12 +258,14 @@ class HardValue(VValue):
     """V-value computed from deterministic policy and Q-value."""
 
     def __init__(
-        self, policy: DeterministicPolicy, q_value: Union[QValue, QValueEnsemble]
+        self,
+        policy: DeterministicPolicy,
+        q_value: Union[QValue, QValueEnsemble, BatchedQValueEnsemble],
     ):
         super().__init__()
         self.policy = policy
 
-        if isinstance(q_value, QValueEnsemble):
+        if isinstance(q_value, (QValueEnsemble, BatchedQValueEnsemble)):
             # Treat everything as if single value
             q_value = ClippedQValue(q_value)
         self.q_value = q_value
@@ -164,11 +277,10 @@ class HardValue(VValue):
 class ClippedVValue(VValue):
     """Minimum of an ensemble of state-value functions."""
 
-    def __init__(self, v_values: VValueEnsemble):
+    def __init__(self, v_values: Union[VValueEnsemble, BatchedVValueEnsemble]):
         super().__init__()
         self.v_values = v_values
 
     def forward(self, obs: Tensor) -> Tensor:
-        values = self.v_values(obs)
-        minimum, _ = torch.stack(values, dim=0).min(dim=0)
+        minimum, _ = self.v_values.stacked_values(obs).min(dim=-1)
         return minimum
@@ -3,6 +3,7 @@ from .builders import build as build_single
 from .builders import build_ensemble
 from .builders import EnsembleSpec
 from .builders import Spec as SingleSpec
+from .ensemble import BatchedSME
 from .ensemble import ForkedSME
 from .ensemble import SME
 from .single import MLPModel
@@ -1,10 +1,12 @@
 """Constructors for stochastic dynamics models."""
 from dataclasses import dataclass
 from dataclasses import field
+from typing import Union
 
 from dataclasses_json import DataClassJsonMixin
 from gym.spaces import Box
 
+from .ensemble import BatchedSME
 from .ensemble import ForkedSME
 from .ensemble import SME
 from .single import MLPModel
@@ -62,14 +64,18 @@ class EnsembleSpec(Spec):
             keyword arguments. Used to initialize the models' Linear layers.
         ensemble_size: Number of models in the collection.
         parallelize: Whether to use an ensemble with parallelized `sample`,
-            `rsample`, and `log_prob` methods
+            `rsample`, and `log_prob` methods. If True, forks one TorchScript
+            task per model. If 'batched', stacks the models' weights and
+            evaluates all of them with one batched matrix multiply per layer.
     """
 
     ensemble_size: int = 1
-    parallelize: bool = False
+    parallelize: Union[bool, str] = False
 
 
-def build_ensemble(obs_space: Box, action_space: Box, spec: EnsembleSpec) -> SME:
+def build_ensemble(
+    obs_space: Box, action_space: Box, spec: EnsembleSpec
+) -> Union[SME, BatchedSME]:
     """Construct stochastic dynamics model ensemble.
 
     Args:
@@ -81,6 +87,9 @@ def build_ensemble(obs_space: Box, action_space: Box, spec: EnsembleSpec) -> SME
         A stochastic dynamics model ensemble
     """
     models = [build(obs_space, action_space, spec) for _ in range(spec.ensemble_size)]
-    cls = ForkedSME if spec.parallelize else SME
+    if spec.parallelize == "batched":
+        cls = BatchedSME
+    else:
+        cls = ForkedSME if spec.parallelize else SME
     ensemble = cls(models)
     return ensemble
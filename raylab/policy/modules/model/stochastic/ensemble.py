@@ -1,6 +1,9 @@
 """Network and configurations for modules with stochastic model ensembles."""
+from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Tuple
+from typing import Union
 
 import torch
 import torch.nn as nn
@@ -8,8 +11,10 @@ from torch import Tensor
 from torch.jit import fork
 from torch.jit import wait
 
+from raylab.torch.nn.utils import stack_modules
 from raylab.utils.types import TensorDict
 
+from .single import ResidualStochasticModel
 from .single import StochasticModel
 
 SampleLogp = Tuple[Tensor, Tensor]
@@ -120,3 +125,150 @@ class ForkedSME(SME):
     def deterministic(self, params: List[TensorDict]) -> List[SampleLogp]:
         futures = [fork(m.deterministic, params[i]) for i, m in enumerate(self)]
         return [wait(f) for f in futures]
+
+
+class BatchedSME(nn.Module):
+    """Stochastic Model Ensemble evaluated as a single batched network.
+
+    Stacks the parameters of `N` models with the same architecture, so that
+    each layer runs every model with one batched matrix multiply instead of
+    one module call per model. Implements the same API as :class:`SME`.
+
+    Indexing and iterating yield views of single models, which share the
+    stacked parameters and implement the StochasticModel API. These still
+    evaluate the whole stack, so prefer the ensemble methods where possible.
+    Compiling with TorchScript keeps the ensemble methods but not the views.
+
+    Args:
+        models: List of StochasticModel modules with the same architecture.
+            Their parameters are copied
+
+    Attributes:
+        batched: StochasticModel mapping `(N, B) + O` observations and
+            `(N, B) + A` actions to stacked distribution parameters
+    """
+
+    # pylint:disable=abstract-method
+    ensemble_size: int
+
+    def __init__(self, models: List[StochasticModel]):
+        cls_name = type(self).__name__
+        assert all(
+            isinstance(m, StochasticModel) for m in models
+        ), f"All modules in {cls_name} must be instances of StochasticModel."
+        super().__init__()
+        self.ensemble_size = len(models)
+        self.residual = isinstance(models[0], ResidualStochasticModel)
+
+        params = stack_modules([m.params for m in models])
+        batched = StochasticModel(params, models[0].dist)
+        self.batched = ResidualStochasticModel(batched) if self.residual else batched
+        # Plain list so that members are not registered as submodules
+        self._members = [self._member(i) for i in range(self.ensemble_size)]
+
+    def _member(self, index: int) -> StochasticModel:
+        params = _MemberParams(self.batched.params, index, self.ensemble_size)
+        member = StochasticModel(params, self.batched.dist)
+        return ResidualStochasticModel(member) if self.residual else member
+
+    @torch.jit.export
+    def __len__(self) -> int:
+        return self.ensemble_size
+
+    def __iter__(self) -> Iterator[StochasticModel]:
+        return iter(self._members)
+
+    def __getitem__(
+        self, idx: Union[int, slice]
+    ) -> Union[StochasticModel, List[StochasticModel]]:
+        return self._members[idx]
+
+    def forward(self, obs: List[Tensor], act: List[Tensor]) -> List[TensorDict]:
+        # pylint:disable=arguments-differ
+        obs_, act_ = torch.stack(obs), torch.stack(act)
+        batch_shape = obs_.shape[:-1]
+        params = self.batched(
+            obs_.reshape(self.ensemble_size, -1, obs_.shape[-1]),
+            act_.reshape(self.ensemble_size, -1, act_.shape[-1]),
+        )
+        for key, val in params.items():
+            params[key] = val.reshape(list(batch_shape) + [val.shape[-1]])
+        return self.unbind_params(params)
+
+    @torch.jit.export
+    def sample(self, params: List[TensorDict]) -> List[SampleLogp]:
+        """Compute samples and likelihoods for each model in the ensemble.
+
+        Uses the same semantics as :meth:`SME.sample`.
+        """
+        sample, logp = self.batched.sample(self.stack_params(params))
+        return list(zip(sample.unbind(0), logp.unbind(0)))
+
+    @torch.jit.export
+    def rsample(self, params: List[TensorDict]) -> List[SampleLogp]:
+        """Compute reparameterized samples and likelihoods for each model.
+
+        Uses the same semantics as :meth:`SME.sample`.
+        """
+        sample, logp = self.batched.rsample(self.stack_params(params))
+        return list(zip(sample.unbind(0), logp.unbind(0)))
+
+    @torch.jit.export
+    def log_prob(self, new_obs: List[Tensor], params: List[TensorDict]) -> List[Tensor]:
+        """Compute likelihoods for each model in the ensemble.
+
+        Uses the same semantics as :meth:`SME.log_prob`.
+        """
+        logp = self.batched.log_prob(torch.stack(new_obs), self.stack_params(params))
+        return [val for val in logp.unbind(0)]
+
+    @torch.jit.export
+    def deterministic(self, params: List[TensorDict]) -> List[SampleLogp]:
+        """Compute deterministic new observations and their likelihoods for each model.
+
+        Uses the same semantics as :meth:`SME.sample`.
+        """
+        sample, logp = self.batched.deterministic(self.stack_params(params))
+        return list(zip(sample.unbind(0), logp.unbind(0)))
+
+    @torch.jit.export
+    def stack_params(self, params: List[TensorDict]) -> TensorDict:
+        """Stack the distribution parameters of each model along a new dimension."""
+        # pylint:disable=no-self-use
+        stacked: Dict[str, Tensor] = {}
+        for key in params[0].keys():
+            stacked[key] = torch.stack([p[key] for p in params])
+        return stacked
+
+    @torch.jit.export
+    def unbind_params(self, params: TensorDict) -> List[TensorDict]:
+        """Split stacked distribution parameters into one dict per model."""
+        unbound: List[Dict[str, Tensor]] = []
+        for idx in range(self.ensemble_size):
+            single: Dict[str, Tensor] = {}
+            for key, val in params.items():
+                single[key] = val[idx]
+            unbound.append(single)
+        return unbound
+
+
+class _MemberParams(nn.Module):
+    """Distribution parameters of a single model in a batched ensemble."""
+
+    # pylint:disable=abstract-method
+    def __init__(self, stacked: nn.Module, index: int, ensemble_size: int):
+        super().__init__()
+        self.stacked = stacked
+        self.index = index
+        self.ensemble_size = ensemble_size
+
+    def forward(self, obs: Tensor, act: Tensor) -> TensorDict:
+        # pylint:disable=arguments-differ
+        batch_shape = obs.shape[:-1]
+        obs_ = obs.reshape(1, -1, obs.shape[-1]).expand(self.ensemble_size, -1, -1)
+        act_ = act.reshape(1, -1, act.shape[-1]).expand(self.ensemble_size, -1, -1)
+        params = self.stacked(obs_, act_)
+        return {
+            key: val[self.index].reshape(list(batch_shape) + [val.shape[-1]])
+            for key, val in params.items()
+        }
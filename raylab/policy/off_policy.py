@@ -1,7 +1,9 @@
 # pylint:disable=missing-module-docstring
+import uuid
 from abc import ABC
 from abc import abstractmethod
 from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import Optional
 from typing import Tuple
@@ -10,9 +12,18 @@ from typing import Union
 from ray.rllib import SampleBatch
 from ray.rllib.evaluation.episode import MultiAgentEpisode
 from ray.rllib.utils.typing import TensorType
+from torch import Tensor
 
 from raylab.options import option
+from raylab.utils.replay_buffer import ArrayStorage
+from raylab.utils.replay_buffer import CompactReplayBuffer
+from raylab.utils.replay_buffer import MemmapStorage
 from raylab.utils.replay_buffer import NumpyReplayBuffer
+from raylab.utils.replay_buffer import PrioritizedCompactReplayBuffer
+from raylab.utils.replay_buffer import PrioritizedReplayBuffer
+from raylab.utils.replay_buffer import ReplayPrefetcher
+from raylab.utils.replay_buffer import SharedReplayBuffer
+from raylab.utils.replay_buffer import TorchReplayBuffer
 from raylab.utils.types import TensorDict
 
 from .stats import learner_stats
@@ -47,7 +58,123 @@ def off_policy_options(cls: type) -> type:
         help="Size of replay buffer batches sampled on each call to `improve_policy`.",
     )
 
-    options = [buffer_size, std_obs, improvement_steps, batch_size]
+    replay = option(
+        "replay/",
+        help="""Replay buffer storage and sampling configurations.""",
+    )
+    storage = option(
+        "replay/storage",
+        default="memory",
+        help="""Storage backend for the replay buffer fields.
+
+        'memory' allocates regular arrays in RAM.
+
+        'memmap' stores each field in a memory-mapped `.npy` file under
+        'replay/directory', so that the buffer may grow up to disk size.
+
+        'torch' preallocates tensors on the policy's device and samples
+        minibatches directly as tensors. Not compatible with
+        'replay/prioritized' or 'replay/compact_obs'.
+
+        'shared' allocates the buffer in shared memory, with one segment for
+        each rollout worker. Workers on the same node write their samples
+        directly to the buffer. Not compatible with 'replay/prioritized',
+        'replay/compact_obs', 'std_obs' or the trainer's 'replay_checkpoint'.
+        """,
+    )
+    name = option(
+        "replay/name",
+        default=None,
+        help="""Name of the shared memory blocks for the 'shared' storage backend.
+
+        Must be the same for all workers. If None, uses a random name, which
+        only allows a single process.
+        """,
+    )
+    directory = option(
+        "replay/directory",
+        default=None,
+        help="""Directory for the 'memmap' storage backend.
+
+        Field files found in this directory are reopened. Saving the buffer
+        to this directory only writes the small state needed to interpret
+        them, allowing a run to restore the buffer contents of a previous one
+        from the same directory. If None, uses a new temporary directory,
+        removed along with the replay buffer.
+        """,
+    )
+
+    prioritized = option(
+        "replay/prioritized",
+        default=False,
+        help="""Whether to sample transitions proportionally to their TD errors.
+
+        Requires the policy to report per-sample TD errors via `td_error`.
+        """,
+    )
+    alpha = option(
+        "replay/alpha",
+        default=0.6,
+        help="How much prioritization is used (0 for uniform sampling).",
+    )
+    beta = option(
+        "replay/beta",
+        default=0.4,
+        help="Importance sampling correction exponent (1 for full correction).",
+    )
+    compact_obs = option(
+        "replay/compact_obs",
+        default=False,
+        help="""Whether to store each observation only once in the replay buffer.
+
+        Next observations are rebuilt from the current observation of the
+        following transition, except at episode boundaries. Roughly halves the
+        memory used by observations when episodes are long.
+        """,
+    )
+
+    dtypes = option(
+        "replay/dtypes",
+        default=None,
+        help="""Reduced-precision storage types for the replay buffer fields.
+
+        Mapping from field names (e.g., 'obs', 'new_obs', 'actions') to NumPy
+        dtype names such as 'float16'. Values are cast back to their original
+        type when sampled. The 'dones' field may use 'bits' to store one bit
+        per transition, except with the 'torch' or 'shared' storage backends.
+        If None, stores every field with its original type.
+        """,
+    )
+
+    prefetch = option(
+        "replay/prefetch",
+        default=0,
+        help="""Number of minibatches to prepare in a background thread.
+
+        Overlaps sampling and tensor conversion with policy updates. Batches
+        holding transitions overwritten by new samples are discarded. Only
+        the learner prefetches, with as many transitions per batch as the
+        policy samples from this buffer at once. Not compatible with
+        'replay/prioritized' or 'std_obs'. 0 disables prefetching.
+        """,
+    )
+
+    options = [
+        buffer_size,
+        std_obs,
+        improvement_steps,
+        batch_size,
+        replay,
+        storage,
+        name,
+        directory,
+        prioritized,
+        alpha,
+        beta,
+        compact_obs,
+        dtypes,
+        prefetch,
+    ]
     for opt in options:
         cls = opt(cls)
 
@@ -58,18 +185,105 @@ class OffPolicyMixin(ABC):
     """Adds a replay buffer and standard procedures for `learn_on_batch`."""
 
     replay: NumpyReplayBuffer
+    prefetcher: Optional[ReplayPrefetcher] = None
 
     def build_replay_buffer(self):
         """Construct the experience replay buffer.
 
         Should be called by subclasses on init.
         """
-        self.replay = NumpyReplayBuffer(
-            self.observation_space, self.action_space, self.config["buffer_size"]
-        )
+        config = self.config["replay"]
+        args = (self.observation_space, self.action_space, self.config["buffer_size"])
+        if config["storage"] == "torch":
+            if config["prioritized"] or config["compact_obs"]:
+                raise ValueError(
+                    "'replay/storage': torch does not support 'replay/prioritized'"
+                    " or 'replay/compact_obs'"
+                )
+            self.replay = TorchReplayBuffer(
+                *args, device=self.device, dtypes=config["dtypes"]
+            )
+        elif config["storage"] == "shared":
+            if config["prioritized"] or config["compact_obs"] or self.config["std_obs"]:
+                raise ValueError(
+                    "'replay/storage': shared does not support 'replay/prioritized',"
+                    " 'replay/compact_obs' or 'std_obs'"
+                )
+            # With rollout workers, the learner only samples from the buffer
+            num_workers, index = self.config["num_workers"], self.config["worker_index"]
+            self.replay = SharedReplayBuffer(
+                *args,
+                name=config["name"] or "raylab-replay-" + uuid.uuid4().hex[:8],
+                num_writers=max(num_workers, 1),
+                writer=index - 1 if index else (None if num_workers else 0),
+                owner=index == 0,
+                dtypes=config["dtypes"],
+            )
+        elif config["prioritized"]:
+            storage = self.build_replay_storage()
+            cls = (
+                PrioritizedCompactReplayBuffer
+                if config["compact_obs"]
+                else PrioritizedReplayBuffer
+            )
+            self.replay = cls(
+                *args,
+                storage=storage,
+                dtypes=config["dtypes"],
+                alpha=config["alpha"],
+                beta=config["beta"],
+            )
+        else:
+            cls = CompactReplayBuffer if config["compact_obs"] else NumpyReplayBuffer
+            self.replay = cls(
+                *args, storage=self.build_replay_storage(), dtypes=config["dtypes"]
+            )
         self.replay.seed(self.config["seed"])
         self.replay.compute_stats = self.config["std_obs"]
 
+        batch_size = self.replay_batch_size()
+        if config["prefetch"] and batch_size and self.config["worker_index"] == 0:
+            if config["prioritized"] or self.config["std_obs"]:
+                # Normalizing observations would discard the queue on every add
+                raise ValueError(
+                    "'replay/prefetch' is not compatible with 'replay/prioritized'"
+                    " or 'std_obs'"
+                )
+            self.prefetcher = ReplayPrefetcher(
+                self.replay,
+                batch_size=batch_size,
+                convert=lambda b: {k: self.convert_to_tensor(v) for k, v in b.items()},
+                capacity=config["prefetch"],
+                seed=self.config["seed"],
+            )
+
+    def replay_batch_size(self) -> int:
+        """Number of transitions in each minibatch sampled from the replay buffer.
+
+        Sets the size of prefetched minibatches.
+        """
+        return self.config["batch_size"]
+
+    def close(self):
+        """Stop the replay prefetcher's thread, if any."""
+        if self.prefetcher:
+            self.prefetcher.close()
+            self.prefetcher = None
+
+    def build_replay_storage(self) -> ArrayStorage:
+        """Construct the storage backend for the replay buffer fields."""
+        config = self.config["replay"]
+        if config["storage"] == "memory":
+            return ArrayStorage()
+        if config["storage"] == "memmap":
+            return MemmapStorage(config["directory"])
+
+        storage = config["storage"]
+        raise ValueError(
+            "Invalid config for 'replay/storage': {}."
+            " Choose between 'memory', 'memmap', 'torch' and 'shared'".format(storage)
+        )
+
     @learner_stats
     def learn_on_batch(self, samples: SampleBatch):
         """Run one logical iteration of training.
@@ -82,21 +296,69 @@ class OffPolicyMixin(ABC):
         info = {}
         info.update(self.get_exploration_info())
 
-        for _ in range(int(self.config["improvement_steps"])):
-            batch = self.replay.sample(self.config["batch_size"])
-            batch = self.lazy_tensor_dict(batch)
+        num_batches = int(self.config["improvement_steps"])
+        for batch in self.sample_replay_batches(num_batches, self.config["batch_size"]):
             info.update(self.improve_policy(batch))
+            self.update_priorities(batch)
 
         return info
 
+    def sample_replay_batches(
+        self, num_batches: int, batch_size: int
+    ) -> Iterable[TensorDict]:
+        """Sample minibatches of tensors for consecutive policy improvement steps.
+
+        Takes batches from the prefetcher if one is enabled with the same batch
+        size. Otherwise, uses the replay buffer's bulk sampling, so that the
+        indexes for all minibatches are drawn and gathered at once.
+        Tensor-resident buffers already return tensors on the policy's device,
+        which are passed along as is.
+        """
+        if self.prefetcher and self.prefetcher.batch_size == batch_size:
+            return (self.prefetcher.get() for _ in range(num_batches))
+
+        batches = self.replay.sample_many(num_batches, batch_size)
+        if isinstance(self.replay, TorchReplayBuffer):
+            return batches
+        return [self.lazy_tensor_dict(b) for b in batches]
+
     def add_to_buffer(self, samples: SampleBatch):
         """Add sample batch to replay buffer"""
-        self.replay.add(samples)
+        if self.prefetcher:
+            self.prefetcher.add(samples)
+        else:
+            self.replay.add(samples)
 
     @abstractmethod
     def improve_policy(self, batch: TensorDict) -> dict:
         """Run one step of Policy Improvement."""
 
+    def td_error(self) -> Optional[Tensor]:
+        """Per-sample TD errors from the last call to :meth:`improve_policy`.
+
+        Used to update the priorities of sampled transitions if the replay
+        buffer is prioritized. Returns None by default, which leaves the
+        priorities unchanged.
+        """
+        # pylint:disable=no-self-use
+        return None
+
+    def update_priorities(self, batch: TensorDict):
+        """Update the replay priorities of the transitions in the batch.
+
+        The batch may be the leading part of the minibatch passed to
+        :meth:`improve_policy`, e.g., if the latter was extended with samples
+        from other sources. TD errors of the remaining samples are ignored.
+        """
+        if not isinstance(self.replay, PrioritizedReplayBuffer):
+            return
+
+        td_error = self.td_error()
+        if td_error is not None:
+            idxes = batch[PrioritizedReplayBuffer.IDXES].cpu().numpy()
+            td_error = td_error[: len(idxes)]
+            self.replay.update_priorities(idxes, td_error.cpu().numpy())
+
     def compute_actions(
         self,
         obs_batch: Union[List[TensorType], TensorType],
@@ -141,6 +403,20 @@ class OffPolicyMixin(ABC):
             prev_reward_batch=prev_reward_batch,
         )
 
+    def save_replay(self, directory: str):
+        """Write the replay buffer's contents and statistics to a directory."""
+        self.replay.save(directory)
+
+    def restore_replay(self, directory: str):
+        """Read the replay buffer's contents and statistics from a directory.
+
+        The statistics replace those loaded with the policy's weights, which
+        may describe a different set of transitions.
+        """
+        self.replay.restore(directory)
+        if self.prefetcher:
+            self.prefetcher.clear()
+
     def get_weights(self) -> dict:
         state = super().get_weights()
         state["replay"] = self.replay.state_dict()
@@ -148,6 +424,8 @@ class OffPolicyMixin(ABC):
 
     def set_weights(self, weights: dict):
         self.replay.load_state_dict(weights["replay"])
+        if self.prefetcher:
+            self.prefetcher.clear()
         super().set_weights({k: v for k, v in weights.items() if k != "replay"})
 
     @staticmethod
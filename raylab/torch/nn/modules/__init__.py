@@ -13,6 +13,7 @@ from .lambd import Lambda
 from .leaf_parameter import LeafParameter
 from .linear import MaskedLinear
 from .linear import NormalizedLinear
+from .linear import StackedLinear
 from .tanh_squash import TanhSquash
 from .tril_matrix import TrilMatrix
 
@@ -29,6 +30,7 @@ __all__ = [
     "NormalizedLinear",
     "MADE",
     "MaskedLinear",
+    "StackedLinear",
     "StateActionEncoder",
     "StdNormalParams",
     "TanhSquash",
@@ -1,4 +1,6 @@
 """Customized Linear modules."""
+from typing import List
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -43,3 +45,35 @@ class NormalizedLinear(nn.Module):
         return torch.where(
             norms / self.linear.out_features > self.beta, normalized, vec
         )
+
+
+class StackedLinear(nn.Module):
+    """Independent Linear modules evaluated with a single batched matmul.
+
+    Holds the weights and biases of `N` Linear modules stacked in tensors of
+    shape `(N, in_features, out_features)` and `(N, 1, out_features)`. Inputs
+    must have shape `(N, *, in_features)`, with each slice along the first
+    dimension fed to the corresponding module.
+
+    Args:
+        linears: Linear modules with the same input and output sizes. Their
+            parameters are copied
+    """
+
+    __constants__ = {"in_features", "out_features"}
+
+    def __init__(self, linears: List[nn.Linear]):
+        super().__init__()
+        assert all(l.bias is not None for l in linears), "Linears must have biases"
+        self.in_features = linears[0].in_features
+        self.out_features = linears[0].out_features
+        weight = torch.stack([l.weight.detach().t() for l in linears])
+        bias = torch.stack([l.bias.detach() for l in linears]).unsqueeze(1)
+        self.weight = nn.Parameter(weight)
+        self.bias = nn.Parameter(bias)
+
+    @override(nn.Module)
+    def forward(self, inputs):  # pylint:disable=arguments-differ
+        flat = inputs.reshape(inputs.shape[0], -1, self.in_features)
+        outputs = torch.baddbmm(self.bias, flat, self.weight)
+        return outputs.reshape(list(inputs.shape[:-1]) + [self.out_features])
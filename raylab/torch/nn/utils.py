@@ -1,13 +1,18 @@
 """Utilities for manipulating neural network modules."""
+import copy
+from typing import List
+
 import torch
 import torch.nn as nn
 
+from .modules.linear import StackedLinear
 from .modules.utils import get_activation
 
 __all__ = [
     "get_activation",
     "update_polyak",
     "perturb_params",
+    "stack_modules",
 ]
 
 
@@ -44,3 +49,41 @@ def perturb_params(target: nn.Module, origin: nn.Module, stddev: float):
 
     for param in to_perturb:
         param.data.add_(torch.randn_like(param) * stddev)
+
+
+def stack_modules(modules: List[nn.Module]) -> nn.Module:
+    """Merge modules with the same architecture into a single batched module.
+
+    Linear submodules are replaced by :class:`StackedLinear`. Other parameters
+    and buffers are stacked into tensors of shape `(N, 1) + original_shape`,
+    so that they broadcast against features of shape `(N, B, ...)`. Layer
+    normalization is not supported.
+
+    Args:
+        modules: `N` modules with the same structure. Their parameters are
+            copied
+
+    Returns:
+        A copy of the first module with stacked parameters, which expects
+        inputs of shape `(N, B, ...)` and applies each module to its slice of
+        the inputs
+    """
+    first = modules[0]
+    if isinstance(first, nn.Linear):
+        return StackedLinear(modules)
+    if isinstance(first, nn.LayerNorm):
+        raise ValueError("Cannot stack LayerNorm modules")
+
+    stacked = copy.deepcopy(first)
+    for name, _ in first.named_children():
+        setattr(stacked, name, stack_modules([getattr(m, name) for m in modules]))
+
+    def stack(name: str) -> torch.Tensor:
+        return torch.stack([getattr(m, name).detach() for m in modules]).unsqueeze(1)
+
+    for name, _ in first.named_parameters(recurse=False):
+        setattr(stacked, name, nn.Parameter(stack(name)))
+    for name, buffer in first.named_buffers(recurse=False):
+        if buffer is not None:
+            stacked.register_buffer(name, stack(name))
+    return stacked
@@ -1,6 +1,8 @@
 """PyTorch related utilities."""
 from typing import Dict
 from typing import Iterator
+from typing import List
+from typing import Optional
 from typing import Union
 
 import numpy as np
@@ -57,3 +59,59 @@ class TensorDictDataset(torch.utils.data.Dataset):
 
     def __len__(self) -> int:
         return next(iter(self.tensor_dict.values())).size(0)
+
+
+class StateSnapshot:
+    """Copy of a state dict kept in preallocated tensors.
+
+    Shadow tensors are allocated on the first save and overwritten in place on
+    subsequent saves, avoiding a full allocation of the state each time, as
+    with :func:`copy.deepcopy`.
+
+    Attributes:
+        state: Dictionary of shadow tensors. None if nothing was ever saved.
+        count: Number of saves since the last reset
+    """
+
+    def __init__(self):
+        self.state: Optional[Dict[str, Tensor]] = None
+        self.count = 0
+
+    @property
+    def saved(self) -> bool:
+        """Whether a state was saved since the last reset."""
+        return self.count > 0
+
+    @torch.no_grad()
+    def save(self, state: Dict[str, Tensor]):
+        """Copy tensors from a state dict into the snapshot."""
+        if self.state is None or not self._matches(state):
+            self.state = {k: v.detach().clone() for k, v in state.items()}
+        else:
+            copy_tensors_(list(self.state.values()), list(state.values()))
+        self.count += 1
+
+    def reset(self):
+        """Forget the saved state, keeping the shadow tensors for reuse."""
+        self.count = 0
+
+    def _matches(self, state: Dict[str, Tensor]) -> bool:
+        return self.state.keys() == state.keys() and all(
+            shadow.shape == state[k].shape
+            and shadow.dtype == state[k].dtype
+            and shadow.device == state[k].device
+            for k, shadow in self.state.items()
+        )
+
+
+def copy_tensors_(dst: List[Tensor], src: List[Tensor]):
+    """Copy each source tensor into the corresponding destination in place.
+
+    Uses a single fused :func:`torch._foreach_copy_` call if available,
+    falling back to a loop over :meth:`Tensor.copy_`.
+    """
+    if hasattr(torch, "_foreach_copy_"):
+        torch._foreach_copy_(dst, src)  # pylint:disable=protected-access
+    else:
+        for dst_, src_ in zip(dst, src):
+            dst_.copy_(src_)
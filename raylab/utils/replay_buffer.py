@@ -1,22 +1,417 @@
 """Custom Replay Buffers based on RLlibs's implementation."""
+import bisect
+import os
+import pickle
+import tempfile
+import threading
+import weakref
+from collections import deque
+import dataclasses
 from dataclasses import dataclass
+from typing import Callable
 from typing import Dict
+from typing import List
 from typing import Optional
 from typing import Tuple
 from typing import Union
 
 import numpy as np
+import torch
 from gym.spaces import Space
 from ray.rllib import SampleBatch
+from torch import Tensor
+
+from raylab.utils.segment_tree import MinSegmentTree
+from raylab.utils.segment_tree import SumSegmentTree
+from raylab.utils.types import TensorDict
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:  # Python < 3.8
+    SharedMemory = None
 
 
 @dataclass
 class ReplayField:
-    """Storage specification for ReplayBuffer data."""
+    """Storage specification for ReplayBuffer data.
+
+    Attributes:
+        name: Key of the field in sample batches
+        shape: Shape of a single item
+        dtype: Type of the values returned by the replay buffer
+        storage_dtype: Type of the stored values if different from `dtype`,
+            e.g., `float16` to halve the memory used by observations. Values
+            are cast back to `dtype` when queried. Use `PACKED_BITS` to store
+            boolean fields with one bit per item.
+    """
 
     name: str
     shape: tuple = ()
     dtype: np.dtype = np.float32
+    storage_dtype: Optional[Union[np.dtype, str]] = None
+
+
+PACKED_BITS = "bits"
+
+
+class PackedBits:
+    """One-dimensional boolean array stored with one bit per item.
+
+    Supports getting and setting items by integer, slice or index array.
+
+    Args:
+        data: Byte array with room for `size` bits
+        size: Number of items
+    """
+
+    dtype = np.dtype(bool)
+
+    def __init__(self, data: np.ndarray, size: int):
+        assert len(data) * 8 >= size, "Not enough bytes for the given size"
+        self.data = data
+        self.shape = (size,)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def _idxes(self, index: Union[int, np.ndarray, slice]) -> np.ndarray:
+        if isinstance(index, slice):
+            return np.arange(*index.indices(len(self)))
+        return np.asarray(index) % len(self)
+
+    def __getitem__(self, index: Union[int, np.ndarray, slice]) -> np.ndarray:
+        idxes = self._idxes(index)
+        return ((self.data[idxes >> 3] >> (idxes & 7)) & 1).astype(bool)
+
+    def __setitem__(self, index: Union[int, np.ndarray, slice], values: np.ndarray):
+        idxes = np.atleast_1d(self._idxes(index))
+        values = np.broadcast_to(np.asarray(values, dtype=np.uint8), idxes.shape)
+        byte, bit = idxes >> 3, (idxes & 7).astype(np.uint8)
+        np.bitwise_and.at(self.data, byte, ~(np.uint8(1) << bit))
+        np.bitwise_or.at(self.data, byte, values << bit)
+
+
+class RunningStats:
+    """Streaming mean and variance of arrays along the batch dimension.
+
+    Batches are merged and removed using Chan et al.'s parallel update of the
+    count, mean and sum of squared deviations, in O(batch) time.
+
+    Args:
+        shape: Shape of a single item
+    """
+
+    def __init__(self, shape: tuple):
+        self.count = 0
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+
+    @staticmethod
+    def _moments(arr: np.ndarray) -> Tuple[int, np.ndarray, np.ndarray]:
+        arr = np.asarray(arr, dtype=np.float64)
+        mean = np.mean(arr, axis=0)
+        return len(arr), mean, np.sum((arr - mean) ** 2, axis=0)
+
+    def push(self, arr: np.ndarray):
+        """Include a batch of items in the statistics."""
+        if len(arr) == 0:
+            return
+        count_b, mean_b, m2_b = self._moments(arr)
+        count = self.count + count_b
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta * count_b / count
+        self.m2 = self.m2 + m2_b + delta ** 2 * self.count * count_b / count
+        self.count = count
+
+    def pop(self, arr: np.ndarray):
+        """Exclude a batch of previously pushed items from the statistics."""
+        if len(arr) == 0:
+            return
+        count_b, mean_b, m2_b = self._moments(arr)
+        count = self.count - count_b
+        if count <= 0:
+            self.reset()
+            return
+        mean = (self.count * self.mean - count_b * mean_b) / count
+        delta = mean_b - mean
+        self.m2 = np.maximum(
+            self.m2 - m2_b - delta ** 2 * count * count_b / self.count, 0.0
+        )
+        self.mean = mean
+        self.count = count
+
+    def reset(self):
+        """Discard all pushed items."""
+        self.count = 0
+        self.mean = np.zeros_like(self.mean)
+        self.m2 = np.zeros_like(self.m2)
+
+    @property
+    def std(self) -> np.ndarray:
+        """Population standard deviation of the pushed items."""
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def state_dict(self) -> dict:
+        # pylint:disable=missing-function-docstring
+        return {"count": self.count, "mean": self.mean.copy(), "m2": self.m2.copy()}
+
+    def load_state_dict(self, state: dict):
+        # pylint:disable=missing-function-docstring
+        self.count = state["count"]
+        self.mean = state["mean"].copy()
+        self.m2 = state["m2"].copy()
+
+
+class ArrayStorage:
+    """Allocates in-memory arrays for replay buffer fields.
+
+    Attributes:
+        persistent: Whether the allocated arrays outlive the process, in which
+            case saving the buffer to the storage's directory only writes the
+            state needed to interpret them
+    """
+
+    persistent: bool = False
+
+    def allocate(self, field: ReplayField, size: int) -> np.ndarray:
+        """Returns an array with room for `size` items of `field`."""
+        # pylint:disable=no-self-use
+        return np.empty((size,) + field.shape, dtype=field.dtype)
+
+
+class MemmapStorage(ArrayStorage):
+    """Allocates memory-mapped arrays for replay buffer fields.
+
+    Each field is stored in a `<name>.npy` file under `directory`. Existing
+    files with the expected shape and dtype are reopened instead of
+    overwritten, so that a buffer saved to `directory` with
+    :meth:`NumpyReplayBuffer.save` can be restored by pointing to the same
+    directory.
+
+    Args:
+        directory: Path to the directory holding the field files. Created if
+            it does not exist. If None, uses a temporary directory which is
+            removed along with its files once this storage is garbage
+            collected. Such storage is not persistent.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.persistent = directory is not None
+        if directory is None:
+            self._tmpdir = tempfile.TemporaryDirectory(prefix="replay-")
+            directory = self._tmpdir.name
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def allocate(self, field: ReplayField, size: int) -> np.ndarray:
+        path = os.path.join(self.directory, f"{field.name}.npy")
+        shape = (size,) + field.shape
+        dtype = np.dtype(field.dtype)
+
+        if os.path.exists(path):
+            arr = np.load(path, mmap_mode="r+")
+            if arr.shape == shape and arr.dtype == dtype:
+                return arr
+            del arr
+
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+
+class SharedMemoryStorage(ArrayStorage):
+    """Allocates arrays in named shared memory blocks.
+
+    Each field is stored in a block named `<name>-<field name>`. The first
+    process to allocate a field creates its block, while others attach to it,
+    so that every process allocating the same fields under the same name sees
+    the same arrays. Blocks are zero-initialized on creation.
+
+    Args:
+        name: Prefix for the names of the shared memory blocks
+        owner: Whether to remove the blocks once this storage is garbage
+            collected. Other processes may keep using blocks already attached.
+    """
+
+    def __init__(self, name: str, owner: bool = False):
+        assert SharedMemory is not None, "Shared memory storage requires Python 3.8+"
+        self.name = name
+        self.owner = owner
+        self._blocks = []
+        weakref.finalize(self, self._release, self._blocks, owner)
+
+    def allocate(self, field: ReplayField, size: int) -> np.ndarray:
+        shape = (size,) + field.shape
+        dtype = np.dtype(field.dtype)
+        nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        name = f"{self.name}-{field.name}"
+        try:
+            block = SharedMemory(name=name, create=True, size=nbytes)
+        except FileExistsError:
+            block = SharedMemory(name=name)
+        if not self.owner:
+            # Only the owner's process should remove the block when it exits
+            # pylint:disable=protected-access
+            resource_tracker.unregister(block._name, "shared_memory")
+        self._blocks.append(block)
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    @staticmethod
+    def _release(blocks: list, unlink: bool):
+        for block in blocks:
+            block.close()
+            if unlink:
+                try:
+                    block.unlink()
+                except FileNotFoundError:
+                    pass
+
+
+class TensorStorage:
+    """Allocates preallocated tensors for replay buffer fields.
+
+    Double precision fields are stored as single precision floats, matching
+    the conversion done by :meth:`raylab.policy.TorchPolicy.convert_to_tensor`.
+
+    Args:
+        device: Device on which to allocate the tensors
+    """
+
+    persistent: bool = False
+
+    def __init__(self, device: Union[str, torch.device] = "cpu"):
+        self.device = torch.device(device)
+
+    def allocate(self, field: ReplayField, size: int) -> Tensor:
+        # pylint:disable=missing-function-docstring
+        dtype = self.torch_dtype(field.dtype)
+        return torch.empty((size,) + field.shape, dtype=dtype, device=self.device)
+
+    @staticmethod
+    def torch_dtype(dtype: np.dtype) -> torch.dtype:
+        """Tensor type used to store values of a NumPy type."""
+        dtype = torch.as_tensor(np.empty(0, dtype=dtype)).dtype
+        return torch.float32 if dtype == torch.float64 else dtype
+
+
+def _copy_to_slots(
+    arr: Union[np.ndarray, Tensor, PackedBits],
+    index: slice,
+    values: Union[np.ndarray, Tensor],
+):
+    """Copy values into a slice of a storage array without intermediate arrays."""
+    if torch.is_tensor(arr):
+        arr[index].copy_(torch.as_tensor(values))
+    elif torch.is_tensor(values) and isinstance(arr, np.ndarray):
+        torch.from_numpy(arr[index]).copy_(values)
+    else:
+        arr[index] = values.cpu().numpy() if torch.is_tensor(values) else values
+
+
+class ReplayReservation:
+    """Writable views of consecutive slots reserved in a replay buffer.
+
+    Obtained from :meth:`NumpyReplayBuffer.reserve`. Rows are numbered in
+    insertion order and map to storage slots, which may wrap around the end
+    of the buffer. Every field of every row should be written before calling
+    :meth:`commit`, which adds the transitions to the buffer. When used as a
+    context manager, commits on exit unless an exception was raised.
+
+    Until committed, the reserved slots still count as holding the
+    transitions being overwritten, which may be sampled mid-write.
+
+    Args:
+        replay: The buffer holding the reserved slots
+        start: Position of the first row in the ring of slots
+        count: Number of reserved rows
+        base: Storage slot where the ring of slots begins
+        size: Number of slots in the ring. Defaults to the buffer's size
+
+    Attributes:
+        scratch: Arrays indexed by row for fields without storage slots,
+            which the buffer processes on commit
+    """
+
+    # pylint:disable=protected-access,too-many-arguments
+    def __init__(
+        self,
+        replay: "NumpyReplayBuffer",
+        start: int,
+        count: int,
+        base: int = 0,
+        size: Optional[int] = None,
+    ):
+        self.replay = replay
+        self.count = count
+        self.scratch: Dict[str, np.ndarray] = {}
+        self._done = False
+        size = replay._maxsize if size is None else size
+        # First row and storage slots of each contiguous segment
+        head = min(count, size - start)
+        self._segments = [(0, slice(base + start, base + start + head))]
+        if head < count:
+            self._segments.append((head, slice(base, base + count - head)))
+
+    def __enter__(self) -> "ReplayReservation":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.cancel()
+
+    def views(self, name: str) -> List[Union[np.ndarray, Tensor]]:
+        """Contiguous writable views of a field's reserved slots, in row order.
+
+        Not available for fields packed as bits.
+        """
+        arr, segments = self._target(name)
+        assert not isinstance(arr, PackedBits), "Use `write` for packed fields"
+        return [arr[slots] for _, slots in segments]
+
+    def write(self, name: str, rows: slice, values: Union[np.ndarray, Tensor]):
+        """Copy values into some of the reserved rows of a field.
+
+        Tensors are copied straight into storage, converting their dtype and
+        device as needed.
+
+        Args:
+            name: The field name
+            rows: The rows to write, as a slice with positive step
+            values: Array or tensor with the values of each row
+        """
+        arr, segments = self._target(name)
+        rows = range(self.count)[rows]
+        assert rows.step > 0, "Rows must be written in increasing order"
+        for first, slots in segments:
+            end = first + slots.stop - slots.start
+            lo, hi = bisect.bisect_left(rows, first), bisect.bisect_left(rows, end)
+            if lo < hi:
+                start = slots.start + rows[lo] - first
+                index = slice(start, start + (hi - lo - 1) * rows.step + 1, rows.step)
+                _copy_to_slots(arr, index, values[lo:hi])
+
+    def _target(self, name: str) -> Tuple[np.ndarray, List[Tuple[int, slice]]]:
+        """Array holding a field's rows and its contiguous segments."""
+        if name in self.scratch:
+            segments = [
+                (first, slice(first, first + s.stop - s.start))
+                for first, s in self._segments
+            ]
+            return self.scratch[name], segments
+        return self.replay._storage[name], self._segments
+
+    def commit(self):
+        """Add the transitions in the reserved slots to the buffer."""
+        assert not self._done, "Reservation already finished"
+        self._done = True
+        self.replay._commit_reservation(self.count)
+
+    def cancel(self):
+        """Release the reserved slots, keeping whatever was written to them."""
+        assert not self._done, "Reservation already finished"
+        self._done = True
+        self.replay._cancel_reservation()
 
 
 class NumpyReplayBuffer:
@@ -29,20 +424,40 @@ class NumpyReplayBuffer:
         action_space: action space
         size: max number of transitions to store in the buffer.
             When the bufferoverflows the old memories are dropped.
+        storage: Allocator for the field arrays. Defaults to in-memory
+            arrays
+        dtypes: Mapping from the names of default fields to their storage
+            dtypes. See :class:`ReplayField`.
+        track_episodes: Whether to keep the start and end offsets of each
+            transition's episode, needed to sample contiguous sequences
 
     Attributes:
         fields (:obj:`tuple` of :obj:`ReplayField`): storage fields
             specification
         compute_stats: Whether to track mean and stddev for normalizing
-            observations
+            observations. The statistics are only updated while this is on,
+            and rebuilt from the stored observations when it is turned on.
+
+    Episodes are delimited by the `dones` field and, if present in added
+    sample batches, by changes in `eps_id`.
     """
 
-    # pylint:disable=too-many-instance-attributes
-    compute_stats: bool = False
+    # pylint:disable=too-many-instance-attributes,too-many-public-methods
+    MASK: str = "mask"
 
-    def __init__(self, obs_space: Space, action_space: Space, size: int):
+    def __init__(
+        self,
+        obs_space: Space,
+        action_space: Space,
+        size: int,
+        storage: Optional[ArrayStorage] = None,
+        dtypes: Optional[Dict[str, Union[np.dtype, str]]] = None,
+        track_episodes: bool = False,
+    ):
+        # pylint:disable=too-many-arguments
         self._maxsize = size
-        self.fields = (
+        self._allocator = storage or ArrayStorage()
+        fields = (
             ReplayField(
                 SampleBatch.CUR_OBS, shape=obs_space.shape, dtype=obs_space.dtype
             ),
@@ -55,16 +470,46 @@ class NumpyReplayBuffer:
             ),
             ReplayField(SampleBatch.DONES, shape=(), dtype=np.bool),
         )
+        dtypes = dtypes or {}
+        self.fields = tuple(
+            dataclasses.replace(f, storage_dtype=dtypes.get(f.name)) for f in fields
+        )
         self._storage = {}
+        self._dtypes = {}
         self._build_buffers(*self.fields)
         self._next_idx = 0
         self._curr_size = 0
         self._rng = np.random.default_rng()
         self._obs_stats: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._running_obs_stats = RunningStats(obs_space.shape)
+        self._compute_stats = False
+        self._save_directory: Optional[str] = None
+        self._unsaved = 0
+        self._episode_index = self._build_episode_index() if track_episodes else {}
+        self._total = 0
+        self._open_start: Optional[int] = None
+        self._last_eps_id = None
 
     def __len__(self) -> int:
         return self._curr_size
 
+    @property
+    def capacity(self) -> int:
+        """Maximum number of transitions stored."""
+        return self._maxsize
+
+    @property
+    def compute_stats(self) -> bool:
+        # pylint:disable=missing-function-docstring
+        return self._compute_stats
+
+    @compute_stats.setter
+    def compute_stats(self, value: bool):
+        if value and not self._compute_stats:
+            self._rebuild_running_obs_stats()
+            self._obs_stats = None
+        self._compute_stats = value
+
     def add_fields(self, *fields: ReplayField):
         """Add fields to the replay buffer and build the corresponding storage."""
         new_names = {f.name for f in fields}
@@ -77,19 +522,93 @@ class NumpyReplayBuffer:
         self._build_buffers(*fields)
 
     def _build_buffers(self, *fields: ReplayField):
-        storage = self._storage
-        size = self._maxsize
         for field in fields:
-            storage[field.name] = np.empty((size,) + field.shape, dtype=field.dtype)
+            self._dtypes[field.name] = np.dtype(field.dtype)
+            self._storage[field.name] = self._allocate(field)
+
+    def _allocate(self, field: ReplayField) -> np.ndarray:
+        size = self._maxsize
+        if field.storage_dtype is None:
+            return self._allocator.allocate(field, size)
+        if field.storage_dtype == PACKED_BITS:
+            assert field.shape == (), "Only scalar fields can be packed as bits"
+            data = self._allocator.allocate(
+                ReplayField(field.name, dtype=np.uint8), (size + 7) // 8
+            )
+            return PackedBits(data, size)
+        return self._allocator.allocate(
+            ReplayField(field.name, field.shape, field.storage_dtype), size
+        )
+
+    def _build_episode_index(self) -> Dict[str, np.ndarray]:
+        """Arrays with the episode start and end offsets of each slot.
+
+        Offsets count transitions added since the buffer was created. The end
+        offset of the latest episode is -1 while it is still open.
+        """
+        # Offsets are always kept in host memory
+        allocator = self._allocator
+        if not isinstance(allocator, ArrayStorage):
+            allocator = ArrayStorage()
+        return {
+            name: allocator.allocate(ReplayField(name, dtype=np.int64), self._maxsize)
+            for name in ("episode_start", "episode_end")
+        }
+
+    def _field(self, name: str) -> ReplayField:
+        (field,) = (f for f in self.fields if f.name == name)
+        return field
 
     def __getitem__(
         self, index: Union[int, np.ndarray, slice]
     ) -> Dict[str, np.ndarray]:
-        batch = {f.name: self._storage[f.name][index] for f in self.fields}
+        batch = self._gather(index)
         for key in SampleBatch.CUR_OBS, SampleBatch.NEXT_OBS:
             batch[key] = self.normalize(batch[key])
         return batch
 
+    def _gather(self, index: Union[int, np.ndarray, slice]) -> Dict[str, np.ndarray]:
+        """Returns the unnormalized field values at the given index."""
+        return {
+            name: self._upcast(name, arr[index]) for name, arr in self._storage.items()
+        }
+
+    def _upcast(self, name: str, values: np.ndarray) -> np.ndarray:
+        """Cast stored values back to their field's dtype."""
+        dtype = self._dtypes[name]
+        return values if values.dtype == dtype else values.astype(dtype)
+
+    def gather_into(self, idxes: np.ndarray, out: Dict[str, np.ndarray]):
+        """Write the transitions at the given indexes into existing arrays.
+
+        Same as :meth:`__getitem__`, but avoids allocating the output arrays.
+
+        Args:
+            idxes: Storage indexes
+            out: Mapping from field names to arrays of shape
+                `idxes.shape + field.shape`, which may be views of a larger
+                array
+        """
+        self._gather_into(idxes, out)
+        if not self.compute_stats:
+            return
+
+        if not self._obs_stats:
+            self.update_obs_stats()
+        mean, std = self._obs_stats
+        for key in SampleBatch.CUR_OBS, SampleBatch.NEXT_OBS:
+            out[key] -= mean
+            out[key] /= std
+
+    def _gather_into(self, idxes: np.ndarray, out: Dict[str, np.ndarray]):
+        """Write the unnormalized field values into existing arrays."""
+        for name, dst in out.items():
+            arr = self._storage[name]
+            if isinstance(arr, np.ndarray) and arr.dtype == dst.dtype:
+                np.take(arr, idxes, axis=0, out=dst, mode="clip")
+            else:
+                dst[...] = arr[idxes]
+
     def normalize(self, obs: np.ndarray) -> np.ndarray:
         """Normalize observation using the stored mean and stddev."""
         obs = np.asarray(obs)
@@ -106,16 +625,20 @@ class NumpyReplayBuffer:
         """Compute mean and standard deviation for observation normalization.
 
         Subsequent batches sampled from this buffer will use these statistics to
-        normalize the current and next observation fields.
+        normalize the current and next observation fields. If `compute_stats`
+        is on, the statistics are kept up to date on each :meth:`add`, so this
+        does not scan the buffer.
         """
-        if len(self) == 0:
+        if not self.compute_stats:
+            self._rebuild_running_obs_stats()
+        running = self._running_obs_stats
+        if running.count == 0:
             self._obs_stats = (0, 1)
         else:
-            cur_obs = self._storage[SampleBatch.CUR_OBS][: len(self)]
-            mean = np.mean(cur_obs, axis=0)
-            std = np.std(cur_obs, axis=0)
+            dtype = self._field(SampleBatch.CUR_OBS).dtype
+            std = running.std
             std[std < 1e-12] = 1.0
-            self._obs_stats = (mean, std)
+            self._obs_stats = (running.mean.astype(dtype), std.astype(dtype))
 
     def seed(self, seed: int = None):
         """Seed the random number generator for sampling minibatches."""
@@ -129,9 +652,11 @@ class NumpyReplayBuffer:
         Args:
             samples: The sample batch
         """
+        self._update_running_obs_stats(samples)
+        self._update_episode_index(samples)
         if samples.count >= self._maxsize:
             samples = samples.slice(samples.count - self._maxsize, None)
-            end_idx = 0
+            self._next_idx = 0
             assign = [(slice(0, self._maxsize), samples)]
         else:
             start_idx = self._next_idx
@@ -145,18 +670,235 @@ class NumpyReplayBuffer:
             else:
                 assign = [(slice(start_idx, end_idx), samples)]
 
-        for field in self.fields:
+        for name, arr in self._storage.items():
             for slc, smp in assign:
-                self._storage[field.name][slc] = smp[field.name]
+                arr[slc] = smp[name]
 
-        self._next_idx = end_idx
-        self._curr_size = min(self._curr_size + samples.count, self._maxsize)
+        self._advance(samples.count)
+
+    def _advance(self, count: int):
+        """Account for `count` transitions written from the next slot on."""
+        self._next_idx = (self._next_idx + count) % self._maxsize
+        self._curr_size = min(self._curr_size + count, self._maxsize)
+        self._unsaved = min(self._unsaved + count, self._maxsize)
         self._obs_stats = None
 
+    def reserve(self, count: int) -> ReplayReservation:
+        """Reserve the next `count` slots to write transitions in place.
+
+        Avoids building and copying a SampleBatch when the transitions are
+        produced step by step, e.g., by model rollouts. The transitions are
+        only added to the buffer once the reservation is committed, and no
+        other transitions should be added in the meantime.
+
+        Args:
+            count: Number of transitions to write. At most the buffer's
+                capacity
+
+        Returns:
+            Writable views of the reserved slots
+        """
+        assert 0 < count <= self._maxsize, "Can only reserve up to capacity"
+        if self.compute_stats:
+            self._pop_overwritten_obs(count)
+        start = 0 if count == self._maxsize else self._next_idx
+        return ReplayReservation(self, start, count)
+
+    def _commit_reservation(self, count: int):
+        if count == self._maxsize:
+            self._next_idx = 0
+        idxes = self._insertion_idxes(count)
+        if self.compute_stats:
+            self._running_obs_stats.push(self._stored(SampleBatch.CUR_OBS, idxes))
+        if self._episode_index:
+            names = [SampleBatch.DONES, SampleBatch.EPS_ID]
+            written = {k: self._stored(k, idxes) for k in names if k in self._storage}
+            self._update_episode_index(SampleBatch(written))
+        self._advance(count)
+
+    def _cancel_reservation(self):
+        # Reserved slots may hold any mix of old and new observations
+        if self.compute_stats:
+            self._rebuild_running_obs_stats()
+
+    def _insertion_idxes(self, count: int) -> np.ndarray:
+        """Storage indexes overwritten by adding `count` transitions."""
+        if count >= self._maxsize:
+            return np.arange(self._maxsize)
+        return (self._next_idx + np.arange(count)) % self._maxsize
+
+    def _update_running_obs_stats(self, samples: SampleBatch):
+        """Replace the statistics of overwritten observations with new ones.
+
+        Must be called before writing the samples to storage.
+        """
+        if not self.compute_stats:
+            return
+
+        obs = samples[SampleBatch.CUR_OBS][-self._maxsize :]
+        self._pop_overwritten_obs(len(obs))
+        # Track the values as stored, so that popping them cancels out exactly
+        storage_dtype = self._field(SampleBatch.CUR_OBS).storage_dtype
+        self._running_obs_stats.push(
+            obs if storage_dtype is None else obs.astype(storage_dtype)
+        )
+
+    def _pop_overwritten_obs(self, count: int):
+        """Remove observations about to be overwritten from the statistics."""
+        running = self._running_obs_stats
+        if count >= self._maxsize:
+            running.reset()
+        else:
+            idxes = self._insertion_idxes(count)
+            idxes = idxes[idxes < len(self)]
+            running.pop(self._stored(SampleBatch.CUR_OBS, idxes))
+
+    def _rebuild_running_obs_stats(self):
+        """Recompute the statistics from all stored observations."""
+        running = self._running_obs_stats
+        running.reset()
+        running.push(self._stored(SampleBatch.CUR_OBS, np.arange(len(self))))
+
+    def _stored(self, name: str, idxes: np.ndarray) -> np.ndarray:
+        """Current values of a field in storage at the given indexes."""
+        return self._storage[name][idxes]
+
+    def _update_episode_index(self, samples: SampleBatch):
+        """Record the episode offsets of new transitions.
+
+        Must be called before writing the samples to storage.
+        """
+        # pylint:disable=too-many-locals
+        if not self._episode_index or not samples.count:
+            return
+
+        count = samples.count
+        dones = np.asarray(samples[SampleBatch.DONES], dtype=bool)
+        new = np.empty(count, dtype=bool)
+        new[0] = self._open_start is None
+        new[1:] = dones[:-1]
+        if SampleBatch.EPS_ID in samples:
+            eps_id = np.asarray(samples[SampleBatch.EPS_ID])
+            new[0] |= eps_id[0] != self._last_eps_id
+            new[1:] |= eps_id[1:] != eps_id[:-1]
+            self._last_eps_id = eps_id[-1]
+        else:
+            self._last_eps_id = None
+
+        times = self._total + np.arange(count)
+        starts = np.where(new, times, -1)
+        starts[0] = times[0] if new[0] else self._open_start
+        starts = np.maximum.accumulate(starts)
+
+        closed = np.append(new[1:], dones[-1])
+        ends = np.where(closed, times + 1, np.iinfo(np.int64).max)
+        ends = np.minimum.accumulate(ends[::-1])[::-1]
+        ends[ends == np.iinfo(np.int64).max] = -1
+
+        if self._open_start is not None and count < self._maxsize:
+            end = self._total if new[0] else ends[0]
+            if end >= 0:
+                self._close_open_episode(end)
+
+        kept = min(count, self._maxsize)
+        idxes = self._insertion_idxes(kept)
+        self._episode_index["episode_start"][idxes] = starts[-kept:]
+        self._episode_index["episode_end"][idxes] = ends[-kept:]
+        self._open_start = None if dones[-1] else int(starts[-1])
+        self._total += count
+
+    def _close_open_episode(self, end: int):
+        """Set the end offset of stored transitions from the open episode."""
+        first = max(self._open_start, self._total - len(self))
+        if first < self._total:
+            slots = self._slots(np.arange(first, self._total))
+            self._episode_index["episode_end"][slots] = end
+            # These slots may precede the ones about to be written
+            self._unsaved = max(self._unsaved, self._total - first)
+
+    def _slots(self, offsets: np.ndarray) -> np.ndarray:
+        """Storage slots of transitions given their offsets."""
+        return (self._next_idx + offsets - self._total) % self._maxsize
+
+    def _check_track_episodes(self):
+        if not self._episode_index:
+            raise ValueError(
+                f"{type(self).__name__} does not track episodes. Create it with"
+                " `track_episodes=True` to sample sequences"
+            )
+
+    def episode_bounds(self, idxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Positions of transitions within their stored episodes.
+
+        Episodes are clipped to the transitions still in the buffer.
+
+        Args:
+            idxes: Storage indexes of the transitions
+
+        Returns:
+            The number of stored transitions preceding each one in its episode
+            and the number of transitions from each one to the end of its
+            episode, inclusive
+
+        Raises:
+            ValueError: If the buffer does not track episodes
+        """
+        self._check_track_episodes()
+        offsets = self._total - 1 - (self._next_idx - 1 - idxes) % self._maxsize
+        starts = self._episode_index["episode_start"][idxes]
+        ends = self._episode_index["episode_end"][idxes]
+        starts = np.maximum(starts, self._total - len(self))
+        ends = np.where(ends < 0, self._total, ends)
+        return offsets - starts, ends - offsets
+
+    def sample_sequences(self, batch_size: int, horizon: int) -> Dict[str, np.ndarray]:
+        """Windows of consecutive transitions from the same episode.
+
+        The first transition of each window is sampled uniformly with
+        replacement, regardless of priorities. Windows are cut short at the end
+        of their episode and padded by repeating their last transition.
+
+        Args:
+            batch_size: Number of windows
+            horizon: Maximum number of transitions in each window
+
+        Returns:
+            A dict of `(batch_size, horizon, ...)` arrays for each field and a
+            boolean `(batch_size, horizon)` array under `MASK` which is False
+            for padding
+
+        Raises:
+            ValueError: If the buffer does not track episodes
+        """
+        self._check_track_episodes()
+        first = self._rng.integers(self._curr_size, size=batch_size)
+        _, remaining = self.episode_bounds(first)
+        steps = np.arange(horizon)
+        mask = steps < remaining[:, None]
+        steps = np.minimum(steps, remaining[:, None] - 1)
+        idxes = (first[:, None] + steps) % self._maxsize
+
+        batch = self[idxes]
+        batch[self.MASK] = mask
+        return batch
+
     def sample(self, batch_size: int) -> SampleBatch:
         """Transition batch uniformly sampled with replacement."""
         return SampleBatch(self[self.sample_idxes(batch_size)])
 
+    def sample_many(self, num_batches: int, batch_size: int) -> List[SampleBatch]:
+        """Several transition batches uniformly sampled with replacement.
+
+        Draws the indexes for all batches at once and gathers them as a single
+        block, which is then split into views. Cheaper than calling
+        :meth:`sample` `num_batches` times.
+        """
+        block = self[self.sample_idxes(num_batches * batch_size)]
+        return [
+            SampleBatch({k: v[i : i + batch_size] for k, v in block.items()})
+            for i in range(0, num_batches * batch_size, batch_size)
+        ]
+
     def sample_idxes(self, batch_size: int) -> np.ndarray:
         """Get random transition indexes uniformly sampled with replacement."""
         return self._rng.integers(self._curr_size, size=batch_size)
@@ -166,7 +908,1090 @@ class NumpyReplayBuffer:
         return SampleBatch(self[: len(self)])
 
     def state_dict(self) -> dict:
-        return {"obs_stats": self._obs_stats}
+        """Returns the buffer's state.
+
+        Only includes statistics, not the state of the buffer's contents,
+        which is saved by :meth:`save`.
+        """
+        return {
+            "obs_stats": self._obs_stats,
+            "running_obs_stats": self._running_obs_stats.state_dict(),
+        }
 
     def load_state_dict(self, state: dict):
+        """Restore the buffer's state."""
         self._obs_stats = state["obs_stats"]
+        if "running_obs_stats" in state:
+            self._running_obs_stats.load_state_dict(state["running_obs_stats"])
+
+    def contents_state_dict(self) -> dict:
+        """Returns the state needed to interpret the field arrays.
+
+        Includes the insertion cursor and the offsets of the open episode.
+        """
+        return {
+            "cursor": (self._next_idx, self._curr_size),
+            "episodes": (self._total, self._open_start, self._last_eps_id),
+        }
+
+    def load_contents_state_dict(self, state: dict):
+        """Restore the state needed to interpret the field arrays."""
+        if "cursor" in state:
+            self._next_idx, self._curr_size = state["cursor"]
+        if "episodes" in state:
+            self._total, self._open_start, self._last_eps_id = state["episodes"]
+
+    def save(self, directory: str):
+        """Write the buffer's contents to a directory.
+
+        Each array indexed by storage slot is saved as a raw `<name>.npy` file,
+        along with a small pickle of :meth:`contents_state_dict` and
+        :meth:`state_dict`, so that the statistics are always restored with the
+        transitions they describe. If the buffer was last saved to or restored
+        from the same directory, only the ring segment written since then is
+        updated in place. If the directory is the one holding the buffer's
+        memory-mapped arrays, these are only flushed to disk.
+
+        Args:
+            directory: Path to the directory. Created if it does not exist
+        """
+        os.makedirs(directory, exist_ok=True)
+        contents_path = os.path.join(directory, "contents.pkl")
+        incremental = directory == self._save_directory and os.path.exists(
+            contents_path
+        )
+        in_storage = self._in_storage(directory)
+
+        for name, arr in self._slot_arrays().items():
+            path = os.path.join(directory, f"{name}.npy")
+            if in_storage:
+                data = arr.data if isinstance(arr, PackedBits) else arr
+                data.flush()
+                continue
+            if incremental:
+                out = np.load(path, mmap_mode="r+")
+                slices = self._unsaved_slices()
+            else:
+                dtype = self._read_slots(arr, slice(0)).dtype
+                out = np.lib.format.open_memmap(
+                    path, mode="w+", dtype=dtype, shape=tuple(arr.shape)
+                )
+                slices = [slice(len(self))]
+            for slc in slices:
+                out[slc] = self._read_slots(arr, slc)
+            out.flush()
+            del out
+
+        with open(contents_path, "wb") as file:
+            pickle.dump({**self.state_dict(), **self.contents_state_dict()}, file)
+        self._save_directory = directory
+        self._unsaved = 0
+
+    def restore(self, directory: str):
+        """Read the buffer's contents from a directory written by :meth:`save`.
+
+        Also restores the statistics saved along with the contents, replacing
+        any loaded via :meth:`load_state_dict`.
+        """
+        with open(os.path.join(directory, "contents.pkl"), "rb") as file:
+            state = pickle.load(file)
+        self.load_state_dict(state)
+        self.load_contents_state_dict(state)
+
+        slc = slice(len(self))
+        slot_arrays = {} if self._in_storage(directory) else self._slot_arrays()
+        for name, arr in slot_arrays.items():
+            saved = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+            self._write_slots(arr, slc, saved[slc])
+            del saved
+        self._save_directory = directory
+        self._unsaved = 0
+
+    def _in_storage(self, directory: str) -> bool:
+        """Whether the directory holds the buffer's memory-mapped arrays."""
+        allocator = self._allocator
+        return (
+            isinstance(allocator, MemmapStorage)
+            and allocator.persistent
+            and os.path.isdir(directory)
+            and os.path.samefile(directory, allocator.directory)
+        )
+
+    def _slot_arrays(self) -> Dict[str, np.ndarray]:
+        """Arrays indexed by storage slot which make up the buffer's contents."""
+        return {**self._storage, **self._episode_index}
+
+    def _unsaved_slices(self) -> List[slice]:
+        """Storage slices written since the last save, in ring order."""
+        if not self._unsaved:
+            return []
+        start = (self._next_idx - self._unsaved) % self._maxsize
+        end = start + self._unsaved
+        if end <= self._maxsize:
+            return [slice(start, end)]
+        return [slice(start, None), slice(end - self._maxsize)]
+
+    def _read_slots(self, arr: np.ndarray, index: slice) -> np.ndarray:
+        # pylint:disable=no-self-use
+        return arr[index]
+
+    def _write_slots(self, arr: np.ndarray, index: slice, values: np.ndarray):
+        # pylint:disable=no-self-use
+        arr[index] = values
+
+
+class PrioritizedReplayBuffer(NumpyReplayBuffer):
+    """Replay buffer with proportional prioritization.
+
+    Transitions are sampled with probability proportional to their priority
+    raised to `alpha`, using stratified sampling over a sum-tree. New
+    transitions get the maximum priority seen so far.
+
+    Sampled batches include the importance sampling weights and the storage
+    indexes of each transition under the `WEIGHTS` and `IDXES` keys
+    respectively. Priorities should then be updated via
+    :meth:`update_priorities`.
+
+    Args:
+        obs_space: observation space
+        action_space: action space
+        size: max number of transitions to store in the buffer
+        storage: Allocator for the field arrays
+        alpha: How much prioritization is used (0 for uniform sampling)
+        beta: Importance sampling correction exponent (1 for full correction)
+        epsilon: Small constant added to priorities so that no transition has
+            zero probability of being sampled
+        track_episodes: Whether to keep episode offsets to sample sequences
+    """
+
+    WEIGHTS: str = "weights"
+    IDXES: str = "batch_indexes"
+
+    def __init__(
+        self,
+        obs_space: Space,
+        action_space: Space,
+        size: int,
+        storage: Optional[ArrayStorage] = None,
+        dtypes: Optional[Dict[str, Union[np.dtype, str]]] = None,
+        alpha: float = 0.6,
+        beta: float = 0.4,
+        epsilon: float = 1e-6,
+        track_episodes: bool = False,
+    ):
+        # pylint:disable=too-many-arguments
+        super().__init__(
+            obs_space,
+            action_space,
+            size,
+            storage=storage,
+            dtypes=dtypes,
+            track_episodes=track_episodes,
+        )
+        assert alpha >= 0, "Prioritization exponent must be non-negative"
+        assert beta >= 0, "Importance sampling exponent must be non-negative"
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+        self._sum_tree = SumSegmentTree(size)
+        self._min_tree = MinSegmentTree(size)
+        self._max_priority = 1.0
+
+    def _advance(self, count: int):
+        idxes = self._insertion_idxes(count)
+        super()._advance(count)
+        priority = self._max_priority ** self.alpha
+        self._sum_tree[idxes] = priority
+        self._min_tree[idxes] = priority
+
+    def sample(self, batch_size: int) -> SampleBatch:
+        """Transition batch sampled proportionally to priorities.
+
+        Includes the importance sampling weights and the storage indexes of the
+        sampled transitions.
+        """
+        idxes = self.sample_idxes(batch_size)
+        batch = self[idxes]
+        batch[self.WEIGHTS] = self.importance_weights(idxes)
+        batch[self.IDXES] = idxes
+        return SampleBatch(batch)
+
+    def sample_many(self, num_batches: int, batch_size: int) -> List[SampleBatch]:
+        """Several transition batches sampled proportionally to priorities.
+
+        Batches are sampled one at a time, since priorities are usually
+        updated between consecutive batches.
+        """
+        return [self.sample(batch_size) for _ in range(num_batches)]
+
+    def sample_idxes(self, batch_size: int) -> np.ndarray:
+        """Get transition indexes sampled proportionally to priorities.
+
+        Splits the total priority mass in `batch_size` equal segments and
+        samples one transition from each.
+        """
+        segment = self._sum_tree.reduce() / batch_size
+        prefixsums = (np.arange(batch_size) + self._rng.random(batch_size)) * segment
+        idxes = self._sum_tree.find_prefixsum_idx(prefixsums)
+        # Guard against floating point errors landing on empty leaves
+        return np.minimum(idxes, len(self) - 1)
+
+    def importance_weights(self, idxes: np.ndarray) -> np.ndarray:
+        """Importance sampling weights normalized by the maximum weight."""
+        total = self._sum_tree.reduce()
+        probs = self._sum_tree[idxes] / total
+        min_prob = self._min_tree.reduce() / total
+        weights = (probs / min_prob) ** (-self.beta)
+        return weights.astype(np.float32)
+
+    def update_priorities(self, idxes: np.ndarray, priorities: np.ndarray):
+        """Set the priorities of transitions at the given indexes.
+
+        Args:
+            idxes: Storage indexes of the transitions, as returned by
+                :meth:`sample`
+            priorities: New priorities, e.g., absolute TD errors
+        """
+        priorities = np.abs(priorities) + self.epsilon
+        self._sum_tree[idxes] = priorities ** self.alpha
+        self._min_tree[idxes] = priorities ** self.alpha
+        self._max_priority = max(self._max_priority, priorities.max())
+
+    def state_dict(self) -> dict:
+        state = super().state_dict()
+        state["max_priority"] = self._max_priority
+        return state
+
+    def load_state_dict(self, state: dict):
+        super().load_state_dict(state)
+        self._max_priority = state["max_priority"]
+
+    def contents_state_dict(self) -> dict:
+        state = super().contents_state_dict()
+        state["sum_tree"] = self._sum_tree.state_dict()
+        state["min_tree"] = self._min_tree.state_dict()
+        return state
+
+    def load_contents_state_dict(self, state: dict):
+        super().load_contents_state_dict(state)
+        if "sum_tree" in state:
+            self._sum_tree.load_state_dict(state["sum_tree"])
+            self._min_tree.load_state_dict(state["min_tree"])
+
+
+class CompactReplayBuffer(NumpyReplayBuffer):
+    """Replay buffer storing each observation only once.
+
+    Consecutive transitions in an episode share observations: the next
+    observation of a transition is the current observation of the one that
+    follows. This buffer does not allocate storage for next observations.
+    Instead, each transition holds a reference to either the following storage
+    slot or to an entry in an array of boundary observations, which keeps the
+    next observations that cannot be recovered from the following slot (e.g.,
+    at episode ends or for the latest transition). Next observations are
+    rebuilt from these references when queried.
+
+    Boundary observations are kept in insertion order, so that entries are
+    released as their transitions get overwritten. Memory usage for next
+    observations thus scales with the number of episode boundaries in the
+    buffer instead of its size.
+
+    Args:
+        obs_space: observation space
+        action_space: action space
+        size: max number of transitions to store in the buffer
+        storage: Allocator for the field arrays
+        dtypes: Mapping from the names of default fields to their storage
+            dtypes. See :class:`ReplayField`.
+        track_episodes: Whether to keep episode offsets to sample sequences
+    """
+
+    def __init__(
+        self,
+        obs_space: Space,
+        action_space: Space,
+        size: int,
+        storage: Optional[ArrayStorage] = None,
+        dtypes: Optional[Dict[str, Union[np.dtype, str]]] = None,
+        track_episodes: bool = False,
+    ):
+        # pylint:disable=too-many-arguments
+        super().__init__(
+            obs_space,
+            action_space,
+            size,
+            storage=storage,
+            dtypes=dtypes,
+            track_episodes=track_episodes,
+        )
+        self._next_ref = self._allocator.allocate(
+            ReplayField("next_obs_ref", dtype=np.int64), size
+        )
+        self._boundary = np.empty(
+            (16,) + obs_space.shape, dtype=self._storage[SampleBatch.CUR_OBS].dtype
+        )
+        self._boundary_head = 0
+        self._boundary_tail = 0
+        self._pending_next_obs: Optional[np.ndarray] = None
+
+    def _build_buffers(self, *fields: ReplayField):
+        super()._build_buffers(*(f for f in fields if f.name != SampleBatch.NEXT_OBS))
+
+    @property
+    def num_boundaries(self) -> int:
+        """Number of next observations stored separately."""
+        return self._boundary_tail - self._boundary_head
+
+    def add(self, samples: SampleBatch):
+        if samples.count >= self._maxsize:
+            samples = samples.slice(samples.count - self._maxsize, None)
+            idxes = np.arange(self._maxsize)
+            self._boundary_head = self._boundary_tail = 0
+        else:
+            idxes = self._insertion_idxes(samples.count)
+            self._release_boundaries(idxes)
+            if samples.count:
+                self._link_latest(samples[SampleBatch.CUR_OBS][0])
+
+        self._store_next_obs(idxes, samples)
+        super().add(samples)
+
+    def reserve(self, count: int) -> ReplayReservation:
+        """Reserve the next `count` slots to write transitions in place.
+
+        Next observations are written to a scratch array of the reservation
+        and only stored on commit, where needed. See
+        :meth:`NumpyReplayBuffer.reserve`.
+        """
+        reservation = super().reserve(count)
+        self._pending_next_obs = np.empty(
+            (count,) + self._boundary.shape[1:], dtype=self._boundary.dtype
+        )
+        reservation.scratch[SampleBatch.NEXT_OBS] = self._pending_next_obs
+        return reservation
+
+    def _commit_reservation(self, count: int):
+        if count == self._maxsize:
+            idxes = np.arange(self._maxsize)
+            self._boundary_head = self._boundary_tail = 0
+        else:
+            idxes = self._insertion_idxes(count)
+            self._release_boundaries(idxes)
+        cur_obs = self._stored(SampleBatch.CUR_OBS, idxes)
+        if count < self._maxsize:
+            self._link_latest(cur_obs[0])
+        next_obs, self._pending_next_obs = self._pending_next_obs, None
+        written = {SampleBatch.CUR_OBS: cur_obs, SampleBatch.NEXT_OBS: next_obs}
+        self._store_next_obs(idxes, written)
+        super()._commit_reservation(count)
+
+    def _cancel_reservation(self):
+        self._pending_next_obs = None
+        super()._cancel_reservation()
+
+    def _release_boundaries(self, idxes: np.ndarray):
+        """Release boundary entries of transitions about to be overwritten."""
+        idxes = idxes[idxes < len(self)]
+        self._boundary_head += np.count_nonzero(self._next_ref[idxes] >= 0)
+
+    def _link_latest(self, obs: np.ndarray):
+        """Link the latest transition to the next slot if it continues there."""
+        if len(self) == 0:
+            return
+
+        latest = (self._next_idx - 1) % self._maxsize
+        ref = self._next_ref[latest]
+        if ref == self._boundary_tail - 1 and np.array_equal(
+            self._boundary[ref % len(self._boundary)],
+            np.asarray(obs).astype(self._boundary.dtype),
+        ):
+            self._next_ref[latest] = -1
+            self._boundary_tail -= 1
+            # The latest slot precedes the ones about to be written
+            self._unsaved += 1
+
+    def _store_next_obs(self, idxes: np.ndarray, samples: Dict[str, np.ndarray]):
+        cur_obs = samples[SampleBatch.CUR_OBS]
+        next_obs = samples[SampleBatch.NEXT_OBS]
+
+        linked = np.zeros(len(idxes), dtype=bool)
+        obs_axes = tuple(range(1, next_obs.ndim))
+        linked[:-1] = np.all(next_obs[:-1] == cur_obs[1:], axis=obs_axes)
+
+        unlinked = ~linked
+        count = np.count_nonzero(unlinked)
+        self._reserve_boundaries(count)
+        refs = self._boundary_tail + np.arange(count)
+        self._boundary[refs % len(self._boundary)] = next_obs[unlinked]
+        self._next_ref[idxes] = -1
+        self._next_ref[idxes[unlinked]] = refs
+        self._boundary_tail += count
+
+    def _reserve_boundaries(self, count: int):
+        """Grow the boundary array if needed to fit `count` new entries."""
+        capacity = len(self._boundary)
+        if self.num_boundaries + count <= capacity:
+            return
+
+        new_capacity = max(2 * capacity, self.num_boundaries + count)
+        refs = np.arange(self._boundary_head, self._boundary_tail)
+        boundary = np.empty(
+            (new_capacity,) + self._boundary.shape[1:], dtype=self._boundary.dtype
+        )
+        boundary[refs % new_capacity] = self._boundary[refs % capacity]
+        self._boundary = boundary
+
+    def _slot_arrays(self) -> Dict[str, np.ndarray]:
+        return {**super()._slot_arrays(), "next_obs_ref": self._next_ref}
+
+    def _gather(self, index: Union[int, np.ndarray, slice]) -> Dict[str, np.ndarray]:
+        batch = super()._gather(index)
+        batch[SampleBatch.NEXT_OBS] = self._next_obs(index)
+        return batch
+
+    def _gather_into(self, idxes: np.ndarray, out: Dict[str, np.ndarray]):
+        out = out.copy()
+        next_obs = out.pop(SampleBatch.NEXT_OBS, None)
+        super()._gather_into(idxes, out)
+        if next_obs is not None:
+            next_obs[...] = self._next_obs(idxes)
+
+    def _next_obs(self, index: Union[int, np.ndarray, slice]) -> np.ndarray:
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(self._maxsize))
+        idxes = np.ravel(index) % self._maxsize
+
+        next_obs = self._storage[SampleBatch.CUR_OBS][(idxes + 1) % self._maxsize]
+        refs = self._next_ref[idxes]
+        bounded = refs >= 0
+        next_obs[bounded] = self._boundary[refs[bounded] % len(self._boundary)]
+        next_obs = self._upcast(SampleBatch.CUR_OBS, next_obs)
+        return next_obs.reshape(np.shape(index) + next_obs.shape[1:])
+
+    def contents_state_dict(self) -> dict:
+        state = super().contents_state_dict()
+        refs = np.arange(self._boundary_head, self._boundary_tail)
+        state["boundary"] = (
+            self._boundary[refs % len(self._boundary)],
+            self._boundary_head,
+        )
+        return state
+
+    def load_contents_state_dict(self, state: dict):
+        super().load_contents_state_dict(state)
+        if "boundary" in state:
+            boundary, head = state["boundary"]
+            self._boundary_head = self._boundary_tail = head
+            self._reserve_boundaries(len(boundary))
+            refs = head + np.arange(len(boundary))
+            self._boundary[refs % len(self._boundary)] = boundary
+            self._boundary_tail += len(boundary)
+
+
+class PrioritizedCompactReplayBuffer(PrioritizedReplayBuffer, CompactReplayBuffer):
+    """Prioritized replay buffer storing each observation only once."""
+
+
+class TorchReplayBuffer(NumpyReplayBuffer):
+    """Replay buffer as a dict of tensors on the policy's device.
+
+    Minibatches are gathered with `index_select` from random indexes generated
+    on the same device and returned as a plain :obj:`TensorDict`, avoiding the
+    NumPy round trip and the host-to-device copies of each sampled batch.
+
+    Args:
+        obs_space: observation space
+        action_space: action space
+        size: max number of transitions to store in the buffer.
+        device: Device on which to store the transitions
+        dtypes: Mapping from the names of default fields to their storage
+            dtypes. Packed bits are not supported.
+        track_episodes: Whether to keep episode offsets to sample sequences
+    """
+
+    def __init__(
+        self,
+        obs_space: Space,
+        action_space: Space,
+        size: int,
+        device: Union[str, torch.device] = "cpu",
+        dtypes: Optional[Dict[str, Union[np.dtype, str]]] = None,
+        track_episodes: bool = False,
+    ):
+        # pylint:disable=too-many-arguments
+        assert PACKED_BITS not in (dtypes or {}).values(), "Packed bits unsupported"
+        storage = TensorStorage(device)
+        super().__init__(
+            obs_space,
+            action_space,
+            size,
+            storage=storage,
+            dtypes=dtypes,
+            track_episodes=track_episodes,
+        )
+        self.device = self._allocator.device
+        self._dtypes = {k: storage.torch_dtype(v) for k, v in self._dtypes.items()}
+        self._generator = torch.Generator(device=self.device)
+        self._generator.seed()
+        self._tensor_obs_stats: Optional[Tuple[Tensor, Tensor]] = None
+
+    def _gather(self, index: Union[int, np.ndarray, slice, Tensor]) -> TensorDict:
+        if isinstance(index, np.ndarray):
+            index = torch.from_numpy(index).to(self.device)
+        if torch.is_tensor(index) and index.dim() == 1:
+            batch = {
+                name: ten.index_select(0, index) for name, ten in self._storage.items()
+            }
+        else:
+            batch = {name: ten[index] for name, ten in self._storage.items()}
+        return {name: self._upcast(name, ten) for name, ten in batch.items()}
+
+    def _upcast(self, name: str, values: Tensor) -> Tensor:
+        return values.to(self._dtypes[name])
+
+    def _read_slots(self, arr: Tensor, index: slice) -> np.ndarray:
+        if not torch.is_tensor(arr):
+            return super()._read_slots(arr, index)
+        return arr[index].cpu().numpy()
+
+    def _write_slots(self, arr: Tensor, index: slice, values: np.ndarray):
+        if not torch.is_tensor(arr):
+            super()._write_slots(arr, index, values)
+        else:
+            arr[index] = torch.as_tensor(np.asarray(values)).to(arr)
+
+    def _stored(self, name: str, idxes: np.ndarray) -> np.ndarray:
+        index = torch.from_numpy(idxes).to(self.device)
+        return self._storage[name].index_select(0, index).cpu().numpy()
+
+    def normalize(self, obs: Union[np.ndarray, Tensor]) -> Union[np.ndarray, Tensor]:
+        """Normalize observation using the stored mean and stddev.
+
+        Tensors are normalized on the buffer's device, while other inputs are
+        handled as in :meth:`NumpyReplayBuffer.normalize`.
+        """
+        if not torch.is_tensor(obs):
+            return super().normalize(obs)
+        if not self.compute_stats:
+            return obs
+
+        if not self._obs_stats:
+            self.update_obs_stats()
+
+        mean, std = self._tensor_obs_stats
+        return (obs - mean) / std
+
+    def update_obs_stats(self):
+        super().update_obs_stats()
+        self._cache_tensor_obs_stats()
+
+    def _cache_tensor_obs_stats(self):
+        self._tensor_obs_stats = tuple(
+            torch.as_tensor(s, dtype=torch.float32, device=self.device)
+            for s in self._obs_stats
+        )
+
+    def seed(self, seed: int = None):
+        super().seed(seed)
+        if seed is None:
+            self._generator.seed()
+        else:
+            self._generator.manual_seed(seed)
+
+    def add(self, samples: SampleBatch):
+        """Copy a SampleBatch into the preallocated tensors.
+
+        Args:
+            samples: The sample batch
+        """
+        self._update_running_obs_stats(samples)
+        self._update_episode_index(samples)
+        count = min(samples.count, self._maxsize)
+        idxes = torch.from_numpy(self._insertion_idxes(count)).to(self.device)
+        for name, ten in self._storage.items():
+            values = torch.as_tensor(np.asarray(samples[name][-count:]))
+            ten.index_copy_(0, idxes, values.to(self.device, ten.dtype))
+
+        if samples.count >= self._maxsize:
+            self._next_idx = 0
+        self._advance(count)
+
+    def sample(self, batch_size: int) -> TensorDict:
+        """Transition batch uniformly sampled with replacement."""
+        return self[self.sample_idxes(batch_size)]
+
+    def sample_many(self, num_batches: int, batch_size: int) -> List[TensorDict]:
+        """Several transition batches uniformly sampled with replacement.
+
+        All batches are views of a single gathered block of tensors.
+        """
+        block = self[self.sample_idxes(num_batches * batch_size)]
+        return [
+            {k: v[i : i + batch_size] for k, v in block.items()}
+            for i in range(0, num_batches * batch_size, batch_size)
+        ]
+
+    def sample_sequences(self, batch_size: int, horizon: int) -> TensorDict:
+        batch = super().sample_sequences(batch_size, horizon)
+        batch[self.MASK] = torch.from_numpy(batch[self.MASK]).to(self.device)
+        return batch
+
+    def sample_idxes(self, batch_size: int) -> Tensor:
+        """Get random transition indexes uniformly sampled with replacement."""
+        return torch.randint(
+            len(self), (batch_size,), generator=self._generator, device=self.device
+        )
+
+    def all_samples(self) -> SampleBatch:
+        """All stored transitions as NumPy arrays."""
+        batch = self[: len(self)]
+        return SampleBatch({k: v.cpu().numpy() for k, v in batch.items()})
+
+    def load_state_dict(self, state: dict):
+        super().load_state_dict(state)
+        if self._obs_stats:
+            self._cache_tensor_obs_stats()
+
+
+class GenerationalReplayBuffer(NumpyReplayBuffer):
+    """Replay buffer which only keeps transitions from recent generations.
+
+    Transitions are tagged under `GENERATION` with the generation current
+    when they were added, e.g., the number of model updates so far. Calling
+    :meth:`new_generation` evicts every transition older than the latest
+    `max_generations` generations, so that sampling only reads live ones.
+
+    Storage is allocated on demand, doubling as needed up to `size`
+    transitions. Evictions move the live transitions to the start of freshly
+    allocated arrays, shrinking them when most of the storage is unused, so
+    that stale transitions no longer hold memory.
+
+    Args:
+        obs_space: observation space
+        action_space: action space
+        size: max number of transitions to store in the buffer. When the
+            buffer overflows the old memories are dropped, regardless of
+            their generation.
+        max_generations: Number of most recent generations to keep
+        min_capacity: Initial number of slots allocated
+        dtypes: Mapping from the names of default fields to their storage
+            dtypes. See :class:`ReplayField`.
+        track_episodes: Whether to keep episode offsets to sample sequences
+
+    Attributes:
+        generation: The generation tagging newly added transitions
+    """
+
+    GENERATION: str = "generation"
+
+    def __init__(
+        self,
+        obs_space: Space,
+        action_space: Space,
+        size: int,
+        max_generations: int,
+        min_capacity: int = 1024,
+        dtypes: Optional[Dict[str, Union[np.dtype, str]]] = None,
+        track_episodes: bool = False,
+    ):
+        # pylint:disable=too-many-arguments
+        assert max_generations > 0, "Must keep at least the current generation"
+        self._size_limit = size
+        self._min_capacity = min(min_capacity, size)
+        super().__init__(
+            obs_space,
+            action_space,
+            self._min_capacity,
+            dtypes=dtypes,
+            track_episodes=track_episodes,
+        )
+        self.add_fields(ReplayField(self.GENERATION, dtype=np.int64))
+        self.max_generations = max_generations
+        self.generation = 0
+
+    @property
+    def capacity(self) -> int:
+        """Maximum number of transitions stored."""
+        return self._size_limit
+
+    @property
+    def allocated(self) -> int:
+        """Number of slots currently allocated for each field."""
+        return self._maxsize
+
+    def new_generation(self):
+        """Tag new transitions with the next generation, evicting old ones."""
+        self.generation += 1
+        oldest = self.generation - self.max_generations + 1
+        live = self._live_slots()
+        stale = np.count_nonzero(self._storage[self.GENERATION][live] < oldest)
+        if not stale:
+            return
+
+        if self.compute_stats:
+            self._running_obs_stats.pop(self._stored(SampleBatch.CUR_OBS, live[:stale]))
+        self._curr_size -= stale
+        self._unsaved = min(self._unsaved, self._curr_size)
+        self._obs_stats = None
+        capacity = self._maxsize
+        if self._curr_size < capacity // 4:
+            capacity = max(self._min_capacity, 2 * self._curr_size)
+        self._resize(capacity)
+
+    def add(self, samples: SampleBatch):
+        self._make_room(samples.count)
+        samples = SampleBatch(
+            {**samples, self.GENERATION: np.full(samples.count, self.generation)}
+        )
+        super().add(samples)
+
+    def reserve(self, count: int) -> ReplayReservation:
+        self._make_room(count)
+        return super().reserve(count)
+
+    def _commit_reservation(self, count: int):
+        start = 0 if count == self._maxsize else self._next_idx
+        slots = (start + np.arange(count)) % self._maxsize
+        self._storage[self.GENERATION][slots] = self.generation
+        super()._commit_reservation(count)
+
+    def _make_room(self, count: int):
+        """Grow the storage to fit `count` more transitions, if allowed."""
+        needed = len(self) + count
+        if needed > self._maxsize and self._maxsize < self._size_limit:
+            self._resize(min(self._size_limit, max(needed, 2 * self._maxsize)))
+
+    def _live_slots(self) -> np.ndarray:
+        """Storage slots of the stored transitions, oldest first."""
+        return (self._next_idx - len(self) + np.arange(len(self))) % self._maxsize
+
+    def _resize(self, capacity: int):
+        """Move the stored transitions to the start of new arrays."""
+        live = self._live_slots()
+        storage, episode_index = self._storage, self._episode_index
+        self._maxsize = capacity
+        self._storage = {}
+        self._build_buffers(*self.fields)
+        if episode_index:
+            self._episode_index = self._build_episode_index()
+        for name, arr in storage.items():
+            self._storage[name][: len(live)] = arr[live]
+        for name, arr in episode_index.items():
+            self._episode_index[name][: len(live)] = arr[live]
+        self._next_idx = len(live) % capacity
+        # Saved files no longer match the storage layout
+        self._save_directory = None
+
+    def contents_state_dict(self) -> dict:
+        state = super().contents_state_dict()
+        state["generations"] = (self.generation, self._maxsize)
+        return state
+
+    def load_contents_state_dict(self, state: dict):
+        if "generations" in state:
+            self.generation, capacity = state["generations"]
+            self._curr_size = 0
+            self._resize(capacity)
+        super().load_contents_state_dict(state)
+
+
+class MixedReplaySampler:
+    """Samples minibatches mixing transitions from several replay buffers.
+
+    Each minibatch holds a fixed number of uniformly sampled transitions from
+    each buffer. These are gathered directly into a preallocated block of
+    arrays, instead of concatenating separate batches from each buffer. The
+    block is reused across calls to :meth:`sample_many`, so returned batches
+    are only valid until the next call.
+
+    Args:
+        replays: Buffers to sample from. Only the fields common to all
+            buffers are sampled
+        batch_sizes: Number of transitions from each buffer in a minibatch
+    """
+
+    def __init__(self, replays: List[NumpyReplayBuffer], batch_sizes: List[int]):
+        assert len(replays) == len(batch_sizes), "Need a batch size for each buffer"
+        self.replays = replays
+        self.batch_sizes = batch_sizes
+        names = set.intersection(*({f.name for f in r.fields} for r in replays))
+        self.fields = tuple(f for f in replays[0].fields if f.name in names)
+        self._block: Dict[str, np.ndarray] = {}
+
+    @property
+    def batch_size(self) -> int:
+        """Total number of transitions in a minibatch."""
+        return sum(self.batch_sizes)
+
+    def sample_many(self, num_batches: int) -> List[Dict[str, np.ndarray]]:
+        """Several minibatches with transitions from every buffer."""
+        block = self._reserve(num_batches)
+        start = 0
+        for replay, size in zip(self.replays, self.batch_sizes):
+            if size:
+                idxes = replay.sample_idxes(num_batches * size)
+                out = {k: v[:, start : start + size] for k, v in block.items()}
+                replay.gather_into(idxes.reshape(num_batches, size), out)
+            start += size
+        return [{k: v[i] for k, v in block.items()} for i in range(num_batches)]
+
+    def _reserve(self, num_batches: int) -> Dict[str, np.ndarray]:
+        """Views of the output block with room for `num_batches` minibatches."""
+        if not self._block or len(next(iter(self._block.values()))) < num_batches:
+            self._block = {
+                f.name: np.empty((num_batches, self.batch_size) + f.shape, f.dtype)
+                for f in self.fields
+            }
+        return {k: v[:num_batches] for k, v in self._block.items()}
+
+
+class ReplayPrefetcher:
+    """Prepares uniformly sampled minibatches in a background thread.
+
+    Keeps a bounded queue of batches which are already gathered, normalized
+    and converted to tensors, so that this work overlaps with the policy
+    updates consuming them. Transitions must be added via :meth:`add`, which
+    drops queued batches holding transitions overwritten by the new ones.
+    If the buffer normalizes observations, every new transition changes the
+    statistics, so all queued batches are dropped instead.
+
+    Args:
+        replay: The replay buffer to sample from. Must not be accessed by
+            other threads while sampling, except via this prefetcher's methods
+        batch_size: Number of transitions per batch
+        convert: Function to convert a batch of arrays into tensors
+        capacity: Maximum number of batches in the queue
+        seed: Seed for the random number generator used by the worker thread
+    """
+
+    # pylint:disable=too-many-instance-attributes
+    def __init__(
+        self,
+        replay: NumpyReplayBuffer,
+        batch_size: int,
+        convert: Callable[[Dict[str, np.ndarray]], TensorDict],
+        capacity: int,
+        seed: Optional[int] = None,
+    ):
+        # pylint:disable=too-many-arguments
+        assert not isinstance(
+            replay, PrioritizedReplayBuffer
+        ), "Prefetching is incompatible with prioritized replay"
+        self.replay = replay
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self._convert = convert
+        self._rng = np.random.default_rng(seed)
+        self._queue = deque()
+        # Acquired before self._cond when both are needed
+        self._replay_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._stopped
+                    or (len(self._queue) < self.capacity and len(self.replay) > 0)
+                )
+                if self._stopped:
+                    return
+
+            with self._replay_lock:
+                idxes = self._rng.integers(len(self.replay), size=self.batch_size)
+                batch = self._convert(self.replay[idxes])
+                with self._cond:
+                    self._queue.append((idxes, batch))
+                    self._cond.notify_all()
+
+    def get(self) -> TensorDict:
+        """Next prepared batch, waiting for the worker thread if necessary.
+
+        Raises:
+            RuntimeError: If the prefetcher was closed or the buffer is empty,
+                in which case no batch would ever be prepared
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._queue or self._stopped or len(self.replay) == 0
+            )
+            if not self._queue:
+                raise RuntimeError(
+                    "Cannot get batches from a closed prefetcher or an empty buffer"
+                )
+            _, batch = self._queue.popleft()
+            self._cond.notify_all()
+        return batch
+
+    def add(self, samples: SampleBatch):
+        """Add a SampleBatch to the replay buffer, invalidating stale batches."""
+        # pylint:disable=protected-access
+        with self._replay_lock:
+            overwritten = self.replay._insertion_idxes(
+                min(samples.count, self.replay._maxsize)
+            )
+            self.replay.add(samples)
+            with self._cond:
+                if self.replay.compute_stats:
+                    self._queue.clear()
+                else:
+                    self._queue = deque(
+                        (idxes, batch)
+                        for idxes, batch in self._queue
+                        if not np.isin(idxes, overwritten).any()
+                    )
+                self._cond.notify_all()
+
+    def clear(self):
+        """Drop all queued batches, e.g., after restoring the buffer's state."""
+        with self._replay_lock, self._cond:
+            self._queue.clear()
+            self._cond.notify_all()
+
+    def close(self):
+        """Stop the worker thread."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join()
+
+
+class SharedReplayBuffer(NumpyReplayBuffer):
+    """Replay buffer in shared memory with one segment per writer process.
+
+    Each of the `num_writers` processes creates a buffer with the same `name`
+    and its own `writer` index. Writers add transitions to their own ring
+    segment and then publish the number of transitions written in a shared
+    counter array, so that no locks are needed. All processes may sample from
+    every segment without copying the buffer. Slots being overwritten may be
+    read while still being written to.
+
+    Indexes into the buffer, as taken by :meth:`__getitem__` and returned by
+    :meth:`sample_idxes`, are positions among the stored transitions ordered
+    by segment, from 0 to the buffer's length. They are mapped to storage
+    slots on each access, so an index may refer to a different transition
+    once other writers add to the buffer.
+
+    Observation statistics are not supported, since each process only sees
+    the transitions it added itself. Neither are episode sequences nor
+    checkpointing the buffer's contents.
+
+    Args:
+        obs_space: observation space
+        action_space: action space
+        size: max number of transitions to store in the buffer. Evenly split
+            among the writers.
+        name: Prefix for the names of the shared memory blocks
+        num_writers: Number of processes adding transitions to the buffer
+        writer: Index of the segment this process writes to, or None if it
+            only samples from the buffer
+        owner: Whether this process owns the shared memory blocks, removing
+            them once done. Defaults to whether this process is writer 0.
+        dtypes: Mapping from the names of default fields to their storage
+            dtypes. See :class:`ReplayField`.
+    """
+
+    # pylint:disable=too-many-arguments
+    def __init__(
+        self,
+        obs_space: Space,
+        action_space: Space,
+        size: int,
+        name: str,
+        num_writers: int = 1,
+        writer: Optional[int] = 0,
+        owner: Optional[bool] = None,
+        dtypes: Optional[Dict[str, Union[np.dtype, str]]] = None,
+    ):
+        assert writer is None or 0 <= writer < num_writers, "Writer out of range"
+        # Writers to neighboring segments could race on a shared byte
+        assert PACKED_BITS not in (dtypes or {}).values(), "Packed bits unsupported"
+        owner = writer == 0 if owner is None else owner
+        storage = SharedMemoryStorage(name, owner=owner)
+        super().__init__(obs_space, action_space, size, storage=storage, dtypes=dtypes)
+        self._segment_size = size // num_writers
+        self.writer = writer
+        self._counts = storage.allocate(
+            ReplayField("writer_counts", dtype=np.int64), num_writers
+        )
+
+    def __len__(self) -> int:
+        return int(np.minimum(self._counts, self._segment_size).sum())
+
+    def _slots_of(self, index: Union[int, np.ndarray, slice]) -> np.ndarray:
+        """Storage slots of the transitions at the given indexes."""
+        sizes = np.minimum(self._counts, self._segment_size)
+        ends = np.cumsum(sizes)
+        if isinstance(index, slice):
+            index = np.arange(ends[-1])[index]
+        index = np.asarray(index)
+        segments = np.searchsorted(ends, index, side="right")
+        return segments * self._segment_size + index - (ends - sizes)[segments]
+
+    def _gather(self, index: Union[int, np.ndarray, slice]) -> Dict[str, np.ndarray]:
+        return super()._gather(self._slots_of(index))
+
+    def _gather_into(self, idxes: np.ndarray, out: Dict[str, np.ndarray]):
+        super()._gather_into(self._slots_of(idxes), out)
+
+    def add(self, samples: SampleBatch):
+        """Add a SampleBatch to this process' segment."""
+        assert not self.compute_stats, "Observation statistics are not supported"
+        seg_size = self._segment_size
+        count = min(samples.count, seg_size)
+        if not count:
+            return
+
+        assert self.writer is not None, "This process does not write to the buffer"
+        written = self._counts[self.writer]
+        idxes = (written + samples.count - count + np.arange(count)) % seg_size
+        idxes += self.writer * seg_size
+        for name, arr in self._storage.items():
+            arr[idxes] = samples[name][-count:]
+        self._counts[self.writer] = written + samples.count
+
+    def reserve(self, count: int) -> ReplayReservation:
+        """Reserve the next `count` slots of this process' segment.
+
+        See :meth:`NumpyReplayBuffer.reserve`.
+        """
+        assert self.writer is not None, "This process does not write to the buffer"
+        seg_size = self._segment_size
+        assert 0 < count <= seg_size, "Can only reserve up to the segment's size"
+        start = int(self._counts[self.writer] % seg_size)
+        return ReplayReservation(
+            self, start, count, base=self.writer * seg_size, size=seg_size
+        )
+
+    def _commit_reservation(self, count: int):
+        self._counts[self.writer] += count
+
+    def _cancel_reservation(self):
+        pass
+
+    def sample_idxes(self, batch_size: int) -> np.ndarray:
+        """Get random transition indexes uniformly sampled with replacement."""
+        return self._rng.integers(len(self), size=batch_size)
+
+    def _check_track_episodes(self):
+        raise ValueError(
+            "Shared replay buffers do not track episodes to sample sequences from"
+        )
+
+    def save(self, directory: str):
+        raise NotImplementedError(
+            "Shared replay buffers cannot be checkpointed."
+            " Set 'replay_checkpoint' to None with 'replay/storage': shared"
+        )
+
+    def restore(self, directory: str):
+        raise NotImplementedError(
+            "Shared replay buffers cannot be checkpointed."
+            " Set 'replay_checkpoint' to None with 'replay/storage': shared"
+        )
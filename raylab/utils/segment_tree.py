@@ -0,0 +1,95 @@
+"""Vectorized segment trees for prioritized experience replay."""
+import numpy as np
+
+
+class SegmentTree:
+    """Binary segment tree stored as a flat array.
+
+    The leaves live in the second half of the array, with the root at index 1.
+    Updates and queries operate on whole batches of indices, touching each
+    tree level once, so that their cost is O(batch * log(capacity)) without
+    Python loops over the batch.
+
+    Args:
+        capacity: Number of leaves. Rounded up to the next power of two
+        operation: Binary numpy ufunc used to aggregate children, e.g.,
+            `np.add` or `np.minimum`
+        neutral_element: Identity value for `operation`
+    """
+
+    def __init__(self, capacity: int, operation: np.ufunc, neutral_element: float):
+        self._capacity = 1
+        while self._capacity < capacity:
+            self._capacity *= 2
+        self._depth = self._capacity.bit_length() - 1
+        self._operation = operation
+        self._neutral_element = neutral_element
+        self._tree = np.full(2 * self._capacity, neutral_element, dtype=np.float64)
+
+    @property
+    def capacity(self) -> int:
+        """Number of leaves in the tree."""
+        return self._capacity
+
+    def __setitem__(self, idxes: np.ndarray, values: np.ndarray):
+        idxes = np.asarray(idxes) + self._capacity
+        self._tree[idxes] = values
+
+        for _ in range(self._depth):
+            idxes = np.unique(idxes // 2)
+            self._tree[idxes] = self._operation(
+                self._tree[2 * idxes], self._tree[2 * idxes + 1]
+            )
+
+    def __getitem__(self, idxes: np.ndarray) -> np.ndarray:
+        return self._tree[np.asarray(idxes) + self._capacity]
+
+    def reduce(self) -> float:
+        """Returns the aggregate of all leaves."""
+        return self._tree[1]
+
+    def state_dict(self) -> dict:
+        # pylint:disable=missing-function-docstring
+        return {"tree": self._tree.copy()}
+
+    def load_state_dict(self, state: dict):
+        # pylint:disable=missing-function-docstring
+        self._tree = state["tree"].copy()
+
+
+class SumSegmentTree(SegmentTree):
+    """Segment tree holding partial sums of the leaves."""
+
+    def __init__(self, capacity: int):
+        super().__init__(capacity, operation=np.add, neutral_element=0.0)
+
+    def find_prefixsum_idx(self, prefixsums: np.ndarray) -> np.ndarray:
+        """Find the leaves at which each cumulative sum is reached.
+
+        For each value `s`, returns the highest index `i` such that the sum of
+        leaves `[0, i)` is less than or equal to `s`. All values are traversed
+        down the tree in lockstep.
+
+        Args:
+            prefixsums: Array of cumulative sums in `[0, self.reduce())`
+
+        Returns:
+            Array of leaf indices with the same shape as `prefixsums`
+        """
+        tree = self._tree
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        idxes = np.ones_like(prefixsums, dtype=np.int64)
+        for _ in range(self._depth):
+            left = 2 * idxes
+            left_sum = tree[left]
+            go_right = prefixsums >= left_sum
+            prefixsums = np.where(go_right, prefixsums - left_sum, prefixsums)
+            idxes = left + go_right
+        return idxes - self._capacity
+
+
+class MinSegmentTree(SegmentTree):
+    """Segment tree holding the minimum of the leaves."""
+
+    def __init__(self, capacity: int):
+        super().__init__(capacity, operation=np.minimum, neutral_element=np.inf)
@@ -0,0 +1,67 @@
+# pylint:disable=missing-module-docstring,missing-function-docstring,import-outside-toplevel
+import time
+
+import click
+import gym.spaces as spaces
+import numpy as np
+
+from raylab.utils.debug import fake_batch
+
+
+def make_policy(obs_dim: int, act_dim: int, replay_size: int, epochs: int):
+    from raylab.agents.mbpo import MBPOTorchPolicy
+
+    obs_space = spaces.Box(-np.inf, np.inf, shape=(obs_dim,), dtype=np.float32)
+    action_space = spaces.Box(-1.0, 1.0, shape=(act_dim,), dtype=np.float32)
+    # Fixed number of epochs, so that both trainers do the same work
+    training = {"max_epochs": epochs, "max_steps": None, "patience": None}
+    config = {"model_training": {"training": training, "warmup": training}}
+    policy = MBPOTorchPolicy(obs_space, action_space, config)
+
+    policy.replay.add(fake_batch(obs_space, action_space, replay_size))
+    return policy
+
+
+def epochs_per_sec(trainer, iterations: int) -> float:
+    trainer.optimize()
+    epochs = 0
+    start = time.perf_counter()
+    for _ in range(iterations):
+        _, info = trainer.optimize()
+        epochs += info["model_epochs"]
+    elapsed = time.perf_counter() - start
+    return epochs / elapsed
+
+
+@click.command()
+@click.option("--iterations", type=int, default=5)
+@click.option("--epochs", type=int, default=2)
+@click.option("--replay-size", type=int, default=int(1e4))
+@click.option("--obs-dim", type=int, default=17)
+@click.option("--act-dim", type=int, default=6)
+def main(iterations, epochs, replay_size, obs_dim, act_dim):
+    """Compare MBPO model epochs per second with Lightning and a PyTorch loop."""
+    from raylab.policy.model_based import LightningModelTrainer
+    from raylab.policy.model_based import TorchModelTrainer
+
+    policy = make_policy(obs_dim, act_dim, replay_size, epochs)
+    args = (
+        policy.module.models,
+        policy.loss_model,
+        policy.optimizers["models"],
+        policy.replay,
+        policy.config,
+    )
+
+    results = {}
+    for name, cls in (
+        ("lightning", LightningModelTrainer),
+        ("torch", TorchModelTrainer),
+    ):
+        results[name] = epochs_per_sec(cls(*args), iterations)
+        print(f"Model training ({name}): {results[name]:.2f} epochs/s")
+    print(f"Model training speedup: {results['torch'] / results['lightning']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()  # pylint:disable=no-value-for-parameter
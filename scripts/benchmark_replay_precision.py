@@ -0,0 +1,84 @@
+# pylint:disable=missing-module-docstring,missing-function-docstring
+import click
+import numpy as np
+import torch
+from ray.rllib import SampleBatch
+
+from raylab.envs import get_env_creator
+from raylab.utils.replay_buffer import NumpyReplayBuffer
+from raylab.utils.replay_buffer import PACKED_BITS
+
+
+def collect_transitions(env_name: str, steps: int, seed: int) -> SampleBatch:
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    env = get_env_creator(env_name)({})
+    env.action_space.seed(seed)
+
+    keys = (
+        SampleBatch.CUR_OBS,
+        SampleBatch.ACTIONS,
+        SampleBatch.REWARDS,
+        SampleBatch.NEXT_OBS,
+        SampleBatch.DONES,
+    )
+    rows = {k: [] for k in keys}
+    obs = env.reset()
+    for _ in range(steps):
+        act = env.action_space.sample()
+        new_obs, rew, done, _ = env.step(act)
+        for key, val in zip(rows, (obs, act, rew, new_obs, done)):
+            rows[key].append(val)
+        obs = env.reset() if done else new_obs
+    return SampleBatch({k: np.asarray(v) for k, v in rows.items()})
+
+
+def fill_replay(env, samples: SampleBatch, dtypes=None) -> NumpyReplayBuffer:
+    replay = NumpyReplayBuffer(
+        env.observation_space, env.action_space, samples.count, dtypes=dtypes
+    )
+    replay.add(samples)
+    return replay
+
+
+def storage_nbytes(replay: NumpyReplayBuffer) -> int:
+    return sum(getattr(a, "data", a).nbytes for a in replay._storage.values())
+
+
+@click.command()
+@click.option(
+    "--envs", "-e", multiple=True, default=("Navigation", "Reservoir", "HVAC")
+)
+@click.option("--steps", type=int, default=int(1e5))
+@click.option("--obs-dtype", default="float16")
+@click.option("--seed", type=int, default=42)
+def main(envs, steps, obs_dtype, seed):
+    """Compare memory and accuracy of full and reduced-precision replay storage."""
+    dtypes = {
+        SampleBatch.CUR_OBS: obs_dtype,
+        SampleBatch.NEXT_OBS: obs_dtype,
+        SampleBatch.DONES: PACKED_BITS,
+    }
+    for env_name in envs:
+        samples = collect_transitions(env_name, steps, seed)
+        env = get_env_creator(env_name)({})
+        full = fill_replay(env, samples)
+        reduced = fill_replay(env, samples, dtypes=dtypes)
+
+        full_bytes, reduced_bytes = storage_nbytes(full), storage_nbytes(reduced)
+        print(
+            f"{env_name}: {full_bytes / 2**20:.2f} MiB -> "
+            f"{reduced_bytes / 2**20:.2f} MiB ({reduced_bytes / full_bytes:.1%})"
+        )
+        expected, batch = full[:steps], reduced[:steps]
+        for key in (SampleBatch.CUR_OBS, SampleBatch.NEXT_OBS):
+            error = np.abs(batch[key].astype(np.float64) - expected[key])
+            print(f"  {key} abs error: max {error.max():.3g}, mean {error.mean():.3g}")
+        dones_match = np.array_equal(
+            batch[SampleBatch.DONES], expected[SampleBatch.DONES]
+        )
+        print(f"  dones exact: {dones_match}")
+
+
+if __name__ == "__main__":
+    main()  # pylint:disable=no-value-for-parameter
@@ -0,0 +1,65 @@
+# pylint:disable=missing-module-docstring,missing-function-docstring,import-outside-toplevel
+import time
+
+import click
+import gym.spaces as spaces
+import numpy as np
+
+from raylab.utils.debug import fake_batch
+
+
+def make_policy(agent_name: str, storage: str, obs_dim: int, act_dim: int, config):
+    from raylab.agents.sac import SACTorchPolicy
+    from raylab.agents.td3.policy import TD3TorchPolicy
+
+    policy_cls = {"SAC": SACTorchPolicy, "TD3": TD3TorchPolicy}[agent_name]
+    obs_space = spaces.Box(-np.inf, np.inf, shape=(obs_dim,), dtype=np.float32)
+    action_space = spaces.Box(-1.0, 1.0, shape=(act_dim,), dtype=np.float32)
+    config = {**config, "replay": {"storage": storage}}
+    return policy_cls(obs_space, action_space, config)
+
+
+def updates_per_sec(policy, iterations: int) -> float:
+    obs_space, action_space = policy.observation_space, policy.action_space
+    policy.learn_on_batch(
+        fake_batch(obs_space, action_space, policy.config["buffer_size"])
+    )
+
+    samples = fake_batch(obs_space, action_space, batch_size=1)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        policy.learn_on_batch(samples)
+    elapsed = time.perf_counter() - start
+    return iterations * policy.config["improvement_steps"] / elapsed
+
+
+@click.command()
+@click.option("--agents", "-a", multiple=True, default=("SAC", "TD3"))
+@click.option("--iterations", type=int, default=200)
+@click.option("--improvement-steps", type=int, default=10)
+@click.option("--batch-size", type=int, default=256)
+@click.option("--buffer-size", type=int, default=int(1e5))
+@click.option("--obs-dim", type=int, default=17)
+@click.option("--act-dim", type=int, default=6)
+def main(
+    agents, iterations, improvement_steps, batch_size, buffer_size, obs_dim, act_dim
+):
+    """Compare policy updates per second of NumPy and tensor replay storage."""
+    # pylint:disable=too-many-arguments
+    config = {
+        "improvement_steps": improvement_steps,
+        "batch_size": batch_size,
+        "buffer_size": buffer_size,
+    }
+    for agent_name in agents:
+        results = {}
+        for storage in ("memory", "torch"):
+            policy = make_policy(agent_name, storage, obs_dim, act_dim, config)
+            results[storage] = updates_per_sec(policy, iterations)
+            print(f"{agent_name} ({storage}): {results[storage]:.1f} updates/s")
+        speedup = results["torch"] / results["memory"]
+        print(f"{agent_name} speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()  # pylint:disable=no-value-for-parameter
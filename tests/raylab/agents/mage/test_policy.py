@@ -8,6 +8,7 @@ from raylab.policy.losses import MAGE
 from raylab.policy.losses import MaximumLikelihood
 from raylab.policy.stats import LEARNER_STATS_KEY
 from raylab.utils.debug import fake_batch
+from raylab.utils.replay_buffer import PrioritizedReplayBuffer
 
 
 @pytest.fixture(scope="module")
@@ -105,6 +106,28 @@ def test_learn_on_batch(policy, samples):
     assert np.isfinite(info["grad_norm(critics)"])
 
 
+def test_learn_on_batch_prioritized(
+    policy_cls, obs_space, action_space, reward_fn, termination_fn, samples, mocker
+):
+    # pylint:disable=too-many-arguments
+    training = {"max_steps": 1}
+    config = {
+        "model_training": {"training": training, "warmup": training},
+        "replay": {"prioritized": True},
+    }
+    policy = policy_cls(obs_space, action_space, {"policy": config})
+    policy.set_reward_from_callable(reward_fn)
+    policy.set_termination_from_callable(termination_fn)
+    assert isinstance(policy.replay, PrioritizedReplayBuffer)
+
+    update = mocker.spy(PrioritizedReplayBuffer, "update_priorities")
+    info = policy.learn_on_batch(samples)[LEARNER_STATS_KEY]
+    assert np.isfinite(info["loss(critics)"])
+    assert update.call_count == policy.config["improvement_steps"]
+    _, idxes, priorities = update.call_args[0]
+    assert len(idxes) == len(priorities) == policy.config["batch_size"]
+
+
 def test_compile(policy, mocker):
     method = mocker.spy(MAGE, "compile")
     policy.compile()
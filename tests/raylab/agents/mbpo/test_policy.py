@@ -1,5 +1,7 @@
 import pytest
 
+from raylab.utils.replay_buffer import PrioritizedReplayBuffer
+
 
 @pytest.fixture(scope="module", params=(1, 4), ids=lambda s: f"Ensemble:{s}")
 def ensemble_size(request):
@@ -43,3 +45,48 @@ def test_policy_creation(policy):
 
     for attr in "replay virtual_replay".split():
         assert hasattr(policy, attr)
+
+
+def test_learn_on_batch_prioritized(policy_cls, env_samples, mocker):
+    training = {"max_steps": 1}
+    config = {
+        "batch_size": 32,
+        "real_data_ratio": 0.5,
+        "model_rollouts": 4,
+        "model_training": {"training": training, "warmup": training},
+        "replay": {"prioritized": True},
+    }
+    policy = policy_cls({"policy": config})
+    assert isinstance(policy.replay, PrioritizedReplayBuffer)
+
+    update = mocker.spy(PrioritizedReplayBuffer, "update_priorities")
+    policy.learn_on_batch(env_samples)
+    assert update.call_count == policy.config["improvement_steps"]
+    _, idxes, priorities = update.call_args[0]
+    assert len(idxes) == len(priorities) == 16
+
+
+def test_prefetch(policy_cls):
+    config = {"batch_size": 32, "real_data_ratio": 0.5, "replay": {"prefetch": 2}}
+    policy = policy_cls({"policy": config})
+    assert policy.prefetcher.batch_size == 16
+
+    thread = policy.prefetcher._thread
+    policy.close()
+    assert policy.prefetcher is None
+    assert not thread.is_alive()
+
+
+def test_prefetch_std_obs(policy_cls):
+    config = {"std_obs": True, "replay": {"prefetch": 2}}
+    with pytest.raises(ValueError, match="std_obs"):
+        policy_cls({"policy": config})
+
+
+def test_close_async_rollouts(policy_cls):
+    policy = policy_cls({"policy": {"async_rollouts": True}})
+    executor = policy.rollout_sampler._executor
+    policy.close()
+    assert policy.rollout_sampler is None
+    with pytest.raises(RuntimeError):
+        executor.submit(print)
@@ -87,3 +87,10 @@ def test_second_train(trainer, timesteps_per_iteration, learning_starts):
 
     policy = trainer.get_policy()
     assert policy.global_timestep == expected_timesteps
+
+
+def test_shared_replay_checkpoint(trainer_cls, config):
+    config["policy"] = {"replay": {"storage": "shared"}}
+    config["replay_checkpoint"] = "full"
+    with pytest.raises(AssertionError, match="cannot be checkpointed"):
+        trainer_cls(config=config)
@@ -83,6 +83,23 @@ def test_mage_call(loss_fn, batch, critics):
     assert all([p.grad is not None for p in critics.parameters()])
 
 
+def test_importance_weights(loss_fn, batch):
+    loss_fn.seed(42)
+    torch.manual_seed(42)
+    loss, _ = loss_fn(batch)
+    td_error = loss_fn.last_td_error
+    assert torch.is_tensor(td_error)
+    assert td_error.shape == batch[SampleBatch.REWARDS].shape
+    assert not td_error.requires_grad
+
+    weighted = batch.copy()
+    weighted["weights"] = torch.ones_like(batch[SampleBatch.REWARDS])
+    loss_fn.seed(42)
+    torch.manual_seed(42)
+    weighted_loss, _ = loss_fn(weighted)
+    assert torch.allclose(loss, weighted_loss)
+
+
 @pytest.mark.skip(reason="https://github.com/pytorch/pytorch/issues/42459")
 def test_script_backprop(loss_fn, batch, critics):
     loss_fn.compile()
@@ -38,3 +38,19 @@ def test_compile(loss_fn, batch):
 
     assert torch.is_tensor(loss)
     loss.sum().backward()
+
+
+def test_batched(models, batch):
+    from raylab.policy.modules.model import BatchedSME
+
+    batched = BatchedSME(list(models))
+    expected, _ = MaximumLikelihood(models)(batch)
+
+    loss_fn = MaximumLikelihood(batched)
+    loss_fn.compile()
+    loss, info = loss_fn(batch)
+    assert torch.allclose(loss, expected, atol=1e-6)
+    assert len(info) == len(models)
+
+    loss.backward()
+    assert all(p.grad is not None for p in batched.parameters())
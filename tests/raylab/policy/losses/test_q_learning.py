@@ -105,3 +105,16 @@ def test_soft_critic_loss(soft_cdq_loss, batch, critics, soft_target):
     loss.backward()
     assert all([any([p.grad is not None for p in pars]) for pars in params])
     assert all([p.grad is None for p in aux_params])
+
+
+def test_importance_weights(cdq_loss, batch):
+    loss, _ = cdq_loss(batch)
+    td_error = cdq_loss.last_td_error
+    assert torch.is_tensor(td_error)
+    assert td_error.shape == batch[SampleBatch.REWARDS].shape
+    assert not td_error.requires_grad
+
+    weighted = batch.copy()
+    weighted["weights"] = torch.ones_like(batch[SampleBatch.REWARDS])
+    weighted_loss, _ = cdq_loss(weighted)
+    assert torch.allclose(loss, weighted_loss)
@@ -4,6 +4,7 @@ from ray.rllib import SampleBatch
 
 from raylab.policy.losses.svg import OneStepSVG
 from raylab.policy.losses.svg import ReproduceRewards
+from raylab.policy.losses.svg import TrajectorySVG
 
 
 @pytest.fixture
@@ -100,3 +101,28 @@ def test_propagates_gradients(repr_rewards, consistent_batch, actor):
     rew.sum().backward()
 
     assert all(p.grad is not None for p in actor.parameters())
+
+
+@pytest.fixture
+def trajectory_loss(model, actor, critic, reward_fn):
+    loss = TrajectorySVG(model, actor, critic)
+    loss.set_reward_fn(reward_fn)
+    return loss
+
+
+@torch.no_grad()
+def test_sequences_loss(trajectory_loss, consistent_batch):
+    episodes = [
+        {k: v[:3] for k, v in consistent_batch.items()},
+        {k: v[3:5] for k, v in consistent_batch.items()},
+    ]
+    padded = {
+        k: torch.stack([episodes[0][k], torch.cat([episodes[1][k], v[4:5]])])
+        for k, v in consistent_batch.items()
+    }
+    padded[trajectory_loss.MASK] = torch.tensor([[True] * 3, [True, True, False]])
+
+    loss, _ = trajectory_loss(episodes)
+    seq_loss, info = trajectory_loss.sequences_loss(padded)
+    assert torch.allclose(loss, seq_loss, atol=1e-5)
+    assert "sim_return_mean" in info
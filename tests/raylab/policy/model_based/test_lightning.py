@@ -16,6 +16,7 @@ from raylab.options import configure
 from raylab.policy import OptimizerCollection
 from raylab.policy.losses import Loss
 from raylab.policy.model_based.lightning import DataModule
+from raylab.policy.model_based.lightning import EarlyStopping
 from raylab.policy.model_based.lightning import LightningModel
 from raylab.policy.model_based.lightning import LightningModelTrainer
 from raylab.policy.model_based.lightning import TrainingSpec
@@ -296,6 +297,67 @@ def test_checkpointing(build_trainer):
     before_params = copy.deepcopy(list(pl_model.parameters()))
     losses, info = trainer.run_training(pl_model, pl_trainer, datamodule)
     assert info["model_epochs"] == patience + 1
+    assert info["model_snapshots"] == 1
 
     after_params = list(pl_model.parameters())
     assert not any([torch.allclose(b, a) for b, a in zip(before_params, after_params)])
+
+
+def test_datamodule_batches(mocker, replay, holdout_ratio):
+    spec = TrainingSpec.from_dict(
+        {"datamodule": {"batch_size": 32, "holdout_ratio": holdout_ratio}}
+    ).datamodule
+    datamodule = DataModule(replay, spec)
+    datamodule.setup(None)
+    train_idxes = datamodule.train_dataset.idxes
+    val_idxes = datamodule.val_dataset.idxes
+    assert len(train_idxes) + len(val_idxes) == len(replay)
+    assert not set(train_idxes).intersection(val_idxes)
+
+    getitem = mocker.spy(NumpyReplayBuffer, "__getitem__")
+    batches = list(datamodule.train_dataloader())
+    assert getitem.call_count == len(batches) == math.ceil(len(train_idxes) / 32)
+    assert all(torch.is_tensor(v) for b in batches for v in b.values())
+    assert sum(len(b[SampleBatch.CUR_OBS]) for b in batches) == len(train_idxes)
+    assert all(len(b[SampleBatch.ACTIONS]) == 32 for b in batches[:-1])
+
+
+@pytest.mark.parametrize("max_holdout", (None, 10))
+def test_datamodule_holdout(obs_space, action_space, max_holdout):
+    replay = NumpyReplayBuffer(obs_space, action_space, size=200)
+    spec = TrainingSpec.from_dict(
+        {"datamodule": {"holdout_ratio": 0.2, "max_holdout": max_holdout}}
+    ).datamodule
+    datamodule = DataModule(replay, spec)
+
+    replay.add(fake_batch(obs_space, action_space, batch_size=100))
+    datamodule.setup(None)
+    first = set(datamodule.val_dataset.idxes)
+    datamodule.setup(None)
+    assert set(datamodule.val_dataset.idxes) == first
+
+    # Filling and then overwriting the ring buffer keeps previous holdout slots
+    for _ in range(2):
+        replay.add(fake_batch(obs_space, action_space, batch_size=100))
+        datamodule.setup(None)
+        val_idxes = datamodule.val_dataset.idxes
+        assert first.issubset(val_idxes) or len(val_idxes) == max_holdout
+        assert not set(datamodule.train_dataset.idxes).intersection(val_idxes)
+        assert len(datamodule.train_dataset) + len(val_idxes) == len(replay)
+        assert len(val_idxes) <= (max_holdout or len(replay))
+
+
+def test_reuse_trainer(mocker, build_trainer):
+    trainer = build_trainer(DummyLoss)
+    trainer.spec.reuse_trainer = True
+    trainer_init = mocker.spy(pl.Trainer, "__init__")
+    reset = mocker.spy(EarlyStopping, "reset")
+
+    for _ in range(3):
+        losses, info = trainer.optimize(warmup=False)
+        spec = trainer.spec.training
+        assert 0 < info["model_epochs"] <= spec.max_epochs
+        assert "model_setup_time_s" in info
+
+    assert trainer_init.call_count == 1
+    assert reset.call_count == 2
@@ -1,3 +1,4 @@
+import dataclasses
 import functools
 import random
 
@@ -10,7 +11,10 @@ from raylab.options import configure
 from raylab.options import option
 from raylab.policy import ModelSamplingMixin
 from raylab.policy import TorchPolicy
+from raylab.policy.model_based.sampling import AsyncModelSampler
 from raylab.utils.debug import fake_batch
+from raylab.utils.replay_buffer import CompactReplayBuffer
+from raylab.utils.replay_buffer import NumpyReplayBuffer
 
 ENSEMBLE_SIZE = (1, 4)
 ROLLOUT_SCHEDULE = ([(0, 1), (200, 10)], [(7, 2)])
@@ -98,6 +102,12 @@ def test_set_new_elite(policy, losses):
 
     expected_elites = [policy.module.models[i] for i in np.argsort(losses)]
     assert all(ee is em for ee, em in zip(expected_elites, policy.elite_models))
+    num_elites = policy.config["model_sampling"]["num_elites"]
+    assert len(policy.elite_models) == num_elites
+    assert all(
+        policy.module.models[i] is m
+        for i, m in zip(policy.elite_idxes, policy.elite_models)
+    )
 
 
 def test_generate_virtual_sample_batch(policy, rollout_schedule):
@@ -126,3 +136,134 @@ def test_generate_virtual_sample_batch(policy, rollout_schedule):
     assert batch[SampleBatch.NEXT_OBS].shape == (batch.count,) + obs_space.shape
     assert batch[SampleBatch.REWARDS].shape == (batch.count,)
     assert batch[SampleBatch.REWARDS].shape == (batch.count,)
+
+
+def test_virtual_rollouts_are_consecutive(policy):
+    obs_space, action_space = policy.observation_space, policy.action_space
+    initial_states = 10
+    samples = fake_batch(obs_space, action_space, batch_size=initial_states)
+    batch = policy.generate_virtual_sample_batch(samples)
+
+    shape = (initial_states, -1)
+    obs = batch[SampleBatch.CUR_OBS].reshape(shape + obs_space.shape)
+    new_obs = batch[SampleBatch.NEXT_OBS].reshape(shape + obs_space.shape)
+    dones = batch[SampleBatch.DONES].reshape(shape)
+
+    init_obs = samples[SampleBatch.CUR_OBS]
+    assert np.allclose(obs[:, 0], init_obs)
+    expected = np.where(dones[:, :-1, None], init_obs[:, None], new_obs[:, :-1])
+    assert np.allclose(obs[:, 1:], expected)
+
+
+@pytest.mark.parametrize("replay_cls", (NumpyReplayBuffer, CompactReplayBuffer))
+def test_write_virtual_samples(policy, replay_cls):
+    obs_space, action_space = policy.observation_space, policy.action_space
+    samples = fake_batch(obs_space, action_space, batch_size=10)
+
+    expected = NumpyReplayBuffer(obs_space, action_space, size=1000)
+    policy.rng = np.random.default_rng(42)
+    torch.manual_seed(42)
+    expected.add(policy.generate_virtual_sample_batch(samples))
+
+    replay = replay_cls(obs_space, action_space, size=1000)
+    policy.rng = np.random.default_rng(42)
+    torch.manual_seed(42)
+    policy.write_virtual_samples(samples, replay)
+
+    assert len(replay) == len(expected)
+    idxes = np.arange(len(replay))
+    batch, target = replay[idxes], expected[idxes]
+    assert all(np.allclose(batch[k], target[k]) for k in target)
+
+
+@pytest.fixture
+def drop_terminated(policy):
+    spec = policy.model_sampling_spec
+    policy.model_sampling_spec = dataclasses.replace(spec, drop_terminated=True)
+    yield policy
+    policy.model_sampling_spec = spec
+
+
+def test_drop_terminated(drop_terminated):
+    policy = drop_terminated
+    obs_space, action_space = policy.observation_space, policy.action_space
+    initial_states = 10
+    samples = fake_batch(obs_space, action_space, batch_size=initial_states)
+    batch = policy.generate_virtual_sample_batch(samples)
+
+    counts = policy.rollout_stats()["rollout_active_counts"]
+    assert batch.count == sum(counts)
+    assert counts[0] == initial_states
+    assert all(a >= b for a, b in zip(counts[:-1], counts[1:]))
+
+    rollout_length = round(policy.rollout_schedule(policy.global_timestep))
+    obs, new_obs = batch[SampleBatch.CUR_OBS], batch[SampleBatch.NEXT_OBS]
+    dones = batch[SampleBatch.DONES]
+    idx = 0
+    for init_obs in samples[SampleBatch.CUR_OBS]:
+        assert np.allclose(obs[idx], init_obs)
+        for _ in range(rollout_length - 1):
+            if dones[idx]:
+                break
+            assert np.allclose(obs[idx + 1], new_obs[idx])
+            idx += 1
+        idx += 1
+    assert idx == batch.count
+
+
+def test_drop_terminated_early(drop_terminated):
+    policy = drop_terminated
+    obs_space, action_space = policy.observation_space, policy.action_space
+    samples = fake_batch(obs_space, action_space, batch_size=10)
+    termination_fn = policy.termination_fn
+    policy.termination_fn = lambda obs, *_: torch.ones(obs.shape[:-1], dtype=torch.bool)
+    try:
+        batch = policy.generate_virtual_sample_batch(samples)
+    finally:
+        policy.termination_fn = termination_fn
+
+    rollout_length = round(policy.rollout_schedule(policy.global_timestep))
+    stats = policy.rollout_stats()
+    assert batch.count == 10
+    assert stats["rollout_active_counts"] == [10] + [0] * (rollout_length - 1)
+    assert stats["rollout_active_fraction"] == pytest.approx(1 / rollout_length)
+
+
+def test_async_model_sampler(policy):
+    obs_space, action_space = policy.observation_space, policy.action_space
+    samples = fake_batch(obs_space, action_space, batch_size=10)
+    sampler = AsyncModelSampler(policy, seed=0)
+    assert not sampler.pending
+
+    sampler.submit(samples)
+    assert sampler.pending
+    params = list(policy.module.models.parameters())
+    with torch.no_grad():
+        for param in params:
+            param.add_(1.0)
+    batch = sampler.result()
+    with torch.no_grad():
+        for param in params:
+            param.sub_(1.0)
+
+    assert not sampler.pending
+    assert isinstance(batch, SampleBatch)
+    assert batch.count == sum(sampler.rollout_active_counts)
+    assert 0 <= sampler.hidden_time <= sampler.generation_time
+
+    snapshot = sampler._snapshot.module.models.parameters()
+    assert all(s is not p and torch.allclose(s, p) for s, p in zip(snapshot, params))
+    sampler.close()
+
+
+@pytest.mark.parametrize("interval", (1, 3))
+def test_scheduled_rollouts(policy, interval):
+    spec = policy.model_sampling_spec
+    policy.model_sampling_spec = dataclasses.replace(spec, rollout_interval=interval)
+    policy._rollout_calls = 0
+
+    counts = [policy.scheduled_rollouts(10) for _ in range(2 * interval)]
+    assert counts[0] == 10 * interval
+    assert counts == counts[:interval] * 2
+    assert sum(counts) == 10 * len(counts)
+    policy.model_sampling_spec = spec
@@ -0,0 +1,179 @@
+import copy
+import itertools
+
+import pytest
+import torch
+from ray.rllib import SampleBatch
+
+from raylab.policy.losses import Loss
+from raylab.policy.model_based.lightning import LightningModelTrainer
+from raylab.policy.model_based.training import build_model_trainer
+from raylab.policy.model_based.training import TorchModelTrainer
+from raylab.policy.modules import get_module
+from raylab.torch.optim import build_optimizer
+from raylab.utils.debug import fake_batch
+from raylab.utils.replay_buffer import NumpyReplayBuffer
+
+
+class DummyLoss(Loss):
+    # pylint:disable=all
+    batch_keys = (SampleBatch.CUR_OBS, SampleBatch.ACTIONS, SampleBatch.NEXT_OBS)
+
+    def __init__(self, models):
+        self.models = models
+
+    def _losses(self, batch):
+        obs = batch[SampleBatch.CUR_OBS]
+        act = batch[SampleBatch.ACTIONS]
+        new_obs = batch[SampleBatch.NEXT_OBS]
+        losses = [-m.log_prob(new_obs, m(obs, act)).mean() for m in self.models]
+        return torch.stack(losses)
+
+    def __call__(self, batch):
+        losses = self._losses(batch)
+        info = {"loss(models)": losses.mean().item()}
+        self.last_output = (losses, info)
+        return losses.mean(), info
+
+
+class WorseningLoss(DummyLoss):
+    def __init__(self, models):
+        super().__init__(models)
+        self._increasing_seq = itertools.count()
+
+    def _losses(self, batch):
+        losses = super()._losses(batch)
+        return losses - losses.detach() + float(next(self._increasing_seq))
+
+
+@pytest.fixture(scope="module", params=(1, 4), ids=lambda s: f"Ensemble({s})")
+def ensemble_size(request):
+    return request.param
+
+
+@pytest.fixture
+def models(obs_space, action_space, ensemble_size):
+    cnf = {"type": "ModelBasedSAC", "model": {"ensemble_size": ensemble_size}}
+    module = get_module(obs_space, action_space, cnf)
+    return module.models
+
+
+@pytest.fixture
+def optimizer(models):
+    return build_optimizer(models, {"type": "Adam"})
+
+
+@pytest.fixture(scope="module")
+def replay(obs_space, action_space):
+    samples = fake_batch(obs_space, action_space, batch_size=256)
+    replay = NumpyReplayBuffer(obs_space, action_space, size=samples.count)
+    replay.add(samples)
+    return replay
+
+
+@pytest.fixture(params=(None, 0, 2), ids=lambda x: f"Patience:{x}")
+def patience(request):
+    return request.param
+
+
+@pytest.fixture(params=(0.0, 0.2), ids=lambda x: f"Holdout%:{x}")
+def holdout_ratio(request):
+    return request.param
+
+
+@pytest.fixture
+def config(patience, holdout_ratio):
+    trainer_cfg = {"max_epochs": 3, "max_steps": 10, "patience": patience}
+    return {
+        "model_training": {
+            "datamodule": {"batch_size": 32, "holdout_ratio": holdout_ratio},
+            "training": trainer_cfg,
+            "warmup": trainer_cfg,
+            "framework": "torch",
+        },
+    }
+
+
+@pytest.fixture
+def build_trainer(models, optimizer, replay, config):
+    def builder(model_loss):
+        return build_model_trainer(
+            models, model_loss(models), optimizer, replay, config
+        )
+
+    return builder
+
+
+def test_build_model_trainer(build_trainer, config):
+    assert isinstance(build_trainer(DummyLoss), TorchModelTrainer)
+    config["model_training"]["framework"] = "lightning"
+    assert isinstance(build_trainer(DummyLoss), LightningModelTrainer)
+
+
+@pytest.mark.parametrize("warmup", (False, True))
+def test_optimize(build_trainer, models, ensemble_size, warmup):
+    trainer = build_trainer(DummyLoss)
+    before = copy.deepcopy(list(models.parameters()))
+    losses, info = trainer.optimize(warmup=warmup)
+
+    assert isinstance(losses, list)
+    assert len(losses) == ensemble_size
+    assert all(isinstance(loss, float) for loss in losses)
+    assert "loss(models)" in info
+
+    spec = trainer.spec.warmup if warmup else trainer.spec.training
+    assert 0 < info["model_epochs"] <= spec.max_epochs
+    assert 0 < info["model_steps"] <= spec.max_steps
+    assert info["model_snapshots"] <= info["model_epochs"]
+    after = list(models.parameters())
+    assert not all(torch.allclose(b, a) for b, a in zip(before, after))
+
+
+def test_checkpointing(build_trainer, models):
+    trainer = build_trainer(WorseningLoss)
+    patience = 2
+    spec = trainer.spec.training
+    spec.max_epochs = 1000
+    spec.max_steps = None
+    spec.patience = patience
+
+    first_epoch = []
+    train_epoch = trainer._train_epoch
+
+    def spy(*args, **kwargs):
+        outputs = train_epoch(*args, **kwargs)
+        if not first_epoch:
+            first_epoch.extend(copy.deepcopy(list(models.parameters())))
+        return outputs
+
+    trainer._train_epoch = spy
+    losses, info = trainer.optimize()
+    assert info["model_epochs"] == patience + 1
+    assert info["model_snapshots"] == 1
+    assert all(torch.allclose(b, a) for b, a in zip(first_epoch, models.parameters()))
+
+
+def test_snapshot_reuse(build_trainer):
+    trainer = build_trainer(DummyLoss)
+    trainer.spec.training.patience = 1
+    trainer.optimize()
+    state = trainer._snapshot.state
+    ptrs = [t.data_ptr() for t in state.values()]
+
+    _, info = trainer.optimize()
+    assert info["model_snapshots"] >= 1
+    assert trainer._snapshot.state is state
+    assert [t.data_ptr() for t in state.values()] == ptrs
+
+
+def test_no_data(models, optimizer, obs_space, action_space, config, ensemble_size):
+    replay = NumpyReplayBuffer(obs_space, action_space, size=100)
+    trainer = build_model_trainer(models, DummyLoss(models), optimizer, replay, config)
+    losses, info = trainer.optimize()
+    assert len(losses) == ensemble_size
+    assert info["model_epochs"] == info["model_steps"] == 0
+
+    replay.add(fake_batch(obs_space, action_space, batch_size=64))
+    losses, _ = trainer.optimize()
+    replay._curr_size = 0  # Empty the buffer
+    assert trainer.optimize()[0] == losses
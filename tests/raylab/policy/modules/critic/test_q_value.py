@@ -1,6 +1,7 @@
 import pytest
 import torch
 
+from raylab.policy.modules.critic import BatchedQValueEnsemble
 from raylab.policy.modules.critic import MLPQValue
 from raylab.policy.modules.critic import QValueEnsemble
 
@@ -44,3 +45,38 @@ def test_script_backprop(q_value_ensemble, obs, action):
     values = critics(obs, action)
     clipped = QValueEnsemble.clipped(values)
     clipped.mean().backward()
+
+
+@pytest.fixture
+def q_values(obs_space, action_space, n_critics):
+    spec = MLPQValue.spec_cls(units=(32, 32), activation="ReLU", delay_action=True)
+    return [MLPQValue(obs_space, action_space, spec) for _ in range(n_critics)]
+
+
+@pytest.fixture
+def batched(q_values, torch_script):
+    module = BatchedQValueEnsemble(q_values)
+    return torch.jit.script(module) if torch_script else module
+
+
+def test_batched(batched, q_values, obs, action, n_critics):
+    values = batched.stacked_values(obs, action)
+    assert values.shape == obs.shape[:-1] + (n_critics,)
+
+    expected = torch.stack([q(obs, action) for q in q_values], dim=-1)
+    assert torch.allclose(values, expected, atol=1e-6)
+    assert all(
+        torch.allclose(v, e) for v, e in zip(batched(obs, action), expected.unbind(-1))
+    )
+
+    values.min(dim=-1)[0].mean().backward()
+    assert all(p.grad is not None for p in batched.parameters())
+
+
+def test_batched_members(q_values, obs, action, n_critics):
+    batched = BatchedQValueEnsemble(q_values)
+    assert len(batched) == n_critics
+
+    for member, q_value in zip(batched, q_values):
+        assert torch.allclose(member(obs, action), q_value(obs, action), atol=1e-6)
+        assert set(member.parameters()) == set(batched.parameters())
@@ -2,6 +2,7 @@ import pytest
 import torch
 
 from raylab.policy.modules.actor import Alpha
+from raylab.policy.modules.critic import BatchedVValueEnsemble
 from raylab.policy.modules.critic import HardValue
 from raylab.policy.modules.critic import MLPVValue
 from raylab.policy.modules.critic import SoftValue
@@ -39,6 +40,23 @@ def test_forward(v_value_ensemble, obs, n_critics):
     _test_value(clipped, obs)
 
 
+def test_batched(obs_space, obs, n_critics):
+    spec = MLPVValue.spec_cls(units=(32, 32), activation="ReLU")
+    v_values = [MLPVValue(obs_space, spec) for _ in range(n_critics)]
+    batched = BatchedVValueEnsemble(v_values)
+
+    values = batched.stacked_values(obs)
+    assert values.shape == obs.shape[:-1] + (n_critics,)
+    expected = torch.stack([v(obs) for v in v_values], dim=-1)
+    assert torch.allclose(values, expected, atol=1e-6)
+
+    clipped = BatchedVValueEnsemble.clipped(batched(obs))
+    _test_value(clipped, obs)
+    assert all(
+        torch.allclose(m(obs), v(obs), atol=1e-6) for m, v in zip(batched, v_values)
+    )
+
+
 @pytest.fixture
 def critics(action_critics):
     _, target_critics = action_critics
@@ -131,3 +131,48 @@ def test_deterministic(module, obs, act, rew, expand_foreach_model):
     assert obs1[0].grad_fn is not None
     obs1[0].sum().backward()
     assert any([p.grad is not None for p in module[0].parameters()])
+
+
+@pytest.fixture
+def models(build_single, ensemble_size):
+    return [build_single() for _ in range(ensemble_size)]
+
+
+@pytest.fixture
+def batched(models, torch_script):
+    from raylab.policy.modules.model.stochastic.ensemble import BatchedSME
+
+    module = BatchedSME(models)
+    return torch.jit.script(module) if torch_script else module
+
+
+@torch.no_grad()
+def test_batched_matches_models(batched, models, obs, act, next_obs):
+    obss, acts, next_obss = ([t] * len(models) for t in (obs, act, next_obs))
+
+    params = batched(obss, acts)
+    logps = batched.log_prob(next_obss, params)
+    outputs = batched.deterministic(params)
+    for idx, model in enumerate(models):
+        expected = model(obs, act)
+        assert all(torch.allclose(params[idx][k], v) for k, v in expected.items())
+        assert torch.allclose(logps[idx], model.log_prob(next_obs, expected))
+        assert len(logps) == len(outputs) == len(batched)
+        sample, logp = outputs[idx]
+        sample_, logp_ = model.deterministic(expected)
+        assert torch.allclose(sample, sample_)
+        assert torch.allclose(logp, logp_)
+
+
+@torch.no_grad()
+def test_batched_members(models, obs, act):
+    from raylab.policy.modules.model.stochastic.ensemble import BatchedSME
+
+    batched = BatchedSME(models)
+    assert len(batched[:-1]) == len(models) - 1
+    for member, model in zip(batched, models):
+        params, expected = member(obs, act), model(obs, act)
+        assert all(torch.allclose(params[k], v) for k, v in expected.items())
+
+        sample, _ = member.sample(params, torch.Size([2]))
+        assert sample.shape == (2,) + obs.shape
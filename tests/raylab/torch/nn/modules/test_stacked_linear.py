@@ -0,0 +1,29 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from raylab.torch.nn import StackedLinear
+
+
+@pytest.fixture(params=(1, 4), ids=lambda x: f"Stack({x})")
+def linears(request):
+    return [nn.Linear(3, 5) for _ in range(request.param)]
+
+
+@pytest.fixture
+def module(linears, torch_script):
+    module = StackedLinear(linears)
+    return torch.jit.script(module) if torch_script else module
+
+
+@pytest.mark.parametrize("batch_shape", ((), (10,), (2, 5)))
+def test_forward(module, linears, batch_shape):
+    inputs = torch.randn((len(linears),) + batch_shape + (3,))
+
+    outputs = module(inputs)
+    assert outputs.shape == inputs.shape[:-1] + (5,)
+    expected = torch.stack([l(i) for l, i in zip(linears, inputs)])
+    assert torch.allclose(outputs, expected, atol=1e-6)
+
+    outputs.sum().backward()
+    assert all(p.grad is not None for p in module.parameters())
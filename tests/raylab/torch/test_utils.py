@@ -0,0 +1,72 @@
+import pytest
+import torch
+from torch import nn
+
+from raylab.torch.utils import copy_tensors_
+from raylab.torch.utils import StateSnapshot
+
+
+@pytest.fixture
+def module():
+    return nn.Sequential(nn.Linear(4, 8), nn.BatchNorm1d(8), nn.Linear(8, 2))
+
+
+def test_state_snapshot(module):
+    snapshot = StateSnapshot()
+    assert not snapshot.saved
+    assert snapshot.state is None
+
+    snapshot.save(module.state_dict())
+    assert snapshot.saved
+    assert snapshot.count == 1
+    state = snapshot.state
+    ptrs = {k: v.data_ptr() for k, v in state.items()}
+    expected = {k: v.clone() for k, v in module.state_dict().items()}
+
+    with torch.no_grad():
+        for par in module.parameters():
+            par.add_(1.0)
+    assert all(torch.allclose(state[k], v) for k, v in expected.items())
+
+    snapshot.save(module.state_dict())
+    assert snapshot.count == 2
+    assert snapshot.state is state
+    assert {k: v.data_ptr() for k, v in state.items()} == ptrs
+    assert all(torch.allclose(state[k], v) for k, v in module.state_dict().items())
+
+    snapshot.reset()
+    assert not snapshot.saved
+    assert snapshot.state is state
+
+
+def test_state_snapshot_restore(module):
+    snapshot = StateSnapshot()
+    snapshot.save(module.state_dict())
+    expected = [p.clone() for p in module.parameters()]
+
+    with torch.no_grad():
+        for par in module.parameters():
+            par.mul_(2.0).add_(1.0)
+    module.load_state_dict(snapshot.state)
+    assert all(torch.allclose(e, p) for e, p in zip(expected, module.parameters()))
+
+
+def test_state_snapshot_reallocates(module):
+    snapshot = StateSnapshot()
+    snapshot.save(module.state_dict())
+    other = nn.Linear(3, 3)
+    snapshot.save(other.state_dict())
+    assert snapshot.state.keys() == other.state_dict().keys()
+
+
+def test_copy_tensors_(monkeypatch):
+    src = [torch.randn(3), torch.randn(2, 2), torch.tensor(5)]
+    dst = [torch.empty_like(t) for t in src]
+    copy_tensors_(dst, src)
+    assert all(torch.equal(d, s) for d, s in zip(dst, src))
+
+    # Fallback for PyTorch versions without foreach ops
+    monkeypatch.delattr(torch, "_foreach_copy_", raising=False)
+    dst = [torch.zeros_like(t) for t in src]
+    copy_tensors_(dst, src)
+    assert all(torch.equal(d, s) for d, s in zip(dst, src))
@@ -1,17 +1,32 @@
+import gc
+import os
+import time
+import uuid
 from functools import partial
 
 import numpy as np
 import pytest
+import torch
 from ray.rllib import SampleBatch
 
 from raylab.utils.debug import fake_batch
+from raylab.utils.replay_buffer import CompactReplayBuffer
+from raylab.utils.replay_buffer import GenerationalReplayBuffer
+from raylab.utils.replay_buffer import MemmapStorage
+from raylab.utils.replay_buffer import MixedReplaySampler
 from raylab.utils.replay_buffer import NumpyReplayBuffer
+from raylab.utils.replay_buffer import PACKED_BITS
+from raylab.utils.replay_buffer import PackedBits
+from raylab.utils.replay_buffer import PrioritizedReplayBuffer
 from raylab.utils.replay_buffer import ReplayField
+from raylab.utils.replay_buffer import ReplayPrefetcher
+from raylab.utils.replay_buffer import SharedReplayBuffer
+from raylab.utils.replay_buffer import TorchReplayBuffer
 
 
-@pytest.fixture
-def replay_cls(obs_space, action_space):
-    return partial(NumpyReplayBuffer, obs_space=obs_space, action_space=action_space)
+@pytest.fixture(params=(NumpyReplayBuffer, CompactReplayBuffer))
+def replay_cls(request, obs_space, action_space):
+    return partial(request.param, obs_space=obs_space, action_space=action_space)
 
 
 @pytest.fixture
@@ -91,6 +106,23 @@ def test_sample(filled_replay):
     assert all([np.allclose(samples[k], samples_[k]) for k in samples.keys()])
 
 
+def test_sample_many(filled_replay):
+    replay = filled_replay
+    replay.seed(42)
+    batches = replay.sample_many(3, 16)
+    assert len(batches) == 3
+    assert all(isinstance(b, SampleBatch) for b in batches)
+    assert all(b.count == 16 for b in batches)
+
+    replay.seed(42)
+    block = replay.sample(48)
+    assert all(
+        np.array_equal(b[k], block[k][i * 16 : (i + 1) * 16])
+        for i, b in enumerate(batches)
+        for k in block.keys()
+    )
+
+
 def test_update_obs_stats(filled_replay: NumpyReplayBuffer, obs_space):
     replay = filled_replay
     replay.update_obs_stats()
@@ -116,15 +148,16 @@ def test_getitem(filled_replay: NumpyReplayBuffer, sample_batch: SampleBatch, id
         [np.allclose(batch[k], sample_batch[k][idx]) for k in sample_batch.keys()]
     )
 
-    mean = np.mean(sample_batch[SampleBatch.CUR_OBS], axis=0)
-    std = np.std(sample_batch[SampleBatch.CUR_OBS], axis=0)
+    obs = sample_batch[SampleBatch.CUR_OBS].astype(np.float64)
+    mean = np.mean(obs, axis=0)
+    std = np.std(obs, axis=0)
     std[std < 1e-12] = 1.0
 
     replay.compute_stats = True
     batch = replay[idx]
     for key in SampleBatch.CUR_OBS, SampleBatch.NEXT_OBS:
         expected = (sample_batch[key][idx] - mean) / std
-        assert np.allclose(batch[key], expected)
+        assert np.allclose(batch[key], expected, atol=1e-6)
 
 
 @pytest.fixture(params=(True, False), ids=lambda x: f"ComputeStats:{x}")
@@ -136,3 +169,751 @@ def empty_replay(request, replay: NumpyReplayBuffer):
 def test_empty(empty_replay: NumpyReplayBuffer, sample_batch: SampleBatch):
     obs = empty_replay.normalize(sample_batch[SampleBatch.CUR_OBS])
     assert np.allclose(obs, sample_batch[SampleBatch.CUR_OBS])
+
+
+@pytest.fixture
+def memmap_replay(replay_cls, tmp_path):
+    return replay_cls(size=100, storage=MemmapStorage(str(tmp_path)))
+
+
+def test_memmap_storage(memmap_replay, sample_batch, tmp_path):
+    replay = memmap_replay
+    replay.add(sample_batch)
+
+    assert all(isinstance(v, np.memmap) for v in replay._storage.values())
+    assert all((tmp_path / f"{k}.npy").exists() for k in replay._storage)
+    buffer = replay.all_samples()
+    assert all(np.allclose(sample_batch[k], buffer[k]) for k in sample_batch.keys())
+
+
+def test_memmap_reopen(memmap_replay, replay_cls, sample_batch, tmp_path):
+    memmap_replay.add(sample_batch)
+    assert "cursor" not in memmap_replay.state_dict()
+    memmap_replay.save(str(tmp_path))
+
+    reopened = replay_cls(size=100, storage=MemmapStorage(str(tmp_path)))
+    reopened.restore(str(tmp_path))
+    assert len(reopened) == sample_batch.count
+    buffer = reopened.all_samples()
+    assert all(np.allclose(sample_batch[k], buffer[k]) for k in sample_batch.keys())
+
+
+def test_memmap_temporary(replay_cls, sample_batch):
+    storage = MemmapStorage()
+    assert not storage.persistent
+    directory = storage.directory
+    replay = replay_cls(size=100, storage=storage)
+    replay.add(sample_batch)
+    assert os.listdir(directory)
+    assert "cursor" not in replay.state_dict()
+
+    del replay, storage
+    gc.collect()
+    assert not os.path.exists(directory)
+
+
+@pytest.mark.parametrize("compute_stats", (False, True))
+def test_gather_into(filled_replay, compute_stats):
+    filled_replay.compute_stats = compute_stats
+    idxes = np.array([[0, 3, 3], [9, 1, 2]])
+    expected = filled_replay[idxes]
+    out = {k: np.empty_like(v) for k, v in expected.items()}
+    filled_replay.gather_into(idxes, out)
+    assert all(np.allclose(expected[k], out[k]) for k in expected)
+
+
+def test_mixed_sampler(replay_cls, obs_space, action_space):
+    real, virtual = replay_cls(size=100), replay_cls(size=100)
+    real_batch = fake_batch(obs_space, action_space, batch_size=20)
+    real_batch[SampleBatch.REWARDS][:] = 1.0
+    virtual_batch = fake_batch(obs_space, action_space, batch_size=50)
+    virtual_batch[SampleBatch.REWARDS][:] = -1.0
+    real.add(real_batch)
+    virtual.add(virtual_batch)
+
+    sampler = MixedReplaySampler([real, virtual], [2, 6])
+    batches = sampler.sample_many(3)
+    assert len(batches) == 3
+    for batch in batches:
+        assert all(len(v) == sampler.batch_size for v in batch.values())
+        assert batch.keys() == real[0].keys()
+        assert np.all(batch[SampleBatch.REWARDS] == [1.0] * 2 + [-1.0] * 6)
+        real_obs = real_batch[SampleBatch.CUR_OBS]
+        for obs in batch[SampleBatch.CUR_OBS][:2]:
+            assert np.any(np.all(real_obs == obs, axis=-1))
+
+
+@pytest.fixture
+def prioritized_replay(obs_space, action_space, sample_batch):
+    replay = PrioritizedReplayBuffer(obs_space, action_space, size=100)
+    replay.add(sample_batch)
+    return replay
+
+
+def test_prioritized_sample(prioritized_replay):
+    replay = prioritized_replay
+    samples = replay.sample(32)
+
+    assert isinstance(samples, SampleBatch)
+    assert replay.WEIGHTS in samples
+    assert replay.IDXES in samples
+    idxes = samples[replay.IDXES]
+    assert np.all((idxes >= 0) & (idxes < len(replay)))
+    # All priorities equal to the max priority on insertion
+    assert np.allclose(samples[replay.WEIGHTS], 1.0)
+
+
+def test_prioritized_sample_many(prioritized_replay):
+    batches = prioritized_replay.sample_many(4, 8)
+    assert len(batches) == 4
+    assert all(b.count == 8 for b in batches)
+    assert all(prioritized_replay.IDXES in b for b in batches)
+
+
+def test_update_priorities(prioritized_replay):
+    replay = prioritized_replay
+    priorities = np.zeros(len(replay))
+    priorities[3] = 100.0
+    replay.update_priorities(np.arange(len(replay)), priorities)
+
+    samples = replay.sample(64)
+    idxes = samples[replay.IDXES]
+    assert np.mean(idxes == 3) > 0.9
+    weights = samples[replay.WEIGHTS]
+    assert np.all(weights <= 1.0)
+    assert np.allclose(weights[idxes == 3], weights[idxes == 3].min())
+
+
+@pytest.fixture
+def trajectory(obs_space, action_space):
+    batch = fake_batch(obs_space, action_space, batch_size=50)
+    obs = batch[SampleBatch.CUR_OBS]
+    batch[SampleBatch.NEXT_OBS][:-1] = obs[1:]
+    batch[SampleBatch.DONES][:] = False
+    # Episode boundary in the middle of the trajectory
+    batch[SampleBatch.NEXT_OBS][24] = fake_batch(obs_space, action_space)[
+        SampleBatch.NEXT_OBS
+    ]
+    batch[SampleBatch.DONES][24] = True
+    return batch
+
+
+@pytest.mark.parametrize("size", (7, 30, 100))
+def test_compact_obs(obs_space, action_space, trajectory, size):
+    compact = CompactReplayBuffer(obs_space, action_space, size=size)
+    replay = NumpyReplayBuffer(obs_space, action_space, size=size)
+    for start in range(0, trajectory.count, 5):
+        samples = trajectory.slice(start, start + 5)
+        compact.add(samples)
+        replay.add(samples)
+
+        assert compact.num_boundaries <= 2
+        expected = replay[: len(replay)]
+        batch = compact[: len(compact)]
+        assert all(np.array_equal(expected[k], batch[k]) for k in expected)
+        idx = len(replay) - 1
+        assert all(np.array_equal(replay[idx][k], compact[idx][k]) for k in expected)
+
+
+@pytest.mark.parametrize("size", (7, 20, 100))
+def test_save_restore(replay_cls, trajectory, size, tmp_path):
+    replay = replay_cls(size=size, track_episodes=True)
+    directory = str(tmp_path / "replay")
+    for start, end in ((0, 3), (3, 8), (8, 30), (30, 31), (31, 50)):
+        replay.add(trajectory.slice(start, end))
+        replay.save(directory)
+
+        restored = replay_cls(size=size, track_episodes=True)
+        restored.restore(directory)
+        assert len(restored) == len(replay)
+        expected = replay[: len(replay)]
+        batch = restored[: len(restored)]
+        assert all(np.array_equal(expected[k], batch[k]) for k in expected)
+        idxes = np.arange(len(replay))
+        bounds = zip(replay.episode_bounds(idxes), restored.episode_bounds(idxes))
+        assert all(np.array_equal(a, b) for a, b in bounds)
+
+
+@pytest.mark.parametrize("chunk", (1, 7, 50))
+def test_episode_bounds(replay_cls, trajectory, chunk):
+    replay = replay_cls(size=100, track_episodes=True)
+    for start in range(0, trajectory.count, chunk):
+        replay.add(trajectory.slice(start, start + chunk))
+
+    preceding, remaining = replay.episode_bounds(np.arange(50))
+    assert np.array_equal(preceding, np.tile(np.arange(25), 2))
+    assert np.array_equal(remaining, np.tile(np.arange(25, 0, -1), 2))
+
+
+def test_episode_bounds_overwritten(replay_cls, trajectory):
+    replay = replay_cls(size=30, track_episodes=True)
+    for start in range(0, trajectory.count, 7):
+        replay.add(trajectory.slice(start, start + 7))
+
+    # Slots hold trajectory rows 30-49 followed by rows 20-29
+    rows = np.concatenate([np.arange(30, 50), np.arange(20, 30)])
+    preceding, remaining = replay.episode_bounds(np.arange(30))
+    assert np.array_equal(preceding, np.where(rows < 25, rows - 20, rows - 25))
+    assert np.array_equal(remaining, np.where(rows < 25, 25 - rows, 50 - rows))
+
+
+def test_episode_bounds_eps_id(replay_cls, obs_space, action_space):
+    samples = fake_batch(obs_space, action_space, batch_size=10)
+    samples[SampleBatch.DONES][:] = False
+    samples[SampleBatch.EPS_ID] = np.array([0, 0, 0, 1, 1, 2, 2, 2, 2, 2])
+    replay = replay_cls(size=20, track_episodes=True)
+    replay.add(samples.slice(0, 4))
+    replay.add(samples.slice(4, 10))
+
+    preceding, remaining = replay.episode_bounds(np.arange(10))
+    assert np.array_equal(preceding, [0, 1, 2, 0, 1, 0, 1, 2, 3, 4])
+    assert np.array_equal(remaining, [3, 2, 1, 2, 1, 5, 4, 3, 2, 1])
+
+
+@pytest.mark.parametrize("size", (30, 100))
+def test_sample_sequences(replay_cls, trajectory, size):
+    replay = replay_cls(size=size, track_episodes=True)
+    for start in range(0, trajectory.count, 7):
+        replay.add(trajectory.slice(start, start + 7))
+
+    batch = replay.sample_sequences(64, horizon=8)
+    mask = batch[replay.MASK]
+    obs, next_obs = batch[SampleBatch.CUR_OBS], batch[SampleBatch.NEXT_OBS]
+    assert mask.shape == (64, 8)
+    assert obs.shape == (64, 8) + trajectory[SampleBatch.CUR_OBS].shape[1:]
+    assert mask[:, 0].all()
+    assert np.all(mask[:, :-1] >= mask[:, 1:])
+
+    lengths = mask.sum(axis=1)
+    for seq_obs, seq_next_obs, length in zip(obs, next_obs, lengths):
+        assert np.array_equal(seq_obs[1:length], seq_next_obs[: length - 1])
+        assert all(np.array_equal(o, seq_obs[length - 1]) for o in seq_obs[length:])
+
+
+def test_untracked_episodes(replay_cls, trajectory):
+    replay = replay_cls(size=100)
+    replay.add(trajectory)
+    assert not replay._episode_index
+    with pytest.raises(ValueError, match="track_episodes"):
+        replay.sample_sequences(16, horizon=5)
+
+
+def test_torch_replay_sample_sequences(obs_space, action_space, trajectory):
+    replay = TorchReplayBuffer(obs_space, action_space, size=100, track_episodes=True)
+    replay.add(trajectory)
+
+    batch = replay.sample_sequences(16, horizon=5)
+    assert all(torch.is_tensor(v) for v in batch.values())
+    assert batch[replay.MASK].shape == (16, 5)
+    assert batch[SampleBatch.ACTIONS].shape[:2] == (16, 5)
+
+
+def test_memmap_priorities_state(obs_space, action_space, sample_batch, tmp_path):
+    storage = MemmapStorage(str(tmp_path))
+    replay = PrioritizedReplayBuffer(obs_space, action_space, 100, storage=storage)
+    replay.add(sample_batch)
+    assert set(replay.state_dict()) == {
+        "obs_stats",
+        "running_obs_stats",
+        "max_priority",
+    }
+
+
+def test_save_restore_priorities(prioritized_replay, obs_space, action_space, tmp_path):
+    replay = prioritized_replay
+    replay.update_priorities(np.array([1, 3]), np.array([5.0, 0.5]))
+    replay.save(str(tmp_path))
+
+    restored = PrioritizedReplayBuffer(obs_space, action_space, size=100)
+    restored.restore(str(tmp_path))
+    assert np.allclose(
+        restored.importance_weights(np.arange(10)),
+        replay.importance_weights(np.arange(10)),
+    )
+
+
+def test_save_restore_obs_stats(replay_cls, obs_space, action_space, tmp_path):
+    replay = replay_cls(size=20)
+    replay.compute_stats = True
+    replay.add(fake_batch(obs_space, action_space, batch_size=15))
+    old_state = replay.state_dict()
+    replay.add(fake_batch(obs_space, action_space, batch_size=15))
+    replay.save(str(tmp_path))
+    replay.update_obs_stats()
+
+    # Restoring older weights with the latest contents keeps stats consistent
+    restored = replay_cls(size=20)
+    restored.compute_stats = True
+    restored.load_state_dict(old_state)
+    restored.restore(str(tmp_path))
+    restored.update_obs_stats()
+    assert all(
+        np.allclose(a, b) for a, b in zip(restored._obs_stats, replay._obs_stats)
+    )
+
+
+def test_torch_replay_save_restore(obs_space, action_space, sample_batch, tmp_path):
+    replay = TorchReplayBuffer(obs_space, action_space, size=100)
+    replay.add(sample_batch)
+    replay.save(str(tmp_path))
+
+    restored = TorchReplayBuffer(obs_space, action_space, size=100)
+    restored.restore(str(tmp_path))
+    assert len(restored) == len(replay)
+    expected = replay[: len(replay)]
+    batch = restored[: len(restored)]
+    assert all(torch.equal(expected[k], batch[k]) for k in expected)
+
+
+def test_packed_bits():
+    bits = PackedBits(np.zeros(3, dtype=np.uint8), size=20)
+    values = np.random.default_rng(42).random(20) > 0.5
+    bits[:13] = values[:13]
+    bits[np.arange(13, 20)] = values[13:]
+    assert np.array_equal(bits[:], values)
+    assert np.array_equal(bits[np.array([19, 0, 7])], values[[19, 0, 7]])
+
+    bits[7] = not values[7]
+    assert bits[7] != values[7]
+    assert np.array_equal(np.delete(bits[:], 7), np.delete(values, 7))
+
+
+@pytest.fixture
+def reduced_dtypes():
+    return {
+        SampleBatch.CUR_OBS: "float16",
+        SampleBatch.NEXT_OBS: "float16",
+        SampleBatch.DONES: PACKED_BITS,
+    }
+
+
+def test_reduced_precision(replay_cls, trajectory, reduced_dtypes):
+    replay = replay_cls(size=30, dtypes=reduced_dtypes)
+    full = replay_cls(size=30)
+    for start in range(0, trajectory.count, 7):
+        replay.add(trajectory.slice(start, start + 7))
+        full.add(trajectory.slice(start, start + 7))
+
+    batch, expected = replay[: len(replay)], full[: len(full)]
+    assert all(batch[k].dtype == expected[k].dtype for k in expected)
+    assert np.array_equal(batch[SampleBatch.DONES], expected[SampleBatch.DONES])
+    for key in (SampleBatch.CUR_OBS, SampleBatch.NEXT_OBS):
+        assert np.allclose(batch[key], expected[key], rtol=1e-3, atol=1e-3)
+
+    storage = replay._storage
+    assert storage[SampleBatch.CUR_OBS].dtype == np.float16
+    assert storage[SampleBatch.DONES].data.nbytes == 4
+
+
+def test_reduced_precision_save_restore(
+    replay_cls, trajectory, reduced_dtypes, tmp_path
+):
+    replay = replay_cls(size=20, dtypes=reduced_dtypes)
+    replay.add(trajectory)
+    replay.save(str(tmp_path))
+
+    restored = replay_cls(size=20, dtypes=reduced_dtypes)
+    restored.restore(str(tmp_path))
+    expected = replay[: len(replay)]
+    batch = restored[: len(restored)]
+    assert all(np.array_equal(expected[k], batch[k]) for k in expected)
+
+
+def test_torch_replay_reduced_precision(obs_space, action_space, sample_batch):
+    dtypes = {SampleBatch.CUR_OBS: "float16", SampleBatch.NEXT_OBS: "float16"}
+    replay = TorchReplayBuffer(obs_space, action_space, size=100, dtypes=dtypes)
+    replay.add(sample_batch)
+
+    assert replay._storage[SampleBatch.CUR_OBS].dtype == torch.float16
+    batch = replay.sample(32)
+    assert batch[SampleBatch.CUR_OBS].dtype == torch.float32
+    assert batch[SampleBatch.NEXT_OBS].dtype == torch.float32
+
+
+@pytest.mark.parametrize("chunk", (1, 3, 25))
+def test_running_obs_stats(replay_cls, obs_space, action_space, chunk):
+    replay = replay_cls(size=20)
+    replay.compute_stats = True
+    for _ in range(10):
+        replay.add(fake_batch(obs_space, action_space, batch_size=chunk))
+
+        cur_obs = replay._storage[SampleBatch.CUR_OBS][: len(replay)]
+        replay.update_obs_stats()
+        mean, std = replay._obs_stats
+        expected_std = np.std(cur_obs, axis=0)
+        expected_std[expected_std < 1e-12] = 1.0
+        assert np.allclose(mean, np.mean(cur_obs, axis=0), atol=1e-5)
+        assert np.allclose(std, expected_std, atol=1e-5)
+
+
+def test_running_obs_stats_off(replay_cls, obs_space, action_space):
+    replay = replay_cls(size=20)
+    for _ in range(3):
+        replay.add(fake_batch(obs_space, action_space, batch_size=9))
+    assert replay._running_obs_stats.count == 0
+
+    replay.compute_stats = True
+    replay.update_obs_stats()
+    cur_obs = replay._storage[SampleBatch.CUR_OBS][: len(replay)]
+    assert np.allclose(replay._obs_stats[0], np.mean(cur_obs, axis=0), atol=1e-5)
+
+
+def test_running_obs_stats_state(filled_replay, replay_cls):
+    filled_replay.compute_stats = True
+    state = filled_replay.state_dict()
+    filled_replay.update_obs_stats()
+    mean, std = filled_replay._obs_stats
+
+    replay = replay_cls(size=100)
+    replay.compute_stats = True
+    replay.load_state_dict(state)
+    replay.update_obs_stats()
+    assert np.allclose(replay._obs_stats[0], mean)
+    assert np.allclose(replay._obs_stats[1], std)
+
+
+@pytest.mark.parametrize("chunk", (7, 45))
+def test_torch_replay(obs_space, action_space, chunk):
+    torch_replay = TorchReplayBuffer(obs_space, action_space, size=30)
+    replay = NumpyReplayBuffer(obs_space, action_space, size=30)
+    torch_replay.compute_stats = replay.compute_stats = True
+    for _ in range(5):
+        samples = fake_batch(obs_space, action_space, batch_size=chunk)
+        torch_replay.add(samples)
+        replay.add(samples)
+
+        assert len(torch_replay) == len(replay)
+        expected = replay[: len(replay)]
+        batch = torch_replay[: len(torch_replay)]
+        assert all(np.allclose(expected[k], batch[k].numpy(), atol=1e-6) for k in batch)
+
+        idxes = np.array([0, len(replay) - 1])
+        expected = replay[idxes]
+        batch = torch_replay[torch.from_numpy(idxes)]
+        assert all(np.allclose(expected[k], batch[k].numpy(), atol=1e-6) for k in batch)
+
+
+def test_torch_replay_sample(obs_space, action_space, sample_batch):
+    replay = TorchReplayBuffer(obs_space, action_space, size=100)
+    replay.add(sample_batch)
+    replay.seed(42)
+
+    batch = replay.sample(32)
+    assert all(torch.is_tensor(v) for v in batch.values())
+    assert all(v.size(0) == 32 for v in batch.values())
+    assert batch[SampleBatch.CUR_OBS].dtype == torch.float32
+    assert batch[SampleBatch.DONES].dtype == torch.bool
+
+    replay.seed(42)
+    assert torch.equal(
+        batch[SampleBatch.ACTIONS], replay.sample(32)[SampleBatch.ACTIONS]
+    )
+
+
+def test_torch_replay_sample_many(obs_space, action_space, sample_batch):
+    replay = TorchReplayBuffer(obs_space, action_space, size=100)
+    replay.add(sample_batch)
+
+    batches = replay.sample_many(5, 8)
+    assert len(batches) == 5
+    assert all(v.size(0) == 8 for b in batches for v in b.values())
+
+
+@pytest.fixture
+def prefetcher(obs_space, action_space):
+    replay = NumpyReplayBuffer(obs_space, action_space, size=10)
+    replay.add(fake_batch(obs_space, action_space, batch_size=10))
+    prefetcher = ReplayPrefetcher(
+        replay,
+        batch_size=2,
+        convert=lambda b: {k: torch.as_tensor(v) for k, v in b.items()},
+        capacity=8,
+        seed=42,
+    )
+    yield prefetcher
+    prefetcher.close()
+
+
+def wait_full(prefetcher):
+    while len(prefetcher) < prefetcher.capacity:
+        time.sleep(0.001)
+
+
+def test_prefetcher_get(prefetcher):
+    batch = prefetcher.get()
+    assert all(torch.is_tensor(v) for v in batch.values())
+    assert all(v.size(0) == 2 for v in batch.values())
+
+
+def test_prefetcher_get_closed(prefetcher):
+    prefetcher.close()
+    prefetcher.clear()
+    with pytest.raises(RuntimeError, match="closed"):
+        prefetcher.get()
+
+
+def test_prefetcher_get_empty(obs_space, action_space):
+    replay = NumpyReplayBuffer(obs_space, action_space, size=10)
+    prefetcher = ReplayPrefetcher(
+        replay, batch_size=2, convert=lambda b: b, capacity=8, seed=42
+    )
+    with pytest.raises(RuntimeError, match="empty"):
+        prefetcher.get()
+    prefetcher.close()
+
+
+def test_prefetcher_invalidation(prefetcher, obs_space, action_space):
+    wait_full(prefetcher)
+    prefetcher.close()
+    prefetcher.add(fake_batch(obs_space, action_space, batch_size=3))
+    # pylint:disable=protected-access
+    assert len(prefetcher) > 0
+    assert all(np.all(idxes >= 3) for idxes, _ in prefetcher._queue)
+
+    prefetcher.replay.compute_stats = True
+    prefetcher.add(fake_batch(obs_space, action_space, batch_size=1))
+    assert len(prefetcher) == 0
+
+
+@pytest.fixture
+def shared_replays(obs_space, action_space):
+    name = f"test-{uuid.uuid4().hex[:8]}"
+    # Create the writers' blocks first, as rollout workers may do
+    writers = [
+        SharedReplayBuffer(
+            obs_space, action_space, size=20, name=name, num_writers=2, writer=i
+        )
+        for i in (1, 0)
+    ]
+    learner = SharedReplayBuffer(
+        obs_space,
+        action_space,
+        size=20,
+        name=name,
+        num_writers=2,
+        writer=None,
+        owner=True,
+    )
+    return learner, writers[1], writers[0]
+
+
+def test_shared_replay(shared_replays, obs_space, action_space):
+    learner, _, writer = shared_replays
+    samples = fake_batch(obs_space, action_space, batch_size=4)
+    writer.add(samples)
+    assert len(learner) == len(writer) == 4
+
+    idxes = learner.sample_idxes(100)
+    assert np.all((idxes >= 0) & (idxes < 4))
+    stored = learner.all_samples()
+    assert all(np.array_equal(stored[k], samples[k]) for k in samples.keys())
+    batch = learner[: len(learner)]
+    assert all(np.array_equal(batch[k], samples[k]) for k in samples.keys())
+
+    # The learner does not write, but may be passed empty batches
+    learner.add(fake_batch(obs_space, action_space, batch_size=0))
+    with pytest.raises(AssertionError):
+        learner.add(samples)
+
+
+def test_shared_replay_segments(shared_replays, obs_space, action_space):
+    learner, first, second = shared_replays
+    first_samples = fake_batch(obs_space, action_space, batch_size=3)
+    second_samples = fake_batch(obs_space, action_space, batch_size=25)
+    first.add(first_samples)
+    second.add(second_samples)
+    assert len(learner) == 13
+
+    batch = learner[np.arange(13)]
+    expected = {
+        k: np.concatenate([first_samples[k], second_samples[k][-10:]])
+        for k in first_samples.keys()
+    }
+    # The second segment wraps around
+    for key, values in expected.items():
+        assert np.array_equal(batch[key][:3], values[:3])
+        assert np.array_equal(
+            np.sort(batch[key][3:], axis=0), np.sort(values[3:], axis=0)
+        )
+
+    out = {k: np.empty_like(v[:5]) for k, v in batch.items()}
+    idxes = np.array([0, 2, 3, 7, 12])
+    learner.gather_into(idxes, out)
+    assert all(np.array_equal(out[k], batch[k][idxes]) for k in out)
+
+
+def test_shared_replay_sequences(shared_replays, obs_space, action_space):
+    _, writer, _ = shared_replays
+    writer.add(fake_batch(obs_space, action_space, batch_size=4))
+    with pytest.raises(ValueError, match="episodes"):
+        writer.sample_sequences(2, horizon=3)
+
+
+def test_shared_replay_reserve(shared_replays, obs_space, action_space):
+    learner, _, writer = shared_replays
+    samples = fake_batch(obs_space, action_space, batch_size=14)
+    writer.add(samples.slice(0, 6))
+    with writer.reserve(8) as reservation:
+        for key in samples.keys():
+            reservation.write(key, slice(None), samples[key][6:])
+
+    assert len(learner) == 10
+    stored = learner.all_samples()
+    # Slots 4 and 5 hold the last two transitions after wrapping around
+    order = np.r_[10:14, 4:10]
+    assert all(np.array_equal(stored[k], samples[k][order]) for k in samples.keys())
+
+
+@pytest.fixture(
+    params=(
+        NumpyReplayBuffer,
+        PrioritizedReplayBuffer,
+        TorchReplayBuffer,
+        CompactReplayBuffer,
+        partial(NumpyReplayBuffer, dtypes={SampleBatch.DONES: PACKED_BITS}),
+    ),
+    ids="Numpy Prioritized Torch Compact PackedBits".split(),
+)
+def reserve_cls(request, obs_space, action_space):
+    return partial(request.param, obs_space=obs_space, action_space=action_space)
+
+
+@pytest.mark.parametrize("chunk", (5, 15, 30))
+def test_reserve(reserve_cls, trajectory, chunk):
+    replay = reserve_cls(size=30, track_episodes=True)
+    expected = reserve_cls(size=30, track_episodes=True)
+    replay.compute_stats = expected.compute_stats = True
+    for start in range(0, trajectory.count, chunk):
+        samples = trajectory.slice(start, start + chunk)
+        expected.add(samples)
+        # Write strided rows, as in (rollout, step) ordered model rollouts
+        with replay.reserve(samples.count) as reservation:
+            for row in range(5):
+                for key in samples.keys():
+                    values = torch.as_tensor(samples[key][row::5])
+                    reservation.write(key, slice(row, None, 5), values)
+
+        assert len(replay) == len(expected)
+        idxes = np.arange(len(replay))
+        batch, target = replay[idxes], expected[idxes]
+        assert all(np.allclose(batch[k], target[k]) for k in target)
+        bounds = zip(replay.episode_bounds(idxes), expected.episode_bounds(idxes))
+        assert all(np.array_equal(a, b) for a, b in bounds)
+
+
+def test_reserve_views(obs_space, action_space, sample_batch):
+    replay = NumpyReplayBuffer(obs_space, action_space, size=15)
+    replay.add(sample_batch)
+    reservation = replay.reserve(10)
+    views = reservation.views(SampleBatch.REWARDS)
+    assert [len(v) for v in views] == [5, 5]
+
+    reservation.write(SampleBatch.REWARDS, slice(None), np.arange(10))
+    assert np.array_equal(np.concatenate(views), np.arange(10))
+    reservation.commit()
+    assert len(replay) == 15
+    assert np.array_equal(
+        replay[np.arange(10, 20) % 15][SampleBatch.REWARDS], np.arange(10)
+    )
+
+
+def test_reserve_cancel(obs_space, action_space, sample_batch):
+    replay = NumpyReplayBuffer(obs_space, action_space, size=15)
+    replay.compute_stats = True
+    replay.add(sample_batch)
+    with pytest.raises(RuntimeError):
+        with replay.reserve(10) as reservation:
+            new_obs = np.ones((10,) + obs_space.shape, dtype=obs_space.dtype)
+            reservation.write(SampleBatch.CUR_OBS, slice(None), new_obs)
+            raise RuntimeError
+
+    assert len(replay) == 10
+    replay.update_obs_stats()
+    stored = replay._storage[SampleBatch.CUR_OBS][:10]
+    assert np.allclose(replay._obs_stats[0], stored.mean(axis=0), atol=1e-5)
+
+
+def test_reserve_compact_views(obs_space, action_space, trajectory):
+    replay = CompactReplayBuffer(obs_space, action_space, size=15)
+    replay.add(trajectory.slice(0, 10))
+    samples = trajectory.slice(10, 20)
+    with replay.reserve(samples.count) as reservation:
+        for key in samples.keys():
+            # Next observations have no storage slots but can still be viewed
+            assert sum(len(v) for v in reservation.views(key)) == samples.count
+            reservation.write(key, slice(None), samples[key])
+
+    batch = replay[np.arange(10, 20) % 15]
+    assert all(np.allclose(batch[k], samples[k]) for k in samples.keys())
+    assert replay.num_boundaries == 1
+
+
+@pytest.fixture
+def generational_replay(obs_space, action_space):
+    return GenerationalReplayBuffer(
+        obs_space,
+        action_space,
+        size=40,
+        max_generations=2,
+        min_capacity=8,
+        track_episodes=True,
+    )
+
+
+def test_generational_replay(generational_replay, trajectory):
+    replay = generational_replay
+    replay.compute_stats = True
+    gens = np.repeat([0, 0, 1, 1, 1, 1, 1, 1, 1, 2], 5)
+    for start in range(0, trajectory.count, 5):
+        while replay.generation < gens[start]:
+            replay.new_generation()
+        replay.add(trajectory.slice(start, start + 5))
+        assert replay.allocated <= replay.capacity
+
+    oldest = replay.generation - replay.max_generations + 1
+    kept = np.flatnonzero(gens >= oldest)[-replay.capacity :]
+    assert len(replay) == len(kept)
+    batch = replay._gather(np.arange(len(replay)))
+    assert np.array_equal(batch[replay.GENERATION], gens[kept])
+    assert np.allclose(
+        batch[SampleBatch.CUR_OBS], trajectory[SampleBatch.CUR_OBS][kept]
+    )
+
+    samples = replay.sample(100)
+    assert np.all(samples[replay.GENERATION] >= oldest)
+
+    mean = trajectory[SampleBatch.CUR_OBS][kept].mean(axis=0)
+    assert np.allclose(replay._running_obs_stats.mean, mean, atol=1e-5)
+
+
+def test_generational_eviction(generational_replay, trajectory):
+    replay = generational_replay
+    replay.add(trajectory.slice(0, 30))
+    assert replay.allocated == 30
+    replay.new_generation()
+    replay.add(trajectory.slice(30, 33))
+    replay.new_generation()
+
+    assert len(replay) == 3
+    assert replay.allocated == 8
+    assert np.allclose(
+        replay[np.arange(3)][SampleBatch.CUR_OBS],
+        trajectory[SampleBatch.CUR_OBS][30:33],
+    )
+    starts, ends = replay.episode_bounds(np.arange(3))
+    assert np.array_equal(starts, [0, 1, 2])
+    assert np.array_equal(ends, [3, 2, 1])
+
+
+def test_generational_reserve(generational_replay, trajectory):
+    replay = generational_replay
+    replay.new_generation()
+    samples = trajectory.slice(0, 20)
+    with replay.reserve(samples.count) as reservation:
+        for key in samples.keys():
+            reservation.write(key, slice(None), samples[key])
+
+    assert len(replay) == 20
+    batch = replay[np.arange(20)]
+    assert np.all(batch[replay.GENERATION] == 1)
+    assert np.allclose(batch[SampleBatch.ACTIONS], samples[SampleBatch.ACTIONS])
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from raylab.utils.segment_tree import MinSegmentTree
+from raylab.utils.segment_tree import SumSegmentTree
+
+
+@pytest.fixture(params=(1, 7, 64), ids=lambda x: f"Capacity:{x}")
+def capacity(request):
+    return request.param
+
+
+@pytest.fixture
+def values(capacity):
+    return np.random.uniform(0.1, 2.0, size=capacity)
+
+
+def test_sum_tree(capacity, values):
+    tree = SumSegmentTree(capacity)
+    assert tree.capacity >= capacity
+
+    tree[np.arange(capacity)] = values
+    assert np.isclose(tree.reduce(), values.sum())
+    assert np.allclose(tree[np.arange(capacity)], values)
+
+
+def test_min_tree(capacity, values):
+    tree = MinSegmentTree(capacity)
+    tree[np.arange(capacity)] = values
+    assert np.isclose(tree.reduce(), values.min())
+
+    tree[np.array([0])] = 0.01
+    assert np.isclose(tree.reduce(), 0.01)
+
+
+def test_find_prefixsum_idx(capacity, values):
+    tree = SumSegmentTree(capacity)
+    tree[np.arange(capacity)] = values
+
+    cumsum = np.cumsum(values)
+    prefixsums = np.random.uniform(0, tree.reduce(), size=100)
+    idxes = tree.find_prefixsum_idx(prefixsums)
+
+    expected = np.searchsorted(cumsum, prefixsums, side="right")
+    assert np.array_equal(idxes, expected)